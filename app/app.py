@@ -5,111 +5,323 @@ Copyright (c) 2020 by Thomas J. Daley, J.D.
 """
 import argparse
 import glob
-import json
 import shutil
 import os
+import zipfile
 
-import boto3
-from botocore.exceptions import ClientError, NoCredentialsError
-from whoosh.index import create_in, exists_in, open_dir
-from whoosh.qparser import QueryParser
-from util.classifier import Classifier
-from util.htmltotext import HtmlToText
-from util.retriever import Retriever
-import dotenv
-import util.functions as FN
-
-# Load environment variables
-dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
-dotenv.load_dotenv(dotenv_path)
+# boto3, whoosh and requests (via Retriever) are imported by the commands
+# that use them. Loading all three takes longer than a small command runs,
+# and the scripts start this program once per code.
+from util.autocomplete import build_completions, remove_completions
+from util.citations import build_citations, citation_path, remove_citations
+from util.chapterstore import STORES, open_store
+from util.converter import classify_text, convert_chapter, extract_text
+from util.htmltotext import EXTRACTORS
+from util.httpcache import HttpCache
+from util.indexversions import IndexVersions
+from util.manifest import ChapterManifest
+from util.metrics import METRICS, capture
+from util.mmaptable import remove_table
+from util.pipeline import Pipeline
+from util.references import build_references, references_path, remove_references
+from util.sectionhashes import SectionHashes
+from util.sectiontext import build_section_text, remove_section_text, section_text_path
+from util.spelling import build_spelling, remove_spelling, spelling_path
+import util.functions as FN  # Loads .env
 
 INDEX_PATH = FN.INDEX_PATH
 CODE_PATH = FN.CODE_PATH
 
 
+_progress_percent = None
+
+
 def progress_bar(total, current):
-    bar = 'Progress: ['
+    # Drawing the bar costs more than a small chapter does, so only redraw it when it moves.
+    global _progress_percent
     percent = int(current/total*100)
+    if percent == _progress_percent:
+        return
+    _progress_percent = percent
+    bar = 'Progress: ['
     bar += '*' * percent
     bar += ' ' * (100-percent)
     bar += ']'
     print(bar, end='\r')
 
 
-def section_file_name(code_name: str, chap_num: str) -> str:
-    if chap_num != '*':
-        chapter = str(chap_num).rjust(5, '0')
-    else:
-        chapter = chap_num
-    return f'codes/sections/{code_name}-Chapter-{chapter}.json'
-
-
 def main(args):
-    classifier = Classifier()
-    htmltotexter = HtmlToText()
+    from concurrent.futures import ProcessPoolExecutor
+    from util.retriever import Retriever
     config = FN.code_config(args.code)
     code_name = config['code_name']
-    retriever = Retriever('https://statutes.capitol.texas.gov', code_name)
+    retriever = Retriever(
+        FN.STATUTES_URL,
+        code_name,
+        workers=args.fetch_workers,
+        rate_limit=args.rate_limit,
+        cache=None if args.no_cache else HttpCache(FN.CACHE_PATH),
+        offline=args.offline
+    )
 
-    if args.chapter:
-        chapters = [args.chapter]
-        skip_chapters = []
+    manifest = ChapterManifest(f'{FN.CACHE_PATH}/manifests', code_name)
+    chapters, full_probe = discover_chapters(args, config, manifest)
+    store = open_store(code_name, args.section_store)
+    found_chapters = []
+
+    def retrieved():
+        for chapter, html_content in retriever.retrieve_all(chapters, verbose=False):
+            if not html_content:
+                if not args.quiet:
+                    print(f"{retriever.make_url(chapter)} - (end)")
+                continue
+            found_chapters.append(chapter)
+            yield chapter, html_content
+
+    def saved(chapter, code_file, sections):
+        store.write(chapter, sections)
+        METRICS.count('chapters_saved')
+        METRICS.count('sections_classified', len(sections))
+        if not args.quiet:
+            print(f"{code_file} - {len(sections)} sections saved")
+        return chapter
+
+    # Fetch, extract, classify and save run concurrently, connected by
+    # small queues, so network time overlaps CPU time and only a few
+    # chapters are ever in memory at once.
+    pipeline = Pipeline('fetch', retrieved(), queue_size=args.queue_size)
+    executor = None
+    if args.workers > 1:
+        # Extract and classify on every core. Each thread of this stage
+        # keeps one worker process busy and saves what it hands back.
+        executor = ProcessPoolExecutor(max_workers=args.workers)
+
+        def convert(item):
+            chapter, html_content = item
+            future = executor.submit(convert_chapter, args.code, code_name, chapter, html_content, extractor=args.extractor)
+            return saved(*future.result())
+
+        pipeline.add_stage('convert', convert, threads=args.workers)
     else:
+        def extract(item):
+            chapter, html_content = item
+            return chapter, extract_text(html_content, args.extractor)
+
+        def classify(item):
+            chapter, text_content = item
+            return (chapter,) + classify_text(text_content, args.code, code_name, chapter)
+
+        def write(item):
+            return saved(*item)
+
+        pipeline.add_stage('extract', extract)
+        pipeline.add_stage('classify', classify)
+        pipeline.add_stage('write', write)
+
+    try:
+        pipeline.run()
+    finally:
+        if executor:
+            executor.shutdown()
+        with METRICS.timer('get.store'):
+            store.save()
+        for stage in [pipeline.source] + pipeline.stages:
+            if stage.items:
+                METRICS.add_time(f'get.pipeline.{stage.name}', stage.busy, calls=stage.items)
+    if not args.quiet:
+        print(pipeline.report())
+
+    # Remember which chapters exist so the next run does not probe dead numbers.
+    # An offline run cannot tell a missing chapter from one that is not cached.
+    if not args.chapter and not args.offline:
+        manifest.update(chapters, found_chapters, retriever.not_found, full_probe)
+
+
+def discover_chapters(args, config: dict, manifest: ChapterManifest) -> tuple:
+    """
+    Decide which chapters to retrieve. In order of preference:
+
+        1. The chapter given on the command line.
+        2. The chapters that existed the last time we retrieved this code,
+           unless the whole range was last probed more than
+           REDISCOVER_DAYS ago (offline runs use them regardless).
+        3. Every number from chapter_range_low to chapter_range_high, plus
+           add_chapters. This is the only option on the very first run or
+           when --discover is given.
+
+    Args:
+        args (argparse): Argparse arguments.
+        config (dict): Code configuration.
+        manifest (ChapterManifest): Chapters found on earlier runs.
+    Returns:
+        (tuple): Chapters to retrieve, and whether they are every chapter
+                 the code could have (the whole range).
+    """
+    if args.chapter:
+        return [args.chapter], False
+
+    skip_chapters = config['skip_chapters']
+    chapters = []
+    full_probe = True
+    if manifest.chapters and not args.discover and (args.offline or not manifest.stale()):
+        chapters = manifest.chapters
+        full_probe = False
+    if not chapters:
         chapters = [str(i) for i in range(config['chapter_range_low'], config['chapter_range_high'])]
         for chapter in config['add_chapters']:
             chapters.append(chapter)
-        skip_chapters = config['skip_chapters']
-
-    for chapter in chapters:
-        if chapter in skip_chapters:
-            continue
-        html_content = retriever.retrieve(chapter)
-        if not html_content:
-            print("(end)")
-            continue
-        text_content = htmltotexter.get_text(html_content)
-        print("txt extracted", end=" - ")
-
-        chap_num = str(chapter).rjust(5, '0')
-        code_file = section_file_name(code_name, chap_num)
-        code = classifier.classify_doc(text_content, args.code, code_file)
-        print("classified", end=" - ")
-        with open(code_file, 'w') as json_file:
-            json.dump(code, json_file)
-        print("json saved")
+    return [chapter for chapter in chapters if chapter not in skip_chapters], full_probe
 
 
 def zip_index(args) -> str:
-    archive_file = 'index'
-    algorithm = 'zip'
-    shutil.make_archive(archive_file, algorithm, FN.INDEX_PATH)
-    return f'{archive_file}.{algorithm}'
+    # Leave out what --sync leaves out: lock files, temp files and sync state.
+    from util.s3sync import excluded
+    archive_file = 'index.zip'
+    with zipfile.ZipFile(archive_file, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for folder, _, files in os.walk(FN.INDEX_PATH):
+            for file in sorted(files):
+                path = os.path.join(folder, file)
+                if not excluded(path):
+                    archive.write(path, os.path.relpath(path, FN.INDEX_PATH))
+    return archive_file
 
 
 def zip_code_configs(args) -> str:
-    archive_file = 'code_configs'
-    algorithm = 'zip'
-    shutil.make_archive(archive_file, algorithm, f'{FN.CODE_PATH}/*.json')
-    return f'{archive_file}.{algorithm}'
+    # make_archive() takes a folder, not a glob, and CODE_PATH also holds
+    # every code's sections, so zip just the config files.
+    archive_file = 'code_configs.zip'
+    with zipfile.ZipFile(archive_file, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for file in glob.glob(f'{FN.CODE_PATH}/*.json'):
+            archive.write(file, os.path.basename(file))
+    return archive_file
+
+
+def zip_sections(args) -> str:
+    config = FN.code_config(args.code)
+    store = open_store(config['code_name'], args.section_store)
+    archive_file = f"{config['code_name'].lower()}-sections.zip"
+    with zipfile.ZipFile(archive_file, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for file in store.files():
+            archive.write(file, os.path.basename(file))
+    return archive_file
+
+
+def s3_client():
+    import boto3
+    return boto3.client(
+        's3',
+        aws_access_key_id=os.environ.get('aws_access_key_id'),
+        aws_secret_access_key=os.environ.get('aws_secret_access_key')
+    )
+
+
+def s3_bucket_name() -> str:
+    return os.environ.get('S3_BUCKET_NAME', 'codesearch.attorney.bot')
+
+
+def sync_trees(args, uploading: bool) -> list:
+    """
+    The sets of files named by --upload_* or --download_* options.
+
+    Returns:
+        (list): (tree name in S3, local folder, files to upload or None for the whole folder)
+    """
+    trees = []
+    if args.upload_index or args.download_index:
+        trees.append(('index', FN.INDEX_PATH, None))
+    if args.upload_config or args.download_config:
+        trees.append(('code_configs', FN.CODE_PATH, glob.glob(f'{FN.CODE_PATH}/*.json') if uploading else None))
+    if args.upload_sections or args.download_sections:
+        files = None
+        if uploading:
+            config = FN.code_config(args.code)
+            files = open_store(config['code_name'], args.section_store).files()
+        trees.append((f'sections-{args.code.lower()}', f'{FN.CODE_PATH}/sections', files))
+    return trees
+
+
+def sync(args, uploading: bool) -> bool:
+    """
+    Upload or download with --sync: file by file, sending only what changed.
+    """
+    from botocore.exceptions import ClientError, NoCredentialsError
+    from util.s3sync import S3Sync
+    syncer = S3Sync(s3_client(), s3_bucket_name(), workers=args.sync_workers)
+    for tree, folder, files in sync_trees(args, uploading):
+        versions = None
+        try:
+            if tree == 'index' and not uploading:
+                # Bring a copy of the current version up to date, then switch to it.
+                # Only the files the manifest lists are carried over: anything else,
+                # e.g. a table of contents from an index.zip download, would
+                # outlive every later version, and Whoosh opens the newest TOC it finds.
+                manifest = syncer.manifest(tree) or {}
+                versions = IndexVersions(FN.INDEX_PATH)
+                folder = versions.new_version(names=set(manifest) | {syncer.state_file_name(tree)})
+            if uploading:
+                stats = syncer.upload(tree, folder, files)
+                METRICS.count('s3_files_sent', stats['sent'])
+                METRICS.count('s3_bytes_sent', stats['sent_bytes'])
+                METRICS.count('s3_bytes_unchanged', stats['skipped_bytes'])
+                METRICS.count('s3_objects_deleted', stats['deleted'])
+                print(
+                    f"{tree}: {stats['sent']} of {stats['files']} files uploaded, "
+                    f"{stats['sent_bytes']:,d} bytes sent, {stats['skipped_bytes']:,d} bytes unchanged, "
+                    f"{stats['deleted']} unused objects deleted"
+                )
+            else:
+                stats = syncer.download(tree, folder)
+                if stats is None:
+                    print(f"{tree}: not found in S3")
+                    if versions:
+                        shutil.rmtree(folder, ignore_errors=True)
+                    continue
+                METRICS.count('s3_files_received', stats['received'])
+                METRICS.count('s3_bytes_received', stats['received_bytes'])
+                METRICS.count('s3_files_deleted', stats['deleted'])
+                print(
+                    f"{tree}: {stats['received']} of {stats['files']} files downloaded, "
+                    f"{stats['received_bytes']:,d} bytes received, {stats['deleted']} files removed"
+                )
+                if versions:
+                    activate_index_version(versions, folder, args)
+        except (NoCredentialsError, ClientError) as e:
+            print(str(e))
+            if versions:
+                shutil.rmtree(folder, ignore_errors=True)
+            return False
+    return True
+
+
+def activate_index_version(versions: IndexVersions, version_path: str, args):
+    versions.activate(version_path)
+    versions.prune(args.keep_versions)
+    if not args.quiet:
+        print(f"{FN.INDEX_PATH} now points to {version_path}")
 
 
 def upload(args):
+    from botocore.exceptions import ClientError, NoCredentialsError
+    if args.sync:
+        return sync(args, uploading=True)
+
     zip_functions = []
     if args.upload_index:
         zip_functions.append(zip_index)
     if args.upload_config:
         zip_functions.append(zip_code_configs)
+    if args.upload_sections:
+        zip_functions.append(zip_sections)
 
-    s3_client = boto3.client(
-        's3',
-        aws_access_key_id=os.environ.get('aws_access_key_id'),
-        aws_secret_access_key=os.environ.get('aws_secret_access_key')
-    )
+    client = s3_client()
 
     for fn in zip_functions:
-        archive_file = fn(args)
+        with METRICS.timer('upload.zip'):
+            archive_file = fn(args)
         try:
-            response = s3_client.upload_file(archive_file, 'codesearch.attorney.bot', archive_file)
+            response = client.upload_file(archive_file, s3_bucket_name(), archive_file)
+            METRICS.count('s3_files_sent')
+            METRICS.count('s3_bytes_sent', os.path.getsize(archive_file))
         except NoCredentialsError as e:
             print(str(e))
             return False
@@ -121,20 +333,23 @@ def upload(args):
 
 
 def download(args) -> bool:
+    from botocore.exceptions import ClientError, NoCredentialsError
+    if args.sync:
+        return sync(args, uploading=False)
+
     # Instantiate AWS client to access S3 resources
-    s3_client = boto3.client(
-        's3',
-        aws_access_key_id=os.environ.get('aws_access_key_id'),
-        aws_secret_access_key=os.environ.get('aws_secret_access_key')
-    )
-    s3_bucket_name = os.environ.get('S3_BUCKET_NAME', 'codesearch.attorney.bot')
+    client = s3_client()
+    bucket_name = s3_bucket_name()
 
     # List of archives we will download from S3
     archives = []
+    versions = IndexVersions(FN.INDEX_PATH)
     if args.download_index:
-        archives.append({'object_name': 'index.zip', 'destination': FN.INDEX_PATH})
+        archives.append({'object_name': 'index.zip', 'destination': versions.new_version(link_current=False)})
     if args.download_config:
         archives.append({'object_name': 'code_configs.zip', 'destination': FN.CODE_PATH})
+    if args.download_sections:
+        archives.append({'object_name': f'{args.code.lower()}-sections.zip', 'destination': f'{FN.CODE_PATH}/sections'})
 
     # Here to download and open the archives
     for archive in archives:
@@ -143,22 +358,30 @@ def download(args) -> bool:
 
         # Create destination path, if it does not exist
         if not os.path.exists(destination):
-            os.mkdir(destination)
+            os.makedirs(destination)
 
         # Connect to S3 and download the archive to a binary file
         try:
             file_name = f'{destination}/{object_name}'
             with open(file_name, 'wb') as fp:
-                s3_client.download_fileobj(s3_bucket_name, object_name, fp)
-        except NoCredentialsError as e:
-            print(str(e))
-            return False
-        except ClientError as e:
+                client.download_fileobj(bucket_name, object_name, fp)
+        except (NoCredentialsError, ClientError) as e:
             print(str(e))
+            if object_name == 'index.zip':
+                shutil.rmtree(destination, ignore_errors=True)
             return False
 
+        METRICS.count('s3_files_received')
+        METRICS.count('s3_bytes_received', os.path.getsize(file_name))
+
         # Unpack the archive to its destination folder
-        shutil.unpack_archive(file_name, destination, 'zip')
+        with METRICS.timer('download.unzip'):
+            shutil.unpack_archive(file_name, destination, 'zip')
+
+        # A downloaded index becomes the current version only once it is complete.
+        if object_name == 'index.zip':
+            os.remove(file_name)
+            activate_index_version(versions, destination, args)
 
     return True
 
@@ -168,115 +391,627 @@ def edit_code_files(args):
     Modify this method as needed to do whatever file editing needs to be done.
     """
     config = FN.code_config(args.code)
-    files = glob.glob(section_file_name(config['code_name'], '*'))
-    prog_total = len(files)
+    store = open_store(config['code_name'], args.section_store)
+    chapters = store.chapters()
+    prog_total = len(chapters)
     prog_current = 0
-    for file in files:
+    for chapter in chapters:
         prog_current += 1
         if args.progress:
             progress_bar(prog_total, prog_current)
         try:
-            with open(file, 'r') as fp:
-                sections = json.load(fp)
+            sections = store.read(chapter)
         except Exception as e:
-            print(f'\n Error reading {file}: {str(e)}')
+            print(f'\n Error reading chapter {chapter}: {str(e)}')
             break
         for section in sections:
             section['code'] = config['code_name']
         try:
-            with open(file, 'w') as fp:
-                json.dump(sections, fp, indent=4)
+            store.write(chapter, sections)
         except Exception as e:
-            print(f'\nError writing {file}: {str(e)}')
+            print(f'\nError writing chapter {chapter}: {str(e)}')
             break
+    store.save()
 
     print('\n')
 
 
-def create_index(args):
+def convert_sections(args):
+    """
+    Copy a code's sections from the other section store into the one
+    selected by --section_store, e.g. from per-chapter files into JSONL.
+    """
+    config = FN.code_config(args.code)
+    source_store = next(store for store in STORES if store != args.section_store)
+    source = open_store(config['code_name'], source_store)
+    target = open_store(config['code_name'], args.section_store)
+    count = 0
+    for chapter, sections in source.items():
+        target.write(chapter, sections)
+        count += 1
+    target.save()
+    print(f"{config['code_name']}: {count} chapters copied from {source_store} store to {args.section_store} store")
+
+
+def create_index(args, index_path: str = None):
+    from whoosh.index import create_in
     schema = FN.schema()
+    index_path = index_path or INDEX_PATH
 
-    if not os.path.exists(INDEX_PATH):
-        os.mkdir(INDEX_PATH)
+    if not os.path.exists(index_path):
+        os.mkdir(index_path)
     ix_name = FN.index_name(args)
-    create_in(INDEX_PATH, schema, indexname=ix_name)
-    print(f"Index '{ix_name}' created at this path: {INDEX_PATH}")
+    create_in(index_path, schema, indexname=ix_name)
+    if not getattr(args, 'quiet', False):
+        print(f"Index '{ix_name}' created at this path: {index_path}")
 
 
 def delete_code(args):
+    from whoosh.qparser import QueryParser
+    from whoosh.writing import CLEAR
     config = FN.code_config(args.code)
     index = FN.open_index(args)
-    parser = QueryParser('code', FN.schema())
-    query = parser.parse(config['code_name'])
-    index.delete_by_query(query)
+    if FN.INDEX_LAYOUT == 'sharded':
+        # The code has an index to itself, so drop all of its segments.
+        index.writer().commit(mergetype=CLEAR)
+    else:
+        parser = QueryParser('code', index.schema)
+        query = parser.parse(config['code_name'])
+        index.delete_by_query(query)
     index.close()
 
+    hashes = SectionHashes(INDEX_PATH, FN.index_name(args))
+    hashes.remove_code(config['code_name'])
+    hashes.save()
+    remove_citations(config['code_name'])
+    remove_references(config['code_name'])
+    remove_section_text(config['code_name'])
+    remove_completions(config['code_name'])
+    remove_spelling(config['code_name'])
+
+
+def migrate_index(args):
+    """
+    Rebuild an index that was created with an older schema so that it uses
+    the field types in FN.schema(). Older indexes stored every field, so the
+    new index is built from their stored fields without re-reading any
+    chapter files. The old index files are kept in {INDEX_PATH}.bak.
+
+    The side tables of every code in the index are built at the same time,
+    since the text that newer indexes keep in them (see build_code_tables())
+    was stored in the old index and goes away with it.
+
+    With a sharded layout and no --code, every code's index is migrated.
+
+    Prints the size and query latency of the index before and after.
+    """
+    if FN.INDEX_LAYOUT == 'sharded' and not args.code:
+        ix_names = FN.shard_names()
+    else:
+        ix_names = [FN.index_name(args)]
+    code_sections = {}
+    for ix_name in ix_names:
+        code_sections.update(migrate_one_index(ix_name, args))
+
+    # Completions last: their scores come from every code's reference table.
+    for code_name, sections in code_sections.items():
+        build_code_tables(code_name, lambda: [sections], completions=False)
+    for code_name, sections in code_sections.items():
+        with METRICS.timer('index.complete'):
+            build_completions(code_name, [sections])
+
+
+def migrate_one_index(ix_name: str, args) -> dict:
+    """
+    Returns:
+        (dict): The migrated sections of each code, for its side tables.
+    """
+    from whoosh.index import create_in, open_dir
+    from util.indexstats import index_size, query_latency
+    old_index = open_dir(INDEX_PATH, ix_name)
+    if FN.schema_is_current(old_index):
+        print(f"Index '{ix_name}' already uses the current schema.")
+        old_index.close()
+        return {}
+
+    before = {'bytes': index_size(INDEX_PATH, ix_name), **query_latency(old_index)}
 
-def index_content(args):
+    temp_path = f'{INDEX_PATH}.migrate'
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    new_index = create_in(temp_path, FN.schema(), indexname=ix_name)
+    writer = open_writer(new_index, args)
+    stored_sections = {}
+    code_sections = {}
+    try:
+        with old_index.reader() as reader:
+            for stored_fields in reader.all_stored_fields():
+                # Older indexes hold a record, under "{code}:None", for each empty chapter.
+                if not stored_fields.get('section_number'):
+                    continue
+                fields = migrated_fields(stored_fields, new_index.schema)
+                section = migrated_section(fields, stored_fields, stored_sections, args)
+                fields['text'] = section.get('text')
+                writer.add_document(**fields)
+                code_sections.setdefault(fields['code'], []).append(section)
+    except BaseException:
+        writer.cancel()
+        raise
+    writer.commit()
+    new_index.optimize()
+
+    after = {'bytes': index_size(temp_path, ix_name), **query_latency(new_index)}
+    old_index.close()
+    new_index.close()
+
+    # Swap the new index into place, keeping the old one just in case.
+    backup_path = f'{INDEX_PATH}.bak'
+    os.makedirs(backup_path, exist_ok=True)
+    for file in FN.index_files(INDEX_PATH, ix_name):
+        shutil.move(file, os.path.join(backup_path, os.path.basename(file)))
+    for file in FN.index_files(temp_path, ix_name):
+        shutil.move(file, os.path.join(INDEX_PATH, os.path.basename(file)))
+    shutil.rmtree(temp_path, ignore_errors=True)
+
+    print(f"Index '{ix_name}' migrated. Old index files saved in {backup_path}")
+    print(f"{'':>10} {'bytes':>14} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for label, stats in (('before', before), ('after', after)):
+        print(
+            f"{label:>10} {stats['bytes']:14,d} {stats['mean_ms']:9.2f} {stats['p50_ms']:9.2f} "
+            f"{stats['p95_ms']:9.2f} {stats['p99_ms']:9.2f}"
+        )
+    return code_sections
+
+
+def migrated_fields(stored_fields: dict, schema) -> dict:
+    """
+    Convert the stored fields of a document in an old index to the fields
+    we index today.
+    """
+    fields = {name: value for name, value in stored_fields.items() if name in schema}
+    code = (stored_fields.get('code') or '').upper()
+    fields['code'] = code
+    if not fields.get('doc_id'):
+        fields['doc_id'] = FN.doc_id(code, stored_fields.get('section_number'))
+    return fields
+
+
+def migrated_section(fields: dict, stored_fields: dict, stored_sections: dict, args) -> dict:
+    """
+    The section a document in an old index was made from, to index its text
+    and build the side tables from: the one in the section store if it is
+    there, or else the old document's stored fields. Indexes that stored only
+    source_text have that indexed as the text.
+
+    Args:
+        fields (dict): The document's migrated fields, from migrated_fields().
+        stored_fields (dict): Stored fields of the old document.
+        stored_sections (dict): Sections of each code's section store by doc_id,
+                                filled in the first time a code is seen.
+        args (argparse): Argparse arguments.
+    Returns:
+        (dict): Section record.
+    """
+    code_name = fields['code']
+    if code_name not in stored_sections:
+        store = open_store(code_name, args.section_store)
+        stored_sections[code_name] = {
+            FN.doc_id(code_name, section['section_number']): section
+            for _, chapter in store.items() for section in chapter or [] if section.get('section_number')
+        }
+    section = stored_sections[code_name].get(fields['doc_id'])
+    if section is None:
+        section = dict(stored_fields)
+        section['text'] = stored_fields.get('text') or stored_fields.get('source_text')
+    return section
+
+
+def index_content(args, index_path: str = None, completions: bool = True):
+    """
+    Index every section of a code, or of one chapter with --chapter, and
+    rebuild the code's side tables.
+
+    Args:
+        args (argparse): Argparse arguments.
+        index_path (str): Directory of the index and tables. Defaults to INDEX_PATH.
+        completions (bool): Whether to build the completion table too. See build_code_tables().
+    """
     config = FN.code_config(args.code)
-    ix_name = FN.index_name(None)
+    ix_name = FN.index_name(args)
+    index_path = index_path or INDEX_PATH
 
     # Create index if it does not already exist.
-    if not FN.index_exists(args):
-        create_index(args)
+    if not FN.index_exists(args, index_path):
+        create_index(args, index_path)
 
     # Open our index
-    index = FN.open_index(args)
+    index = FN.open_index(args, index_path)
+    FN.upgrade_schema(index)
+    if not FN.schema_is_current(index) and not args.quiet:
+        print(f"Warning: index '{ix_name}' was built with an older schema and new sections get its old field "
+              "types (e.g. no character offsets for snippets). Run --migrate_index to bring it up to date.")
+
+    if args.incremental:
+        return index_changes(args, config, index, index_path)
+
+    hashes = SectionHashes(index_path, ix_name)
+    # A full build replaces everything the index had for this code.
+    code_hashes = hashes.for_code(config['code_name']) if args.chapter else {}
 
     # Process every section in this codified law
+    store = open_store(config['code_name'], args.section_store)
     if not args.chapter:
-        files = glob.glob(section_file_name(config['code_name'], '*'))
+        prog_total = len(store.chapters())
+        chapters = store.items()
     else:
-        files = [section_file_name(config['code_name'], args.chapter)]
+        prog_total = 1
+        chapters = [(args.chapter, store.read(args.chapter))]
 
-    prog_total = len(files)
+    # Stream every section of the code through one writer. Committing once
+    # (or every --commit_every chapters) leaves a handful of segments instead
+    # of a few per chapter and starts the writer's worker processes only once.
     prog_current = 0
-    for file in files:
-        # Open next chapter in the codified law
-        with open(file, 'r') as chapter_file:
-            chapter = json.load(chapter_file)
-
-        # If we don't have any sections in that chapter, there was probably a
-        # snafu upstream, but there's nothing we can do about it now. skip it.
-        if not chapter:
-            continue
-
-        # We have a chapter with sections . . . process them
-        if not args.quiet and not args.progress:
-            print('-' * 80)
-            print(chapter[0]['chapter'], "- indexing")
-        with index.writer(limitmb=256, procs=3, multisegment=True) as writer:
+    since_commit = 0
+    writer = open_writer(index, args)
+    # A full build replaces the code. With the sharded layout the code has an
+    # index to itself, so the first commit drops every old segment outright.
+    clear = not args.chapter and FN.INDEX_LAYOUT == 'sharded'
+    if not args.chapter and not clear:
+        from whoosh.qparser import QueryParser
+        writer.delete_by_query(QueryParser('code', index.schema).parse(config['code_name']))
+    try:
+        for _, chapter in chapters:
+            # If we don't have any sections in that chapter, there was probably a
+            # snafu upstream, but there's nothing we can do about it now. skip it.
+            if not chapter:
+                continue
+
+            # We have a chapter with sections . . . process them
+            if not args.quiet and not args.progress:
+                print('-' * 80)
+                print(chapter[0]['chapter'], "- indexing")
             for section in chapter:
                 section_number = section.get('section_number')
                 section_name = section.get('section_name')
                 chapter_name = section.get('chapter')
+                # A chapter with no sections is saved as one empty record. It has
+                # nothing to search and no doc_id of its own, so, as in
+                # index_changes(), it is not indexed.
+                if not section_number:
+                    continue
                 if not args.quiet and not args.progress:
                     print(f"Indexing {section_number} - {section_name}", end='')
-                writer.add_document(
-                    code_name=section.get('code_name'),
-                    title=section.get('title'),
-                    subtitle=section.get('subtitle'),
-                    chapter=chapter_name,
-                    subchapter=section.get('subchapter'),
-                    section_prefix=section.get('section_prefix', 'Sec.'),
-                    section_number=section_number,
-                    section_name=section_name,
-                    text=section.get('text'),
-                    source_text=section.get('source_text'),
-                    code=section.get('code'),
-                    filename=section.get('filename')
-                )
+                if args.chapter:
+                    # The rest of the code stays, so replace this chapter's sections in place.
+                    writer.update_document(**FN.document_fields(section, config['code_name']))
+                else:
+                    writer.add_document(**FN.document_fields(section, config['code_name']))
+                METRICS.count('documents_indexed')
+                code_hashes[FN.doc_id(config['code_name'], section_number)] = SectionHashes.hash(section)
                 if not args.quiet and not args.progress:
                     print(" - added")
-        if not args.quiet and not args.progress:
-            print(f"{chapter_name} - committed to index {ix_name}")
+
+            since_commit += 1
+            if args.commit_every and since_commit >= args.commit_every:
+                with METRICS.timer('index.commit'):
+                    commit(writer, clear)
+                clear = False
+                writer = open_writer(index, args)
+                since_commit = 0
+                if not args.quiet and not args.progress:
+                    print(f"{chapter_name} - committed to index {ix_name}")
+            if args.progress:
+                prog_current += 1
+                progress_bar(prog_total, prog_current)
+    except BaseException:
+        writer.cancel()
+        raise
+    with METRICS.timer('index.commit'):
+        commit(writer, clear)
+    if args.progress:
+        # Finish the progress bar's line.
+        print('')
+
+    if args.optimize:
+        if not args.quiet:
+            print(f"Merging segments of index {ix_name}")
+        with METRICS.timer('index.optimize'):
+            index.optimize()
+
+    hashes.set_code(config['code_name'], code_hashes)
+    hashes.save()
+    build_code_tables(config['code_name'], lambda: (sections for _, sections in store.items()), index_path, completions)
+
+
+def build_code_tables(code_name: str, chapters, index_path: str = None, completions: bool = True):
+    """
+    Rebuild every side table of one code from its sections: citations,
+    references, section text, completions and spelling. Full and incremental
+    indexing and --migrate_index all end here.
+
+    The completion table scores each section by the reference tables of
+    every code, so a build that cannot see the other codes' tables yet
+    passes completions=False and calls build_completions() once they are
+    in place.
+
+    Args:
+        code_name (str): Code abbreviation from the code's config file.
+        chapters (callable): Returns the list of sections of every chapter of
+                             the code. Called once for each table.
+        index_path (str): Directory for the tables. Defaults to INDEX_PATH.
+        completions (bool): Whether to build the completion table too.
+    """
+    with METRICS.timer('index.citations'):
+        build_citations(code_name, chapters(), index_path)
+    with METRICS.timer('index.references'):
+        build_references(code_name, chapters(), index_path)
+    with METRICS.timer('index.text'):
+        build_section_text(code_name, chapters(), index_path)
+    if completions:
+        with METRICS.timer('index.complete'):
+            build_completions(code_name, chapters(), index_path)
+    with METRICS.timer('index.spelling'):
+        build_spelling(code_name, chapters(), index_path)
+
+
+def commit(writer, clear: bool = False):
+    """
+    Commit a writer, dropping every segment the index had before if clear is True.
+    """
+    if clear:
+        from whoosh.writing import CLEAR
+        writer.commit(mergetype=CLEAR)
+    else:
+        writer.commit()
+
+
+def open_writer(index, args):
+    """
+    Open a writer using the memory and process limits from the command line.
+    """
+    return index.writer(limitmb=args.index_mb, procs=args.index_procs, multisegment=args.index_procs > 1)
+
+
+def index_changes(args, config: dict, index, index_path: str = None):
+    """
+    Bring a code's sections in the index up to date by applying only what
+    changed since the last time it was indexed: new sections are added,
+    changed sections are replaced, and sections that no longer exist are
+    deleted. Changes are found by comparing each section's hash against
+    the sidecar manifest written when it was last indexed.
+
+    Args:
+        args (argparse): Argparse arguments.
+        config (dict): Code configuration.
+        index (whoosh.index): Open index.
+        index_path (str): Directory of the index and tables. Defaults to INDEX_PATH.
+    """
+    from whoosh.qparser import QueryParser
+    code_name = config['code_name']
+    ix_name = FN.index_name(args)
+    hashes = SectionHashes(index_path or INDEX_PATH, ix_name)
+
+    # Without a manifest we cannot tell which indexed sections belong to
+    # which doc_id, so clear this code out and index all of it once.
+    rebuild = not hashes.has_code(code_name)
+    known = {} if rebuild else hashes.for_code(code_name)
+
+    store = open_store(code_name, args.section_store)
+    if not args.chapter:
+        chapters = store.items()
+    else:
+        chapters = [(args.chapter, store.read(args.chapter))]
+
+    current = dict(known) if args.chapter else {}
+    changed = {}
+    for _, chapter in chapters:
+        for section in chapter or []:
+            if not section.get('section_number'):
+                continue
+            section_id = FN.doc_id(code_name, section['section_number'])
+            section_hash = SectionHashes.hash(section)
+            current[section_id] = section_hash
+            if known.get(section_id) != section_hash:
+                changed[section_id] = section
+            else:
+                changed.pop(section_id, None)
+
+    # A single chapter cannot tell us what was deleted from the rest of the code.
+    deleted = [] if args.chapter else [section_id for section_id in known if section_id not in current]
+
+    # Even an empty commit writes a new generation of the index.
+    if rebuild or changed or deleted:
+        with index.writer(limitmb=args.index_mb) as writer:
+            if rebuild:
+                writer.delete_by_query(QueryParser('code', index.schema).parse(code_name))
+            for section_id, section in changed.items():
+                writer.update_document(**FN.document_fields(section, code_name))
+            for section_id in deleted:
+                writer.delete_by_term('doc_id', section_id)
+    METRICS.count('documents_indexed', len(changed))
+    METRICS.count('documents_deleted', len(deleted))
+
+    if rebuild or changed or deleted:
+        hashes.set_code(code_name, current)
+        hashes.save()
+    # The tables are built again even when no section changed, since the
+    # completion scores depend on the other codes' references. A table that
+    # comes out the same is not written (see mmaptable.write_table()).
+    build_code_tables(code_name, lambda: (sections for _, sections in store.items()), index_path)
+
+    if not args.quiet:
+        updated = sum(1 for section_id in changed if section_id in known)
+        print(f"{code_name}: {len(changed) - updated} added, {updated} updated, {len(deleted)} deleted in index {ix_name}")
+
+
+def build_all_codes(args):
+    """
+    Run --get and/or --index for every code that has a config file, --jobs
+    codes at a time, each in a worker process of its own.
+
+    Indexing starts from scratch: each worker indexes its code into an
+    index of its own under {INDEX_PATH}.build, so no code waits for
+    another's writer lock, and merge_built_codes() then moves them all into
+    the real index. With --incremental there is little to do per code, so
+    the codes are brought up to date in place, one after another, once the
+    fetching is done.
+
+    A code that fails keeps whatever it had in the index before.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    codes = FN.configured_codes()
+    if args.codes:
+        wanted = [code.strip().lower() for code in args.codes.split(',') if code.strip()]
+        unknown = [code for code in wanted if code not in codes]
+        if unknown:
+            print(f"No config file for: {', '.join(unknown)}")
+        codes = [code for code in codes if code in wanted]
+    jobs = max(1, min(args.jobs or os.cpu_count() or 1, len(codes)))
+    build_path = f'{INDEX_PATH}.build' if args.index and not args.incremental else None
+    if build_path:
+        shutil.rmtree(build_path, ignore_errors=True)
+        os.makedirs(build_path)
+
+    # --rate_limit is for the whole run, not for each worker.
+    worker_args = argparse.Namespace(**dict(vars(args), rate_limit=args.rate_limit / jobs if args.rate_limit else None))
+    built = []
+    if args.get or build_path:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(build_code, code, worker_args, build_path): code for code in codes}
+            for future in as_completed(futures):
+                code = futures[future]
+                try:
+                    METRICS.merge(future.result())
+                    built.append(code)
+                except Exception as e:
+                    print(f"{code.upper()} - failed: {str(e)}")
+                    continue
+                if args.progress:
+                    progress_bar(len(codes), len(built))
+                elif not args.quiet:
+                    print(f"{code.upper()} - done ({len(built)} of {len(codes)})")
         if args.progress:
-            prog_current += 1
-            progress_bar(prog_total, prog_current)
-    print('')
+            print('')
 
+    if build_path:
+        with METRICS.timer('index.merge'):
+            merge_built_codes(sorted(built), build_path, args)
+        shutil.rmtree(build_path, ignore_errors=True)
+    elif args.index:
+        for code in codes:
+            index_content(argparse.Namespace(**dict(vars(args), code=code, chapter=None)))
 
-if __name__ == '__main__':
+
+def build_code(code: str, args, build_path: str = None) -> dict:
+    """
+    Worker for build_all_codes(): fetch one code if --get was given and, if
+    build_path is given, index it into {build_path}/{code}.
+
+    The completion table is left for merge_built_codes() to build, since
+    its scores come from the reference tables of every code.
+
+    Returns:
+        (dict): This worker's metrics, for the parent to add to its own.
+    """
+    METRICS.reset()
+    # The parallelism is across codes; one process per code is plenty.
+    code_args = argparse.Namespace(**dict(
+        vars(args), code=code, chapter=None, quiet=True, progress=False, workers=1, index_procs=1,
+        incremental=False, optimize=False
+    ))
+    if args.get:
+        main(code_args)
+    if build_path:
+        index_content(code_args, os.path.join(build_path, code), completions=False)
+    return METRICS.report()
+
+
+def merge_built_codes(codes: list, build_path: str, args):
+    """
+    Move the indexes that build_code() made into the real index, with their
+    section hashes and side tables, then build each code's completion table
+    now that every code's reference table is in place.
+
+    With the single layout, one writer deletes every built code's old
+    sections, copies in the new ones with add_reader() and commits once, so
+    a searcher sees either the old index or the new one. If every code in
+    the index was rebuilt, the commit drops the old segments outright rather
+    than leaving deleted sections in them to skew scores until the next
+    merge. With the sharded layout, each code's shard is replaced the same way.
+    """
+    from whoosh.index import open_dir
+    from whoosh.qparser import QueryParser
+    from whoosh.writing import CLEAR
+
+    if not codes:
+        return
+    indexes = {}
+    writers = {}
+    indexed_codes = {}
+    for code in codes:
+        config = FN.code_config(code)
+        ix_name = FN.index_name(code)
+        if ix_name not in indexes:
+            if not FN.index_exists(code):
+                create_index(code)
+            indexes[ix_name] = FN.open_index(code)
+            with indexes[ix_name].reader() as reader:
+                indexed_codes[ix_name] = set(reader.field_terms('code'))
+            writers[ix_name] = indexes[ix_name].writer(limitmb=args.index_mb)
+        writer = writers[ix_name]
+        writer.delete_by_query(QueryParser('code', indexes[ix_name].schema).parse(config['code_name']))
+        indexed_codes[ix_name].discard(config['code_name'])
+        built_index = open_dir(os.path.join(build_path, code), ix_name)
+        with built_index.reader() as reader:
+            writer.add_reader(reader)
+            METRICS.count('documents_merged', reader.doc_count())
+        built_index.close()
+
+    try:
+        # Tables go in before the index commits, so a failure here leaves the old index in place.
+        for code in codes:
+            code_name = FN.code_config(code)['code_name']
+            for table_path in (citation_path, references_path, section_text_path, spelling_path):
+                built_table = table_path(code_name, os.path.join(build_path, code))
+                if not os.path.exists(f'{built_table}.idx'):
+                    # Nothing was built, so nothing of the old table should outlive the merge either.
+                    remove_table(table_path(code_name))
+                    continue
+                # The data file first: a reader only looks at it through the index file.
+                for extension in ('.dat', '.idx'):
+                    os.replace(built_table + extension, table_path(code_name) + extension)
+    except BaseException:
+        for writer in writers.values():
+            writer.cancel()
+        raise
+
+    for ix_name, writer in writers.items():
+        if indexed_codes[ix_name]:
+            writer.commit()
+        else:
+            writer.commit(mergetype=CLEAR)
+        if args.optimize:
+            indexes[ix_name].optimize()
+        indexes[ix_name].close()
+
+    for code in codes:
+        code_name = FN.code_config(code)['code_name']
+        ix_name = FN.index_name(code)
+        built_hashes = SectionHashes(os.path.join(build_path, code), ix_name)
+        hashes = SectionHashes(INDEX_PATH, ix_name)
+        hashes.set_code(code_name, built_hashes.for_code(code_name))
+        hashes.save()
+    for code in codes:
+        code_name = FN.code_config(code)['code_name']
+        store = open_store(code_name, args.section_store)
+        with METRICS.timer('index.complete'):
+            build_completions(code_name, (sections for _, sections in store.items()))
+    if not args.quiet:
+        print(f"Merged {len(codes)} codes into {INDEX_PATH}")
+
+
+def argument_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description='Encode Texas Codified Laws')
     parser.add_argument(
         '--code',
@@ -296,6 +1031,102 @@ if __name__ == '__main__':
         const=True,
         default=False
     )
+    parser.add_argument(
+        '--all_codes',
+        required=False,
+        help="Run --get and --index for every code in CODE_PATH, several codes at a time.",
+        action='store_const',
+        const=True,
+        default=False
+    )
+    parser.add_argument(
+        '--codes',
+        required=False,
+        help="Comma-separated codes for --all_codes to work on, e.g. ag,al,fa. Defaults to every code in CODE_PATH.",
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        '--jobs',
+        required=False,
+        help="Number of codes to work on at once with --all_codes. Defaults to the number of CPUs.",
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        '--workers',
+        required=False,
+        help="Number of processes to use for extracting, classifying and saving chapters when using --get.",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--extractor',
+        required=False,
+        help="How to convert HTML to text: 'html2text' (Markdown, the default) or 'fast' (plain lines).",
+        choices=EXTRACTORS,
+        default='html2text'
+    )
+    parser.add_argument(
+        '--section_store',
+        required=False,
+        help="Where to keep classified sections: 'files' (one JSON file per chapter) or 'jsonl' (one file per code).",
+        choices=STORES,
+        default=FN.SECTION_STORE
+    )
+    parser.add_argument(
+        '--convert_sections',
+        required=False,
+        help="Indicates whether to copy a code's sections from the other section store into --section_store.",
+        action='store_const',
+        const=True,
+        default=False
+    )
+    parser.add_argument(
+        '--queue_size',
+        required=False,
+        help="Number of chapters allowed to wait between each stage of --get.",
+        type=int,
+        default=2
+    )
+    parser.add_argument(
+        '--fetch_workers',
+        required=False,
+        help="Number of chapters to retrieve concurrently when using --get.",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--rate_limit',
+        required=False,
+        help="Maximum number of requests per second to send to the statutes server.",
+        type=float,
+        default=None
+    )
+    parser.add_argument(
+        '--no_cache',
+        required=False,
+        help="Indicates whether to bypass the on-disk cache of retrieved chapters.",
+        action='store_const',
+        const=True,
+        default=False
+    )
+    parser.add_argument(
+        '--offline',
+        required=False,
+        help="Indicates whether to serve chapters only from the on-disk cache, without going to the network.",
+        action='store_const',
+        const=True,
+        default=False
+    )
+    parser.add_argument(
+        '--discover',
+        required=False,
+        help="Indicates whether to probe every chapter number instead of only the chapters found on the last run.",
+        action='store_const',
+        const=True,
+        default=False
+    )
     parser.add_argument(
         '--index',
         required=False,
@@ -304,6 +1135,51 @@ if __name__ == '__main__':
         const=True,
         default=False
     )
+    parser.add_argument(
+        '--index_mb',
+        required=False,
+        help="Megabytes of memory each indexing process may use before flushing to disk.",
+        type=int,
+        default=256
+    )
+    parser.add_argument(
+        '--index_procs',
+        required=False,
+        help="Number of processes the index writer may use.",
+        type=int,
+        default=3
+    )
+    parser.add_argument(
+        '--commit_every',
+        required=False,
+        help="Commit the index after this many chapters. By default, commit once after the whole code.",
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        '--optimize',
+        required=False,
+        help="Merge the index into a single segment after indexing.",
+        action='store_const',
+        const=True,
+        default=False
+    )
+    parser.add_argument(
+        '--migrate_index',
+        required=False,
+        help="Rebuild an index created with an older schema using the current one, and report the difference.",
+        action='store_const',
+        const=True,
+        default=False
+    )
+    parser.add_argument(
+        '--incremental',
+        required=False,
+        help="With --index, only add, update and delete the sections that changed since the code was last indexed.",
+        action='store_const',
+        const=True,
+        default=False
+    )
     parser.add_argument(
         '--edit',
         required=False,
@@ -344,6 +1220,36 @@ if __name__ == '__main__':
         const=True,
         default=False
     )
+    parser.add_argument(
+        '--upload_sections',
+        required=False,
+        help="Indicates whether to upload the sections of a code.",
+        action='store_const',
+        const=True,
+        default=False
+    )
+    parser.add_argument(
+        '--sync',
+        required=False,
+        help="Indicates whether uploads and downloads send only changed files instead of whole zip archives.",
+        action='store_const',
+        const=True,
+        default=False
+    )
+    parser.add_argument(
+        '--sync_workers',
+        required=False,
+        help="Number of files, or parts of a large file, transferred at once with --sync.",
+        type=int,
+        default=8
+    )
+    parser.add_argument(
+        '--keep_versions',
+        required=False,
+        help="Number of downloaded index versions to keep in INDEX_PATH.versions.",
+        type=int,
+        default=3
+    )
     parser.add_argument(
         '--download_index',
         required=False,
@@ -360,6 +1266,14 @@ if __name__ == '__main__':
         const=True,
         default=False
     )
+    parser.add_argument(
+        '--download_sections',
+        required=False,
+        help="Indicates whether to download the sections of a code.",
+        action='store_const',
+        const=True,
+        default=False
+    )
     parser.add_argument(
         '--delete',
         required=False,
@@ -368,23 +1282,68 @@ if __name__ == '__main__':
         const=True,
         default=False
     )
+    parser.add_argument(
+        '--metrics',
+        required=False,
+        help="File to write timings and counts to when done: Prometheus text format if it ends in .prom, else JSON."
+    )
+    parser.add_argument(
+        '--profile',
+        required=False,
+        help="File to write a cProfile profile of the run to."
+    )
+    parser.add_argument(
+        '--tracemalloc',
+        required=False,
+        help="Indicates whether to trace memory allocations and add the peak to the --metrics report.",
+        action='store_const',
+        const=True,
+        default=False
+    )
+    return parser
 
-    args = parser.parse_args()
 
-    if args.download_config or args.download_index:
-        download(args)
+if __name__ == '__main__':
+    args = argument_parser().parse_args()
 
-    if args.delete:
-        delete_code(args)
+    # Write the metrics even if the run fails: where it got to is the interesting part.
+    try:
+        with capture(args.profile, args.tracemalloc):
+            if args.download_config or args.download_index or args.download_sections:
+                with METRICS.timer('download'):
+                    download(args)
 
-    if args.get:
-        main(args)
+            if args.migrate_index:
+                with METRICS.timer('migrate'):
+                    migrate_index(args)
+
+            if args.delete:
+                with METRICS.timer('delete'):
+                    delete_code(args)
+
+            if args.convert_sections:
+                with METRICS.timer('convert_sections'):
+                    convert_sections(args)
+
+            if args.all_codes and (args.get or args.index):
+                with METRICS.timer('all_codes'):
+                    build_all_codes(args)
+
+            if args.get and not args.all_codes:
+                with METRICS.timer('get'):
+                    main(args)
 
-    if args.edit:
-        edit_code_files(args)
+            if args.edit:
+                with METRICS.timer('edit'):
+                    edit_code_files(args)
 
-    if args.index:
-        index_content(args)
+            if args.index and not args.all_codes:
+                with METRICS.timer('index'):
+                    index_content(args)
 
-    if args.upload_index or args.upload_config:
-        upload(args)
+            if args.upload_index or args.upload_config or args.upload_sections:
+                with METRICS.timer('upload'):
+                    upload(args)
+    finally:
+        if args.metrics:
+            METRICS.write(args.metrics)
@@ -0,0 +1,116 @@
+"""
+standin.py - Local stand-in for statutes.capitol.texas.gov that serves the fixture corpus.
+
+    GET /Docs/FA/htm/FA.6.htm  ->  bench/fixtures/FA/FA.6.htm
+
+Each page is sent with an ETag, and a request whose If-None-Match matches
+it is answered 304 Not Modified, as the real server does.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import re
+import threading
+import time
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+CHAPTER_URL = re.compile(r'^/Docs/([A-Z0-9]+)/htm/\1\.([0-9A-Za-z\.]+)\.htm$')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real server, so a Retriever's connection pool is exercised.
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        match = CHAPTER_URL.match(self.path)
+        file_name = None
+        if match:
+            code, chapter = match.groups()
+            file_name = os.path.join(self.server.fixtures_path, code, f'{code}.{chapter}.htm')
+        if not file_name or not os.path.isfile(file_name):
+            return self.send_body(404, b'<html><body>Not Found</body></html>')
+        with open(file_name, 'rb') as html_file:
+            body = html_file.read()
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            return self.send_body(304, b'', etag)
+        self.send_body(200, body, etag)
+
+    def send_body(self, status: int, body: bytes, etag: str = None):
+        self.server.requests.append((time.monotonic(), self.path, status))
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandIn(object):
+    """
+    Serves the fixture corpus on a free local port from a background thread.
+
+        with StandIn() as standin:
+            retriever = Retriever(standin.url, 'FA')
+
+    Args:
+        fixtures_path (str): Folder holding one folder of chapter HTML per code.
+        latency (float): Seconds to wait before answering each request, to imitate the network.
+    """
+    def __init__(self, fixtures_path: str = None, latency: float = 0.0):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.daemon_threads = True
+        self.server.fixtures_path = fixtures_path or FIXTURES_PATH
+        self.server.latency = latency
+        # (time, path, status) of every request answered, in order.
+        self.server.requests = []
+        self.thread = None
+
+    @property
+    def requests(self) -> list:
+        return self.server.requests
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def chapters(self) -> dict:
+        """
+        Returns:
+            (dict): Code abbreviation -> list of chapter numbers in the corpus.
+        """
+        corpus = {}
+        for code in sorted(os.listdir(self.server.fixtures_path)):
+            code_path = os.path.join(self.server.fixtures_path, code)
+            if not os.path.isdir(code_path):
+                continue
+            corpus[code] = sorted(
+                (name[len(code) + 1:-len('.htm')] for name in os.listdir(code_path) if name.endswith('.htm')),
+                key=lambda chapter: (len(chapter), chapter)
+            )
+        return corpus
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,412 @@
+"""
+benchmark.py - Time each stage of turning statute HTML into search results.
+
+Serves the fixture corpus in bench/fixtures from a local stand-in for the
+State's web server and runs it through every stage the app does:
+
+    fetch      Retriever.retrieve, one chapter at a time
+    extract    HtmlToText.get_text, once per extractor
+    classify   converter.classify_text: Classifier.classify_doc plus finding references
+    index      index_content for every code, into an empty index
+    search     A fixed query set through SearchService, uncached and cached
+    snippets   The same queries with snippets, from stored offsets and by re-tokenizing
+    citation   Citation lookups through SearchService
+    references SearchService.cites and cited_by for the same sections
+    spelling   Misspelled queries, corrected by util/spelling.py and by the fuzzy terms it replaced
+    complete   SearchService.complete for the first 1, 3 and 6 characters of each section name and number
+    engine     The same query set straight against the index (indexstats.query_latency)
+    startup    Wall time of a fresh `python app.py` process for each subcommand
+
+For each stage it reports throughput, per-call latency percentiles and the
+peak memory Python allocated during one extra, traced pass. Results are
+written as JSON so that two commits can be compared:
+
+    python benchmark.py --output before.json
+    (change something)
+    python benchmark.py --output after.json --compare before.json
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+import tracemalloc
+
+from whoosh.qparser import FuzzyTermPlugin, MultifieldParser
+
+# Everything the app writes while we measure it goes into a scratch folder.
+# util.functions reads these when it is imported, so set them first.
+WORK_PATH = tempfile.mkdtemp(prefix='code2json-bench-')
+for variable, folder in (('INDEX_PATH', 'index'), ('CODE_PATH', 'codes'), ('CACHE_PATH', 'cache')):
+    os.environ[variable] = os.path.join(WORK_PATH, folder)
+
+import app as APP  # noqa: E402
+from bench.standin import StandIn  # noqa: E402
+from util.chapterstore import open_store  # noqa: E402
+from util.converter import classify_text  # noqa: E402
+from util.htmltotext import EXTRACTORS, HtmlToText  # noqa: E402
+from util.indexstats import QUERIES, TYPO_QUERIES, latency_summary, query_latency  # noqa: E402
+from util.retriever import Retriever  # noqa: E402
+from util.searchservice import SEARCH_FIELDS, SearchService  # noqa: E402
+from util.snippets import make_highlighter  # noqa: E402
+import util.functions as FN  # noqa: E402
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'codes')
+
+# Subcommands whose start-up we time, each with arguments that make it do
+# as little work as possible on the fixture corpus. The S3 commands are left
+# out: they cannot finish without talking to S3.
+STARTUP_COMMANDS = {
+    'none': [],
+    'get': ['--code', 'FA', '--get', '--offline', '--chapter', '1', '--quiet'],
+    'edit': ['--code', 'FA', '--edit', '--quiet'],
+    'index': ['--code', 'FA', '--index', '--incremental', '--quiet'],
+}
+
+
+def measure(stages: dict, name: str, items: list, function, repeat: int = 1, units: int = None,
+            unit: str = 'items', size: int = None) -> list:
+    """
+    Call function on every item, *repeat* times, timing each call. Then run
+    one more pass with tracemalloc on to find the peak memory allocated.
+
+    Args:
+        stages (dict): Results so far. This stage's results are added to it.
+        name (str): Name of the stage.
+        items (list): Arguments to call function with, one call each.
+        function (callable): The work to time.
+        repeat (int): Number of timed passes.
+        units (int): Units of work in one pass, e.g. sections. Defaults to len(items).
+        unit (str): What a unit is, for the report.
+        size (int): Bytes processed in one pass, if throughput in bytes means anything.
+    Returns:
+        (list): What function returned for each item on the last timed pass.
+    """
+    timings = []
+    start = perf_counter()
+    for _ in range(repeat):
+        outputs = []
+        for item in items:
+            call_start = perf_counter()
+            outputs.append(function(item))
+            timings.append((perf_counter() - call_start) * 1000)
+    elapsed = perf_counter() - start
+
+    tracemalloc.start()
+    for item in items:
+        function(item)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    units = len(items) if units is None else units
+    stage = latency_summary(timings)
+    stage.update({
+        'seconds': elapsed,
+        'unit': unit,
+        'units': units * repeat,
+        'per_second': units * repeat / elapsed if elapsed else 0.0,
+        'peak_kb': peak / 1024,
+    })
+    if size is not None:
+        stage['mb_per_second'] = size * repeat / elapsed / 1e6 if elapsed else 0.0
+    stages[name] = stage
+    return outputs
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def peak_rss_kb() -> int:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def measure_startup(stages: dict, repeat: int = 1):
+    """
+    Time a fresh interpreter running app.py once per subcommand in STARTUP_COMMANDS.
+    """
+    app_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+    for name, command in STARTUP_COMMANDS.items():
+        measure(
+            stages, f'startup_{name}', [[sys.executable, app_file] + command],
+            lambda item: subprocess.run(item, cwd=WORK_PATH, capture_output=True),
+            repeat=max(repeat, 5), unit='runs'
+        )
+
+
+def measure_spelling(stages: dict, repeat: int = 1):
+    """
+    Time the misspelled queries two ways: corrected by the spelling tables,
+    and with every word made a fuzzy term (word~2) the way FuzzyTermPlugin
+    did it. For each, count how many queries find the same top hit as the
+    query that was meant.
+    """
+    service = SearchService(cache_size=0, refresh_interval=3600)
+
+    def top_hit(hits: list) -> str:
+        return hits[0]['doc_id'] if hits else None
+
+    typos = [typo for typo, _ in TYPO_QUERIES]
+    meant = [top_hit(service.search(query_text, spelling=False)) for _, query_text in TYPO_QUERIES]
+    hits = measure(stages, 'spelling_symspell', typos, service.search, repeat=repeat, unit='queries')
+    stages['spelling_symspell']['top_hit_matches'] = sum(top_hit(h) == m for h, m in zip(hits, meant))
+
+    service.parser = MultifieldParser(SEARCH_FIELDS, schema=service.parser.schema)
+    service.parser.add_plugin(FuzzyTermPlugin())
+    hits = measure(
+        stages, 'spelling_fuzzy', typos,
+        lambda typo: service.search(' '.join(f'{word}~2' for word in typo.split()), spelling=False),
+        repeat=repeat, unit='queries'
+    )
+    stages['spelling_fuzzy']['top_hit_matches'] = sum(top_hit(h) == m for h, m in zip(hits, meant))
+    service.close()
+
+
+def index_args(code: str):
+    return APP.argument_parser().parse_args(['--code', code, '--index', '--quiet'])
+
+
+def run(args) -> dict:
+    extractors = []
+    for name in EXTRACTORS:
+        try:
+            HtmlToText(name)
+            extractors.append(name)
+        except ImportError:
+            print(f"Skipping the {name} extractor: it is not installed")
+    extractor = args.extractor if args.extractor in extractors else extractors[-1]
+
+    os.makedirs(os.path.join(FN.CODE_PATH, 'sections'))
+    stages = {}
+    with StandIn(args.fixtures_path, latency=args.latency) as standin:
+        corpus = standin.chapters()
+        for code in corpus:
+            shutil.copy(os.path.join(CONFIG_PATH, f'{code.lower()}.json'), FN.CODE_PATH)
+        chapters = [(code, chapter) for code, code_chapters in corpus.items() for chapter in code_chapters]
+        retrievers = {code: Retriever(standin.url, code) for code in corpus}
+
+        print(f"fetch: {len(chapters)} chapters of {', '.join(corpus)}")
+        pages = measure(
+            stages, 'fetch', chapters, lambda item: retrievers[item[0]].retrieve(item[1], verbose=False),
+            repeat=args.repeat, unit='chapters'
+        )
+        html_bytes = sum(len(page.encode('utf-8')) for page in pages)
+        stages['fetch']['mb_per_second'] = html_bytes * args.repeat / stages['fetch']['seconds'] / 1e6
+
+    texts = None
+    for name in extractors:
+        print(f"extract: {name}")
+        htmltotext = HtmlToText(name)
+        extracted = measure(
+            stages, f'extract_{name}', pages, htmltotext.get_text,
+            repeat=args.repeat, unit='chapters', size=html_bytes
+        )
+        if name == extractor:
+            texts = extracted
+
+    print(f"classify: text from {extractor}")
+    work = [(text, code, code, chapter) for (code, chapter), text in zip(chapters, texts)]
+    classified = measure(
+        stages, 'classify', work, lambda item: classify_text(*item)[1],
+        repeat=args.repeat, unit='chapters', size=sum(len(text.encode('utf-8')) for text in texts)
+    )
+    section_count = sum(len(sections) for sections in classified)
+
+    for code in corpus:
+        store = open_store(code)
+        for (chapter_code, chapter), sections in zip(chapters, classified):
+            if chapter_code == code:
+                store.write(chapter, sections)
+        store.save()
+
+    def build_index(_):
+        shutil.rmtree(FN.INDEX_PATH, ignore_errors=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for code in corpus:
+                APP.index_content(index_args(code))
+
+    print(f"index: {section_count} sections")
+    measure(stages, 'index', [None], build_index, repeat=args.repeat, units=section_count, unit='sections')
+
+    print(f"search: {len(QUERIES)} queries")
+    service = SearchService(cache_size=0, refresh_interval=3600)
+    measure(stages, 'search', QUERIES, service.search, repeat=args.repeat, unit='queries')
+    measure(
+        stages, 'snippets', QUERIES, lambda query_text: service.search(query_text, snippets=True),
+        repeat=args.repeat, unit='queries'
+    )
+    service.highlighter = make_highlighter(always_retokenize=True)
+    measure(
+        stages, 'snippets_retokenize', QUERIES, lambda query_text: service.search(query_text, snippets=True),
+        repeat=args.repeat, unit='queries'
+    )
+    service.close()
+    service = SearchService(refresh_interval=3600)
+    for query_text in QUERIES:
+        service.search(query_text)
+    measure(stages, 'search_cached', QUERIES, service.search, repeat=args.repeat, unit='queries')
+
+    citations = [
+        f"{sections[0]['code']} {section['section_number']}"
+        for sections in classified if sections for section in sections[:3] if section.get('section_number')
+    ]
+    measure(stages, 'citation', citations, service.search, repeat=args.repeat, unit='queries')
+    sections = [
+        FN.doc_id(section['code'], section['section_number'])
+        for sections in classified for section in sections if section.get('section_number')
+    ]
+    measure(
+        stages, 'references', sections, lambda section: (service.cites(section), service.cited_by(section)),
+        repeat=args.repeat, unit='sections'
+    )
+    prefixes = [
+        text[:length]
+        for sections in classified for section in sections if section.get('section_number')
+        for text in (section.get('section_name') or '', section['section_number']) for length in (1, 3, 6)
+        if len(text) >= length
+    ]
+    measure(stages, 'complete', prefixes, service.complete, repeat=args.repeat, unit='prefixes')
+    service.close()
+
+    print(f"spelling: {len(TYPO_QUERIES)} misspelled queries")
+    measure_spelling(stages, args.repeat)
+
+    if FN.INDEX_LAYOUT != 'sharded':
+        index = FN.open_index(None)
+        stages['engine'] = query_latency(index, repeat=args.repeat)
+        engine = stages['engine']
+        engine.update({
+            'unit': 'queries', 'units': engine['count'],
+            'per_second': 1000 / engine['mean_ms'] if engine['mean_ms'] else 0.0,
+        })
+        index.close()
+
+    print(f"startup: {', '.join(STARTUP_COMMANDS)}")
+    measure_startup(stages, args.repeat)
+
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {
+            'repeat': args.repeat, 'latency': args.latency, 'extractor': extractor,
+            'index_layout': FN.INDEX_LAYOUT, 'section_store': FN.SECTION_STORE,
+        },
+        'corpus': {
+            'codes': list(corpus), 'chapters': len(chapters), 'html_bytes': html_bytes, 'sections': section_count,
+        },
+        'peak_rss_kb': peak_rss_kb(),
+        'stages': stages,
+    }
+
+
+def report(results: dict, baseline: dict = None):
+    print()
+    print(f"{'stage':>19} {'units/s':>10} {'':<9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak KB':>10}", end='')
+    print(f" {'vs baseline':>12}" if baseline else '')
+    for name, stage in results['stages'].items():
+        line = (
+            f"{name:>19} {stage['per_second']:10.1f} {stage['unit']:<9} "
+            f"{stage['p50_ms']:9.3f} {stage['p95_ms']:9.3f} {stage['p99_ms']:9.3f} {stage.get('peak_kb', 0):10.0f}"
+        )
+        old = (baseline or {}).get('stages', {}).get(name)
+        if old and old.get('p50_ms'):
+            line += f" {(stage['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100:+11.1f}%"
+        print(line)
+    for name, stage in results['stages'].items():
+        if 'top_hit_matches' in stage:
+            print(f"{name}: {stage['top_hit_matches']} of {len(TYPO_QUERIES)} misspelled queries found the intended top hit")
+    print(f"peak RSS: {results['peak_rss_kb']} KB")
+    if baseline:
+        print(f"vs baseline is the change in p50 latency from commit {baseline.get('commit')}; negative is faster.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark fetch, extract, classify, index and search')
+    parser.add_argument(
+        '--fixtures_path',
+        required=False,
+        help="Folder of chapter HTML, one folder per code.",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench', 'fixtures')
+    )
+    parser.add_argument(
+        '--repeat',
+        required=False,
+        help="Number of timed passes over each stage.",
+        type=int,
+        default=3
+    )
+    parser.add_argument(
+        '--latency',
+        required=False,
+        help="Seconds the stand-in server waits before answering each request.",
+        type=float,
+        default=0.0
+    )
+    parser.add_argument(
+        '--extractor',
+        required=False,
+        help="Extractor whose text is classified and indexed.",
+        choices=EXTRACTORS,
+        default='html2text'
+    )
+    parser.add_argument(
+        '--output',
+        required=False,
+        help="File to write the results to, as JSON. Defaults to benchmark-{commit}.json."
+    )
+    parser.add_argument(
+        '--compare',
+        required=False,
+        help="Results file from an earlier run to compare against."
+    )
+    parser.add_argument(
+        '--keep',
+        required=False,
+        help="Indicates whether to keep the scratch folder the benchmark works in.",
+        action='store_const',
+        const=True,
+        default=False
+    )
+    args = parser.parse_args()
+
+    try:
+        results = run(args)
+    finally:
+        if args.keep:
+            print(f"Scratch folder kept: {WORK_PATH}")
+        else:
+            shutil.rmtree(WORK_PATH, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+    report(results, baseline)
+
+    output = args.output or f"benchmark-{results['commit'] or 'local'}.json"
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=4)
+    print(f"Results written to {output}")
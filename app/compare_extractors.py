@@ -0,0 +1,130 @@
+"""
+compare_extractors.py - Check the fast HTML extractor against html2text.
+
+Runs every HTML file in a folder through both extractors and the Classifier
+and sorts each chapter by how far the fast extractor's sections are from
+what html2text, as --get runs it, saves:
+
+    identical   The same sections, byte for byte.
+    markdown    The same once whitespace and Markdown punctuation (escapes,
+                emphasis and table rules) are removed, since only html2text
+                produces Markdown.
+    wrapping    The same only against html2text with line wrapping turned off.
+                html2text wraps at 78 characters, which splits long legislative
+                history lines and leaves their tails in the section text; the
+                fast extractor does not.
+    mismatched  Different sections.
+
+Anything but identical changes the saved section text, and so every section
+hash, the first time a code is fetched with the other extractor.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+import argparse
+import glob
+import os
+import re
+import time
+
+from util.classifier import Classifier
+from util.htmltotext import HtmlToText
+import util.functions as FN
+
+MARKDOWN = re.compile(r'[\\*_|\-]|\s+')
+
+
+def normalize(text: str) -> str:
+    if text is None:
+        return None
+    return MARKDOWN.sub('', text)
+
+
+def section_keys(sections: list, normalized: bool = True) -> list:
+    clean = normalize if normalized else (lambda text: text)
+    return [
+        (
+            s['section_prefix'],
+            s['section_number'],
+            clean(s['section_name']),
+            clean(s['text']),
+            s['chapter'],
+            s['subchapter']
+        )
+        for s in sections
+    ]
+
+
+def first_difference(name: str, expected: list, actual: list):
+    print(f"    {len(expected)} sections from {name}, {len(actual)} from fast")
+    for want, got in zip(expected, actual):
+        if want != got:
+            print(f"    {name}: {want}")
+            print(f"    {'fast':>{len(name)}}: {got}")
+            break
+
+
+def compare(html_path: str, verbose: bool = False) -> bool:
+    """
+    Returns:
+        (bool): True if no chapter is mismatched.
+    """
+    files = sorted(glob.glob(os.path.join(html_path, '*.htm')))
+    classifier = Classifier()
+    extractors = {name: HtmlToText(name) for name in ['html2text', 'fast']}
+    unwrapped = HtmlToText('html2text')
+    unwrapped.converter.body_width = 0
+    elapsed = {name: 0.0 for name in extractors}
+    counts = {kind: 0 for kind in ('identical', 'markdown', 'wrapping', 'mismatched')}
+
+    for file in files:
+        with open(file, 'r', encoding='utf-8') as html_file:
+            html_content = html_file.read()
+        sections = {}
+        for name, extractor in extractors.items():
+            start = time.perf_counter()
+            text_content = extractor.get_text(html_content)
+            elapsed[name] += time.perf_counter() - start
+            sections[name] = classifier.classify_doc(text_content, 'xx', file)
+        expected, actual = section_keys(sections['html2text']), section_keys(sections['fast'])
+
+        if section_keys(sections['html2text'], False) == section_keys(sections['fast'], False):
+            kind = 'identical'
+        elif expected == actual:
+            kind = 'markdown'
+        else:
+            expected = section_keys(classifier.classify_doc(unwrapped.get_text(html_content), 'xx', file))
+            kind = 'wrapping' if expected == actual else 'mismatched'
+        counts[kind] += 1
+
+        if kind == 'mismatched':
+            print(f"{file}: mismatched")
+            first_difference('html2text', expected, actual)
+        elif kind == 'wrapping' and verbose:
+            print(f"{file}: differs from html2text only by its line wrapping")
+            first_difference('html2text', section_keys(sections['html2text']), actual)
+
+    print(f"{len(files)} files: " + ', '.join(f"{count} {kind}" for kind, count in counts.items()))
+    if counts['markdown'] or counts['wrapping']:
+        print("Section text differs from what html2text saves, so switching extractors changes every section hash.")
+    for name, seconds in elapsed.items():
+        print(f"{name:>10}: {seconds:.3f}s")
+    return counts['mismatched'] == 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare HTML extractors')
+    parser.add_argument(
+        '--html_path',
+        required=False,
+        help="Folder of chapter HTML files to compare. Defaults to the retrieval cache.",
+        default=FN.CACHE_PATH
+    )
+    parser.add_argument(
+        '--verbose',
+        required=False,
+        help="Also show the first difference in each chapter that differs only by html2text's line wrapping.",
+        action='store_const',
+        const=True,
+        default=False
+    )
+    args = parser.parse_args()
+    compare(args.html_path, args.verbose)
@@ -1,9 +1,5 @@
 #!/bin/bash
-codes=( ag al bc bo cp cr ed el es fa hs pe )
-for code in "${codes[@]}"
-do
-	python3 app.py --get --index --progress --code $code
-done
-python3 app.py --upload_index --upload_config
+# These codes, several at a time, merged into the index at the end.
+python3 app.py --all_codes --codes ag,al,bc,bo,cp,cr,ed,el,es,fa,hs,pe --get --index --progress
+python3 app.py --upload_index --upload_config --sync
 sudo service jdbot-restutil restart
-
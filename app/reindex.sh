@@ -1,10 +1,4 @@
 #!/bin/bash
-codes=( ag al bc bo cp cr ed el es fa hs pe )
-for code in "${codes[@]}"
-do
-        echo
-        echo Indexing $code
-	python3 app.py --delete --index --progress --code $code
-done
-python3 app.py --upload_index
+python3 app.py --all_codes --codes ag,al,bc,bo,cp,cr,ed,el,es,fa,hs,pe --index --incremental
+python3 app.py --upload_index --sync
 sudo service jdbot-restutil restart
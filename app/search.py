@@ -1,39 +1,40 @@
-from whoosh.qparser import MultifieldParser, FuzzyTermPlugin
-from whoosh.index import open_dir
+from util.searchservice import SearchService
+from util.snippets import snippet_text
 
-import util.functions as FN
-
-parser = MultifieldParser(['section_name', 'text', 'section_number'], schema=FN.schema())
-parser.add_plugin(FuzzyTermPlugin())
-index = open_dir(FN.INDEX_PATH, FN.index_name(None))
+service = SearchService()
 
+print("Enter a query, or the number of a hit to see its full text.")
 query_text = input("Query: ")
 code_list = input("Codes (*=All): ")
+docs = []
 while query_text != '':
+    if query_text.strip().isdigit() and 0 < int(query_text) <= len(docs):
+        full_text = service.full_text(docs[int(query_text) - 1]['doc_id']) or {}
+        print(full_text.get('source_text', "NO SOURCE TEXT"))
+        print('=' * 120)
+        query_text = input("Query: ")
+        continue
+
+    codes = []
     if code_list != '*' and code_list != '':
         codes = code_list.upper().split(',')
-        code_clauses = [f'code:{c} ' for c in codes]
-        code_clause = ' OR '.join(code_clauses)
-        query_text = query_text + ' ' + code_clause
-    query = parser.parse(query_text)
-    print(query)
-    with index.searcher() as searcher:
-        result = searcher.search(query)
-        for doc in result:
-            code_name = doc.get('code_name', "NO CODE NAME")
-            section_number = doc.get('section_number', "NO SECTION NUMBER")
-            section_name = doc.get('section_name', "NO SECTION NAME")
-            text = doc.get('text', "NO TEXT")
-            source_text = doc.get('source_text', "NO SOURCE TEXT")
-            default_code = "NO CODE"
-            prefix = doc.get('section_prefix', 'Sec.')
-            code = doc.get('code', default_code)
-            if code != default_code:
-                print(f"{code}: {code_name}")
-                print("Title", doc.get('title', "NO TITLE"))
-                print(f"{prefix} {section_number} - {section_name}\n")
-                print('-' * 120)
-                print(source_text)
-                print('=' * 120)
+    corrected = service.correct(query_text, codes)
+    if corrected != ' '.join(query_text.split()):
+        print(f"Showing results for: {corrected}")
+    print(service.parser.parse(corrected), codes or '')
+    docs = service.search(query_text, codes=codes, snippets=True)
+    for number, doc in enumerate(docs, start=1):
+        code_name = doc.get('code_name', "NO CODE NAME")
+        section_number = doc.get('section_number', "NO SECTION NUMBER")
+        section_name = doc.get('section_name', "NO SECTION NAME")
+        default_code = "NO CODE"
+        prefix = doc.get('section_prefix', 'Sec.')
+        code = doc.get('code', default_code)
+        if code != default_code:
+            print(f"{number}. {code}: {code_name}")
+            print("Title", doc.get('title', "NO TITLE"))
+            print(f"{prefix} {section_number} - {section_name}\n")
+            print(snippet_text(doc.get('snippet')) or "NO TEXT")
+            print('=' * 120)
 
     query_text = input("Query: ")
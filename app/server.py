@@ -0,0 +1,141 @@
+"""
+server.py - Serve searches of the statute index as JSON over HTTP.
+
+    GET /search?q=child+support&codes=FA,ES&limit=10&snippets=1
+    GET /text?id=FA:6.502           Full text of FA 6.502
+    GET /complete?q=protective+ord&codes=FA&limit=10
+    GET /cites?id=FA:6.502          Sections and chapters that FA 6.502 refers to
+    GET /cited_by?id=FA:Ch.153      Sections that refer to chapter 153 of the Family Code
+    GET /metrics    Search counts and timings in Prometheus' text format
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from urllib.parse import parse_qs, urlparse
+
+from util.metrics import METRICS
+from util.searchservice import SearchService
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path == '/health':
+            return self.send_json(200, {'status': 'ok'})
+        if url.path == '/metrics':
+            return self.send_text(200, METRICS.prometheus())
+        if url.path in ('/cites', '/cited_by'):
+            return self.send_references(url.path[1:], params.get('id', [''])[0])
+        if url.path == '/text':
+            return self.send_full_text(params.get('id', [''])[0])
+        if url.path == '/complete':
+            return self.send_completions(params)
+        if url.path != '/search':
+            return self.send_json(404, {'error': f'Unknown path {url.path}'})
+
+        query_text = params.get('q', [''])[0]
+        if not query_text.strip():
+            return self.send_json(400, {'error': "Missing query parameter 'q'"})
+        codes = ','.join(params.get('codes', [])).split(',')
+        try:
+            limit = int(params.get('limit', ['10'])[0])
+            snippets = params.get('snippets', ['0'])[0].lower() in ('1', 'true', 'yes')
+            hits = self.service.search(query_text, codes=codes, limit=limit, snippets=snippets)
+        except Exception as e:
+            return self.send_json(400, {'error': str(e)})
+        self.send_json(200, {'query': query_text, 'count': len(hits), 'results': hits})
+
+    def send_references(self, direction: str, section: str):
+        if not section.strip():
+            return self.send_json(400, {'error': "Missing query parameter 'id'"})
+        try:
+            sections = getattr(self.service, direction)(section)
+        except Exception as e:
+            return self.send_json(400, {'error': str(e)})
+        self.send_json(200, {'id': section, 'count': len(sections), 'results': sections})
+
+    def send_completions(self, params: dict):
+        text = params.get('q', [''])[0]
+        codes = ','.join(params.get('codes', [])).split(',')
+        try:
+            limit = int(params.get('limit', ['10'])[0])
+            completions = self.service.complete(text, codes=codes, limit=limit)
+        except Exception as e:
+            return self.send_json(400, {'error': str(e)})
+        self.send_json(200, {'query': text, 'count': len(completions), 'results': completions})
+
+    def send_full_text(self, section: str):
+        if not section.strip():
+            return self.send_json(400, {'error': "Missing query parameter 'id'"})
+        try:
+            full_text = self.service.full_text(section)
+        except Exception as e:
+            return self.send_json(400, {'error': str(e)})
+        if full_text is None:
+            return self.send_json(404, {'error': f'No section {section}'})
+        self.send_json(200, full_text)
+
+    def send_json(self, status: int, body: dict):
+        self.send_payload(status, 'application/json', json.dumps(body, default=str).encode('utf-8'))
+
+    def send_text(self, status: int, body: str):
+        self.send_payload(status, 'text/plain; version=0.0.4', body.encode('utf-8'))
+
+    def send_payload(self, status: int, content_type: str, payload: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def serve(args):
+    SearchHandler.service = SearchService(cache_size=args.cache_size, refresh_interval=args.refresh_interval)
+    server = ThreadingHTTPServer((args.host, args.port), SearchHandler)
+    server.quiet = args.quiet
+    print(f"Serving searches on http://{args.host}:{args.port}/search")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        SearchHandler.service.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve searches of Texas Codified Laws')
+    parser.add_argument('--host', required=False, help="Interface to listen on.", default='127.0.0.1')
+    parser.add_argument('--port', required=False, help="Port to listen on.", type=int, default=8080)
+    parser.add_argument(
+        '--cache_size',
+        required=False,
+        help="Number of search results to keep in the result cache.",
+        type=int,
+        default=1024
+    )
+    parser.add_argument(
+        '--refresh_interval',
+        required=False,
+        help="Seconds between checks for a new version of the index.",
+        type=float,
+        default=1.0
+    )
+    parser.add_argument(
+        '--quiet',
+        required=False,
+        help="Indicates whether to suppress the request log.",
+        action='store_const',
+        const=True,
+        default=False
+    )
+    serve(parser.parse_args())
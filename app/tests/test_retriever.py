@@ -0,0 +1,86 @@
+"""
+test_retriever.py - Retriever against the local stand-in server.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from bench.standin import StandIn
+from util.httpcache import HttpCache
+from util.retriever import Retriever
+
+
+class RetrieverTest(unittest.TestCase):
+    def setUp(self):
+        self.standin = StandIn().start()
+        self.cache_path = tempfile.mkdtemp(prefix='code2json-test-')
+
+    def tearDown(self):
+        self.standin.stop()
+        shutil.rmtree(self.cache_path)
+
+    def statuses(self) -> list:
+        return [status for _, _, status in self.standin.requests]
+
+    def test_retrieve(self):
+        retriever = Retriever(self.standin.url, 'FA')
+        html = retriever.retrieve('6', verbose=False)
+        with open(os.path.join(self.standin.server.fixtures_path, 'FA', 'FA.6.htm'), encoding='utf-8') as html_file:
+            self.assertEqual(html, html_file.read())
+        self.assertEqual(self.statuses(), [200])
+
+    def test_not_found(self):
+        retriever = Retriever(self.standin.url, 'FA')
+        self.assertIsNone(retriever.retrieve('999', verbose=False))
+        self.assertEqual(retriever.not_found, {'999'})
+        self.assertEqual(self.statuses(), [404])
+
+    def test_not_modified_served_from_cache(self):
+        cache = HttpCache(self.cache_path)
+        first = Retriever(self.standin.url, 'FA', cache=cache).retrieve('6', verbose=False)
+        second = Retriever(self.standin.url, 'FA', cache=cache).retrieve('6', verbose=False)
+        self.assertEqual(second, first)
+        self.assertEqual(self.statuses(), [200, 304])
+
+    def test_not_modified_without_cached_body(self):
+        cache = HttpCache(self.cache_path)
+        retriever = Retriever(self.standin.url, 'FA', cache=cache)
+        first = retriever.retrieve('6', verbose=False)
+        # The validators survive but the page does not: ask again without them.
+        os.remove(os.path.join(self.cache_path, f"{cache.key(retriever.make_url('6'))}.htm"))
+        self.assertEqual(retriever.retrieve('6', verbose=False), first)
+        self.assertEqual(self.statuses(), [200, 304, 200])
+
+    def test_offline(self):
+        cache = HttpCache(self.cache_path)
+        Retriever(self.standin.url, 'FA', cache=cache).retrieve('6', verbose=False)
+        offline = Retriever(self.standin.url, 'FA', cache=cache, offline=True)
+        self.assertIsNotNone(offline.retrieve('6', verbose=False))
+        self.assertIsNone(offline.retrieve('1', verbose=False))
+        self.assertEqual(self.statuses(), [200])
+
+    def test_rate_limit(self):
+        rate = 20
+        retriever = Retriever(self.standin.url, 'FA', workers=4, rate_limit=rate)
+        chapters = ['1', '6', '153', '1', '6', '153']
+        results = dict(retriever.retrieve_all(chapters, verbose=False))
+        self.assertEqual(set(results), {'1', '6', '153'})
+        self.assertTrue(all(results.values()))
+
+        times = sorted(time for time, _, _ in self.standin.requests)
+        self.assertEqual(len(times), len(chapters))
+        # Allow a little for the time between a request's slot and its arrival.
+        self.assertGreaterEqual(times[-1] - times[0], (len(chapters) - 1) / rate * 0.8)
+
+    def test_retrieve_all_in_order_with_one_worker(self):
+        retriever = Retriever(self.standin.url, 'FA')
+        chapters = [chapter for chapter, _ in retriever.retrieve_all(['153', '999', '1'], verbose=False)]
+        self.assertEqual(chapters, ['153', '999', '1'])
+        self.assertEqual(self.statuses(), [200, 404, 200])
+
+
+if __name__ == '__main__':
+    unittest.main()
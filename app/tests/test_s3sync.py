@@ -0,0 +1,158 @@
+"""
+test_s3sync.py - S3Sync against a mocked S3.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+from datetime import timedelta
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+from util.s3sync import LAST, S3Sync, matches
+
+BUCKET = 'code2json-test'
+
+
+@unittest.skipIf(mock_aws is None, 'boto3 and moto are needed to test S3Sync')
+class S3SyncTest(unittest.TestCase):
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        self.s3_client = boto3.client('s3', region_name='us-east-1')
+        self.s3_client.create_bucket(Bucket=BUCKET)
+        self.syncer = S3Sync(self.s3_client, BUCKET)
+        self.folder = tempfile.mkdtemp(prefix='code2json-test-')
+        self.target = tempfile.mkdtemp(prefix='code2json-test-')
+
+    def tearDown(self):
+        self.mock.stop()
+        shutil.rmtree(self.folder)
+        shutil.rmtree(self.target)
+
+    def write(self, name: str, content: str):
+        with open(os.path.join(self.folder, name), 'w') as test_file:
+            test_file.write(content)
+
+    def read(self, folder: str, name: str) -> str:
+        with open(os.path.join(folder, name), 'r') as test_file:
+            return test_file.read()
+
+    def objects(self) -> set:
+        return {key['Key'].rsplit('/', 1)[-1] for key in self.syncer._keys('sync/objects/')}
+
+    def test_upload_sends_only_changed_files(self):
+        self.write('_main_1.toc', 'toc 1')
+        self.write('main_a.seg', 'segment a')
+        self.write('main_b.seg', 'segment b')
+        stats = self.syncer.upload('index', self.folder)
+        self.assertEqual((stats['files'], stats['sent']), (3, 3))
+        first = self.syncer.manifest('index')
+
+        self.write('main_b.seg', 'segment b, changed')
+        stats = self.syncer.upload('index', self.folder)
+        self.assertEqual((stats['files'], stats['sent']), (3, 1))
+        self.assertEqual(stats['sent_bytes'], len('segment b, changed'))
+
+        response = self.s3_client.get_object(Bucket=BUCKET, Key='sync/previous/index.json')
+        self.assertEqual(response['Body'].read().decode('utf-8'), json.dumps(first))
+
+    def test_upload_skips_excluded_files(self):
+        self.write('main_a.seg', 'segment a')
+        self.write('main_WRITELOCK', '')
+        self.write('main_a.seg.123.tmp', 'partial')
+        self.syncer.upload('index', self.folder)
+        self.assertEqual(set(self.syncer.manifest('index')), {'main_a.seg'})
+
+    def test_download_into_fresh_folder(self):
+        self.write('_main_1.toc', 'toc 1')
+        self.write('main_a.seg', 'segment a')
+        self.syncer.upload('index', self.folder)
+
+        stats = self.syncer.download('index', self.target)
+        self.assertEqual((stats['files'], stats['received']), (2, 2))
+        self.assertEqual(self.read(self.target, 'main_a.seg'), 'segment a')
+        self.assertEqual(self.read(self.target, '_main_1.toc'), 'toc 1')
+
+        # Nothing changed, so nothing comes down again.
+        self.assertEqual(self.syncer.download('index', self.target)['received'], 0)
+
+        os.remove(os.path.join(self.folder, '_main_1.toc'))
+        self.write('_main_2.toc', 'toc 2')
+        self.syncer.upload('index', self.folder)
+        stats = self.syncer.download('index', self.target)
+        self.assertEqual((stats['received'], stats['deleted']), (1, 1))
+        self.assertEqual(
+            sorted(name for name in os.listdir(self.target) if not name.startswith('.s3sync-')),
+            ['_main_2.toc', 'main_a.seg']
+        )
+
+    def test_download_missing_tree(self):
+        self.assertIsNone(self.syncer.download('index', self.target))
+
+    def test_download_toc_and_idx_last(self):
+        for name in ('_main_1.toc', 'fa-citations.idx', 'fa-citations.dat', 'main_a.seg', 'main_b.seg'):
+            self.write(name, name)
+        self.syncer.upload('index', self.folder)
+
+        paths = {entry['hash']: path for path, entry in self.syncer.manifest('index').items()}
+        names = []
+        download_file = self.s3_client.download_file
+
+        def recording_download(bucket, key, file_name, **kwargs):
+            names.append(paths[key.rsplit('/', 1)[-1]])
+            return download_file(bucket, key, file_name, **kwargs)
+
+        self.s3_client.download_file = recording_download
+        self.syncer.download('index', self.target)
+        last = [index for index, name in enumerate(names) if matches(name, LAST)]
+        self.assertEqual(len(names), 5)
+        self.assertEqual(last, [3, 4])
+
+    def test_collect_garbage(self):
+        self.write('keep.seg', 'kept by every version')
+        self.write('main.seg', 'version 1')
+        self.syncer.upload('index', self.folder)
+        self.write('main.seg', 'version 2')
+        self.syncer.upload('index', self.folder)
+        self.write('main.seg', 'version 3')
+        self.syncer.upload('index', self.folder)
+        self.assertEqual(len(self.objects()), 4)
+
+        # Version 1 is in neither manifest, but too new to remove.
+        self.assertEqual(self.syncer.collect_garbage(), 0)
+
+        self.assertEqual(self.syncer.collect_garbage(grace_period=timedelta(0)), 1)
+        referenced = {
+            entry['hash']
+            for key in ('sync/trees/index.json', 'sync/previous/index.json')
+            for entry in json.loads(
+                self.s3_client.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+            ).values()
+        }
+        self.assertEqual(self.objects(), referenced)
+
+    def test_collect_garbage_keeps_other_trees(self):
+        self.write('shared.json', 'config')
+        self.syncer.upload('code_configs', self.folder)
+        os.remove(os.path.join(self.folder, 'shared.json'))
+        self.write('main.seg', 'version 1')
+        self.syncer.upload('index', self.folder)
+        self.write('main.seg', 'version 2')
+        self.syncer.upload('index', self.folder)
+        self.write('main.seg', 'version 3')
+        self.syncer.upload('index', self.folder)
+        self.syncer.collect_garbage(grace_period=timedelta(0))
+        self.syncer.download('code_configs', self.target)
+        self.assertEqual(self.read(self.target, 'shared.json'), 'config')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,263 @@
+"""
+autocomplete.py - Type-ahead over section names and numbers from a sorted prefix table.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+from itertools import groupby
+import json
+import mmap
+import os
+import re
+import struct
+
+import util.functions as FN
+from util.mmaptable import NO_TOKEN, CodeTables, remove_table, write_table
+from util.references import ReferenceIndex
+
+MAGIC = b'MPX1'
+DAT_HEADER = struct.Struct('<4s8s')       # magic, token shared with the .idx
+IDX_HEADER = struct.Struct('<4s8sIIII')   # magic, token, entries, top lists, records, top list length
+RECORD = struct.Struct('<QII')            # record offset, record length, score
+ENTRY = struct.Struct('<QII')             # key offset, key length, record number
+
+# A prefix shared by more keys than this is answered from a list of its
+# best records made when the table is written, instead of by a scan.
+SCAN_LIMIT = 64
+TOP_K = 10
+TOP = struct.Struct(f'<QII{TOP_K}I')     # prefix offset, prefix length, records in the list, the list
+
+# Section names are completed from each of their first few words, so
+# "order" finds "PROTECTIVE ORDER".
+NAME_WORDS = 6
+MAX_KEY = 64
+
+LEADING_PREFIX = re.compile(r'^(?:sec|section|art|article)\s+(?=\d)')
+
+
+def completion_words(text: str) -> list:
+    words = (word.strip('.') for word in re.split(r'[^a-z0-9.]+', (text or '').lower()))
+    return [word for word in words if word]
+
+
+def completion_key(text: str) -> str:
+    """
+    Normalize what the user has typed so far the way keys are normalized:
+    lower case, punctuation dropped, and a leading "Sec."/"Art."/"§" dropped.
+    """
+    return LEADING_PREFIX.sub('', ' '.join(completion_words(text.replace('§', ' '))))[:MAX_KEY]
+
+
+def completion_path(code_name: str, index_path: str = None) -> str:
+    return os.path.join(index_path or FN.INDEX_PATH, f'{code_name.lower()}-complete')
+
+
+def build_completions(code_name: str, chapters, index_path: str = None):
+    """
+    Write the prefix table for one code:
+
+        {path}.dat - A header, then every key and every record, one after another.
+        {path}.idx - A header, then three arrays of fixed-size items:
+                     records (where each is and its score), entries (one per
+                     key, sorted by key), and top lists (for each prefix shared
+                     by more than SCAN_LIMIT keys, its TOP_K best records).
+
+    Each section is keyed by its number ("6.502"), its code and number
+    ("fa 6.502") and its name from each of its first NAME_WORDS words.
+    Its score is the number of sections that cite it in the reference
+    tables (see util/references.py), so build the references first.
+
+    Args:
+        code_name (str): Code abbreviation from the code's config file.
+        chapters (iterable): The list of sections of every chapter of the code.
+        index_path (str): Directory for the table. Defaults to INDEX_PATH.
+    """
+    references = ReferenceIndex(index_path)
+    records, scores, keys = [], [], []
+    for chapter in chapters:
+        for section in chapter or []:
+            section_number = section.get('section_number')
+            if not section_number:
+                continue
+            section_id = FN.doc_id(code_name, section_number)
+            score = len(references.cited_by(section_id))
+            record = len(records)
+            records.append(json.dumps({
+                'doc_id': section_id, 'code': code_name.upper(), 'section_prefix': section.get('section_prefix'),
+                'section_number': section_number, 'section_name': section.get('section_name'), 'cited_by': score,
+            }).encode('utf-8'))
+            scores.append(score)
+            name_words = completion_words(section.get('section_name'))
+            section_keys = {section_number.lower(), f'{code_name.lower()} {section_number.lower()}'}
+            section_keys.update(' '.join(name_words[start:]) for start in range(min(len(name_words), NAME_WORDS)))
+            keys += [(key[:MAX_KEY].encode('utf-8'), record) for key in section_keys if key]
+    references.close()
+    keys.sort()
+
+    def best(group: list) -> list:
+        ranked = sorted({record for _, record in group}, key=lambda record: (-scores[record], record))
+        return ranked[:TOP_K]
+
+    tops = []
+    length = 1
+    while True:
+        crowded = False
+        for prefix, group in groupby(keys, key=lambda item: item[0][:length]):
+            group = list(group)
+            if len(prefix) == length and len(group) > SCAN_LIMIT:
+                tops.append((prefix, best(group)))
+                crowded = True
+        if not crowded:
+            break
+        length += 1
+    tops.sort()
+
+    data = bytearray(DAT_HEADER.pack(MAGIC, NO_TOKEN))
+    index = bytearray(IDX_HEADER.pack(MAGIC, NO_TOKEN, len(keys), len(tops), len(records), TOP_K))
+    for record, score in zip(records, scores):
+        index += RECORD.pack(len(data), len(record), score)
+        data += record
+    for key, record in keys:
+        index += ENTRY.pack(len(data), len(key), record)
+        data += key
+    for prefix, ranked in tops:
+        index += TOP.pack(len(data), len(prefix), len(ranked), *(ranked + [0] * (TOP_K - len(ranked))))
+        data += prefix
+
+    write_table(completion_path(code_name, index_path), data, index)
+
+
+def remove_completions(code_name: str, index_path: str = None):
+    remove_table(completion_path(code_name, index_path))
+
+
+class PrefixTable(object):
+    """
+    Reads a table written by build_completions(). Both files are
+    memory-mapped; a lookup is two binary searches over the entries, then
+    either a scan of at most SCAN_LIMIT entries or one more binary search
+    for the prefix's top list.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.maps = []
+        self.index = self._map(f'{path}.idx')
+        self.data = self._map(f'{path}.dat')
+        if len(self.index) < IDX_HEADER.size:
+            self.close()
+            raise ValueError(f"{path}.idx is not a prefix table index")
+        magic, token, self.entry_count, self.top_count, self.record_count, top_k = IDX_HEADER.unpack_from(self.index, 0)
+        # A reader that opens the table while it is being replaced may pair
+        # the new index with the old data. Treat that as no table at all.
+        if magic != MAGIC or top_k != TOP_K or self.data[:DAT_HEADER.size] != DAT_HEADER.pack(MAGIC, token):
+            self.close()
+            raise ValueError(f"{path}.idx is not a prefix table index, or does not match {path}.dat")
+        self.entries_at = IDX_HEADER.size + self.record_count * RECORD.size
+        self.tops_at = self.entries_at + self.entry_count * ENTRY.size
+
+    def _map(self, file_name: str):
+        with open(file_name, 'rb') as table_file:
+            if os.fstat(table_file.fileno()).st_size == 0:
+                return b''
+            table_map = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps.append(table_map)
+        return table_map
+
+    def _key(self, entry: int) -> bytes:
+        offset, length, _ = ENTRY.unpack_from(self.index, self.entries_at + entry * ENTRY.size)
+        return self.data[offset:offset + length]
+
+    def _bisect(self, key: bytes) -> int:
+        # Index of the first entry whose key is not less than key.
+        low, high = 0, self.entry_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _score(self, record: int) -> int:
+        return RECORD.unpack_from(self.index, IDX_HEADER.size + record * RECORD.size)[2]
+
+    def _top(self, prefix: bytes) -> list:
+        low, high = 0, self.top_count
+        while low < high:
+            middle = (low + high) // 2
+            fields = TOP.unpack_from(self.index, self.tops_at + middle * TOP.size)
+            key = self.data[fields[0]:fields[0] + fields[1]]
+            if key == prefix:
+                return list(fields[3:3 + fields[2]])
+            if key < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def lookup(self, prefix: bytes, limit: int = TOP_K) -> list:
+        """
+        Returns:
+            (list): (score, record number) of the best records with a key
+                    that starts with prefix, best first.
+        """
+        low = self._bisect(prefix)
+        # No key holds a 0xff byte, since keys are UTF-8.
+        high = self._bisect(prefix + b'\xff')
+        if low == high:
+            return []
+        if high - low > SCAN_LIMIT and limit <= TOP_K:
+            ranked = self._top(prefix)
+            if ranked is not None:
+                return [(self._score(record), record) for record in ranked[:limit]]
+        records = {
+            ENTRY.unpack_from(self.index, self.entries_at + entry * ENTRY.size)[2] for entry in range(low, high)
+        }
+        ranked = sorted(((self._score(record), record) for record in records), key=lambda item: (-item[0], item[1]))
+        return ranked[:limit]
+
+    def record(self, record: int) -> dict:
+        offset, length, _ = RECORD.unpack_from(self.index, IDX_HEADER.size + record * RECORD.size)
+        return json.loads(self.data[offset:offset + length])
+
+    def close(self):
+        for table_map in self.maps:
+            table_map.close()
+        self.maps = []
+
+
+class Completions(object):
+    """
+    The prefix tables of every indexed code.
+    """
+    def __init__(self, index_path: str = None):
+        self.index_path = index_path or FN.INDEX_PATH
+        self.tables = CodeTables(self.index_path, 'complete', PrefixTable)
+
+    def complete(self, text: str, codes: frozenset = None, limit: int = TOP_K) -> list:
+        """
+        Complete what the user has typed so far.
+
+        Args:
+            text (str): The start of a section name or number, e.g. "protective ord" or "FA 6.5".
+            codes (frozenset): Code abbreviations to complete from. None or empty for all codes.
+            limit (int): Maximum number of completions.
+        Returns:
+            (list): doc_id, code, section_prefix, section_number, section_name
+                    and cited_by of each section, most cited first.
+        """
+        prefix = completion_key(text).encode('utf-8')
+        if not prefix:
+            return []
+        best = []
+        for code_name in sorted(codes) if codes else self.tables.code_names():
+            table = self.tables.get(code_name)
+            if table is not None:
+                best += [(score, code_name, record) for score, record in table.lookup(prefix, limit)]
+        best.sort(key=lambda item: (-item[0], item[1], item[2]))
+        return [self.tables.get(code_name).record(record) for _, code_name, record in best[:limit]]
+
+    def refresh(self) -> bool:
+        return self.tables.refresh()
+
+    def close(self):
+        self.tables.close()
@@ -0,0 +1,217 @@
+"""
+chapterstore.py - Where the classified sections of each chapter are kept.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+import glob
+import json
+import os
+import threading
+
+import util.functions as FN
+
+STORES = ['files', 'jsonl']
+
+
+def open_store(code_name: str, store: str = None):
+    """
+    Open the section store of a code.
+
+    Args:
+        code_name (str): Code abbreviation from the code's config file.
+        store (str): 'files' or 'jsonl'. Defaults to the SECTION_STORE environment variable.
+    Returns:
+        (FileChapterStore or JsonlChapterStore): The store.
+    """
+    store = store or FN.SECTION_STORE
+    if store == 'jsonl':
+        return JsonlChapterStore(code_name)
+    if store == 'files':
+        return FileChapterStore(code_name)
+    raise ValueError(f"Unknown section store '{store}'. Use one of {STORES}")
+
+
+def chapter_key(chapter) -> str:
+    return str(chapter).rjust(5, '0')
+
+
+class FileChapterStore(object):
+    """
+    One JSON file per chapter: codes/sections/{code}-Chapter-{00000}.json
+    """
+    def __init__(self, code_name: str):
+        self.code_name = code_name
+
+    def chapters(self) -> list:
+        prefix, suffix = FN.section_file_name(self.code_name, '*').split('*')
+        return sorted(file[len(prefix):-len(suffix)] for file in self.files())
+
+    def read(self, chapter) -> list:
+        try:
+            with open(FN.section_file_name(self.code_name, chapter_key(chapter)), 'r') as json_file:
+                return json.load(json_file)
+        except FileNotFoundError:
+            return None
+
+    def write(self, chapter, sections: list):
+        with open(FN.section_file_name(self.code_name, chapter_key(chapter)), 'w') as json_file:
+            json.dump(sections, json_file)
+
+    def items(self):
+        """
+        Yields:
+            (tuple): (chapter, list of sections) for every chapter.
+        """
+        for chapter in self.chapters():
+            yield chapter, self.read(chapter)
+
+    def files(self) -> list:
+        return glob.glob(FN.section_file_name(self.code_name, '*'))
+
+    def save(self):
+        pass
+
+
+class JsonlChapterStore(object):
+    """
+    All of a code's chapters in one append-only file, one line per chapter:
+
+        codes/sections/{code}.jsonl      {"chapter": "00006", "sections": [...]}
+        codes/sections/{code}.jsonl.idx  Offset and length of the latest line for each chapter
+
+    Writing a chapter appends a line and points the index at it, so reading
+    a chapter is one seek and one read, and reading a whole code is one
+    sequential pass over one file. Lines that have been replaced stay in
+    the file until save() compacts it. If the index is older than the
+    data file (e.g. the last run was interrupted before save()), the lines
+    written since are found again when the store is opened. A last line that
+    was cut short is skipped by readers and cut off by the first write(), so
+    the next line starts on a line of its own.
+    """
+    def __init__(self, code_name: str):
+        self.code_name = code_name
+        self.file_name = os.path.join(FN.CODE_PATH, 'sections', f'{code_name.upper()}.jsonl')
+        self.index_name = f'{self.file_name}.idx'
+        self.lock = threading.Lock()
+        self.offsets = {}
+        self.repaired = False
+        indexed_size = 0
+        try:
+            with open(self.index_name, 'r') as index_file:
+                index = json.load(index_file)
+            self.offsets = index['chapters']
+            indexed_size = index['size']
+        except (OSError, ValueError, KeyError):
+            pass
+        size = os.path.getsize(self.file_name) if os.path.exists(self.file_name) else 0
+        if size < indexed_size:
+            self.offsets, indexed_size = {}, 0
+        if size > indexed_size:
+            self._scan(indexed_size)
+
+    def _scan(self, start: int):
+        # Read only: another process may still be appending the last line.
+        with open(self.file_name, 'rb') as data_file:
+            data_file.seek(start)
+            offset = start
+            for line in data_file:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    self.offsets[json.loads(line)['chapter']] = [offset, len(line)]
+                except (ValueError, KeyError, TypeError):
+                    # A write that was cut short and then appended to. Skip it.
+                    pass
+                offset += len(line)
+
+    def _repair(self):
+        """
+        Cut off a last line that a crashed writer left unfinished. Called by
+        the writer, holding its lock, before its first append.
+        """
+        if not os.path.exists(self.file_name):
+            return
+        with open(self.file_name, 'rb+') as data_file:
+            end = data_file.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                start = max(0, position - 64 * 1024)
+                data_file.seek(start)
+                newline = data_file.read(position - start).rfind(b'\n')
+                if newline >= 0:
+                    position = start + newline + 1
+                    break
+                position = start
+            if position != end:
+                data_file.truncate(position)
+
+    def chapters(self) -> list:
+        return sorted(self.offsets)
+
+    def read(self, chapter) -> list:
+        position = self.offsets.get(chapter_key(chapter))
+        if position is None:
+            return None
+        with open(self.file_name, 'rb') as data_file:
+            data_file.seek(position[0])
+            return json.loads(data_file.read(position[1]))['sections']
+
+    def write(self, chapter, sections: list):
+        line = (json.dumps({'chapter': chapter_key(chapter), 'sections': sections}) + '\n').encode('utf-8')
+        with self.lock:
+            if not self.repaired:
+                self._repair()
+                self.repaired = True
+            with open(self.file_name, 'ab') as data_file:
+                offset = data_file.tell()
+                data_file.write(line)
+            self.offsets[chapter_key(chapter)] = [offset, len(line)]
+
+    def items(self):
+        """
+        Yields:
+            (tuple): (chapter, list of sections) for every chapter, in one pass over the file.
+        """
+        if not self.offsets:
+            return
+        live = {offset for offset, _ in self.offsets.values()}
+        with open(self.file_name, 'rb') as data_file:
+            offset = 0
+            for line in data_file:
+                if offset in live:
+                    record = json.loads(line)
+                    yield record['chapter'], record['sections']
+                offset += len(line)
+
+    def files(self) -> list:
+        return [file for file in (self.file_name, self.index_name) if os.path.exists(file)]
+
+    def save(self):
+        """
+        Write the offset index. Compacts the data file first when at least
+        half of it is lines that have been replaced.
+        """
+        with self.lock:
+            if not os.path.exists(self.file_name):
+                return
+            size = os.path.getsize(self.file_name)
+            live = sum(length for _, length in self.offsets.values())
+            if size - live >= live:
+                self._compact()
+                size = os.path.getsize(self.file_name)
+            temp_name = f'{self.index_name}.tmp'
+            with open(temp_name, 'w') as index_file:
+                json.dump({'size': size, 'chapters': self.offsets}, index_file)
+            os.replace(temp_name, self.index_name)
+
+    def _compact(self):
+        temp_name = f'{self.file_name}.tmp'
+        offsets = {}
+        with open(self.file_name, 'rb') as data_file, open(temp_name, 'wb') as temp_file:
+            for chapter in sorted(self.offsets):
+                offset, length = self.offsets[chapter]
+                data_file.seek(offset)
+                offsets[chapter] = [temp_file.tell(), length]
+                temp_file.write(data_file.read(length))
+        os.replace(temp_name, self.file_name)
+        self.offsets = offsets
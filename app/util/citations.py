@@ -0,0 +1,146 @@
+"""
+citations.py - Look sections up directly by citation, e.g. "FA 6.502" or "Art. 42.12".
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+from collections import defaultdict
+import json
+import os
+import re
+
+import util.functions as FN
+from util.mmaptable import CodeTables, MmapTableWriter, remove_table
+
+PREFIXES = ['Sec.', 'Art.']
+
+# An optional two-letter code, an optional "Sec.", "Art." or "§", and a
+# section number shaped the way the classifier recognizes them.
+CITATION_PATTERN = re.compile(
+    r'^\s*(?:([A-Za-z]{2})\s+)?(?:(sec|art)\.?\s*|§\s*)?(\d+\.[\dA-Za-z]+)\s*$',
+    re.IGNORECASE
+)
+
+
+def parse_citation(query_text: str) -> tuple:
+    """
+    Recognize a query that is nothing but a citation.
+
+    Returns:
+        (tuple): (code or None, prefix or None, section number), or None if
+                 the query is not a citation.
+    """
+    match = CITATION_PATTERN.match(query_text)
+    if not match:
+        return None
+    code, prefix, section_number = match.groups()
+    if prefix:
+        prefix = f'{prefix.capitalize()}.'
+    elif '§' in query_text:
+        prefix = 'Sec.'
+    return code.upper() if code else None, prefix, section_number
+
+
+def citation_key(code_name: str, section_prefix: str, section_number: str) -> str:
+    return f'{code_name.upper()}|{section_prefix}|{section_number}'
+
+
+def citation_path(code_name: str, index_path: str = None) -> str:
+    return os.path.join(index_path or FN.INDEX_PATH, f'{code_name.lower()}-citations')
+
+
+def citation_record(section: dict, code_name: str) -> dict:
+    """
+    What a search hit for this section would hold: its stored fields.
+    """
+    fields = FN.document_fields(section, code_name)
+    fields['future_effective_date'] = section.get('future_effective_date')
+    return {name: value for name, value in fields.items() if name != 'text' and value is not None}
+
+
+def build_citations(code_name: str, chapters, index_path: str = None):
+    """
+    Write the citation table for one code from its sections. Sections that
+    share a citation (e.g. a version with a future effective date) are kept
+    together under one key.
+
+    Args:
+        code_name (str): Code abbreviation from the code's config file.
+        chapters (iterable): The list of sections of every chapter of the code.
+        index_path (str): Directory for the table. Defaults to INDEX_PATH.
+    """
+    records = defaultdict(list)
+    for chapter in chapters:
+        for section in chapter or []:
+            if not section.get('section_number'):
+                continue
+            key = citation_key(code_name, section.get('section_prefix', 'Sec.'), section['section_number'])
+            records[key].append(citation_record(section, code_name))
+
+    writer = MmapTableWriter(citation_path(code_name, index_path))
+    for key, sections in records.items():
+        writer.add(key, json.dumps(sections, default=str).encode('utf-8'))
+    writer.save()
+
+
+def remove_citations(code_name: str, index_path: str = None):
+    remove_table(citation_path(code_name, index_path))
+
+
+class CitationIndex(object):
+    """
+    The citation tables of every indexed code.
+    """
+    def __init__(self, index_path: str = None):
+        self.index_path = index_path or FN.INDEX_PATH
+        self.tables = CodeTables(self.index_path, 'citations')
+
+    def code_names(self) -> list:
+        return self.tables.code_names()
+
+    def lookup(self, code_name: str, section_prefix: str, section_number: str, codes: frozenset = None) -> list:
+        """
+        Find the sections a citation refers to. A citation without a code is
+        looked up in each of *codes*, or in every code if that is empty, and
+        one without a prefix is tried as both "Sec." and "Art.".
+
+        Returns:
+            (list): The stored fields of each matching section.
+        """
+        if code_name:
+            code_names = [code_name] if not codes or code_name in codes else []
+        else:
+            code_names = sorted(codes) if codes else self.code_names()
+        prefixes = [section_prefix] if section_prefix else PREFIXES
+
+        sections = []
+        for name in code_names:
+            table = self.tables.get(name)
+            if table is None:
+                continue
+            for prefix in prefixes:
+                value = table.get(citation_key(name, prefix, section_number))
+                if value is not None:
+                    sections += json.loads(value)
+        return sections
+
+    def contains(self, code_name: str, section_number: str) -> bool:
+        """
+        Returns:
+            (bool): True if the code has a section with this number.
+        """
+        table = self.tables.get(code_name)
+        return table is not None and any(
+            citation_key(code_name, prefix, section_number) in table for prefix in PREFIXES
+        )
+
+    def refresh(self) -> bool:
+        """
+        Forget every table that has been rewritten since it was opened.
+
+        Returns:
+            (bool): True if any table was forgotten.
+        """
+        return self.tables.refresh()
+
+    def close(self):
+        self.tables.close()
@@ -6,79 +6,235 @@ Copyright (c) 2020 by Thomas J. Daley, J.D.
 import json
 import re
 
+# Kinds of lines that classify_line() recognizes.
+CODE_NAME = 'code_name'
+TITLE = 'title'
+SUBTITLE = 'subtitle'
+CHAPTER = 'chapter'
+SUBCHAPTER = 'subchapter'
+HISTORY = 'history'
+SECTION = 'section'
+TEXT = 'text'
+
+# Every heading pattern, in the order they used to be tried one at a time.
+# Because each alternative is anchored at the start of the line, the first
+# alternative that matches is the same one the sequential search found.
+HEADING_PATTERN = re.compile(
+    r'(?:(?P<code_name>[A-Z\-\s]+) CODE'
+    r'|CODE OF (?P<code_of>[A-Z\-\s]+)'
+    r'|TITLE (?P<title>[A-Z0-9\-\.\s]+)'
+    r'|SUBTITLE (?P<subtitle>[A-Z0-9\-\.\s]+)'
+    r'|CHAPTER (?P<chapter>[A-Z0-9\-\.\s]+)'
+    r'|SUBCHAPTER (?P<subchapter>[A-Z0-9\-\.\s]+))'
+)
+NAMED_HEADING_PATTERNS = {
+    kind: re.compile(rf'{kind.upper()} ([A-Z0-9\-\.\s]+)')
+    for kind in (TITLE, SUBTITLE, CHAPTER, SUBCHAPTER)
+}
+HEADING_GROUPS = (
+    ('code_name', CODE_NAME),
+    ('code_of', CODE_NAME),
+    ('title', TITLE),
+    ('subtitle', SUBTITLE),
+    ('chapter', CHAPTER),
+    ('subchapter', SUBCHAPTER),
+)
+
+# The section number and name can only end one way, so an optional
+# trailing-text group matches exactly what the separate "all four parts"
+# and "first three parts" patterns did.
+SECTION_PATTERN = re.compile(r'(Sec\.|Art\.) (\d+\.[\dA-Za-z]+)\. ([0-9A-Z\,\;\:\-\s]+)\.(?: (.*))?')
+ACTS_PATTERN = re.compile(r'ACTS \d{4}')
+UPPERCASE = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZ-')
+
 
 class Classifier(object):
     def classify_doc(self, text_content: str, code: str, filename: str) -> dict:
-        lines = text_content.split('\n')
+        """
+        Break a chapter's text into sections.
+
+        Headings only change the context that will be recorded with a
+        section, so they are tracked in one small dict and copied into a
+        section's record when that section closes, i.e. when a section with
+        a different number begins. Body lines are buffered in lists and
+        joined once at that point, so very long sections cost linear time.
+
+        Args:
+            text_content (str): Text of the chapter.
+            code (str): Code abbreviation to record with each section.
+            filename (str): Name of the file the sections will be saved in.
+        Returns:
+            (list): One dict per section.
+        """
         doc = []
-        context = {}
-        context['code'] = code
-        context['code_name'] = None
-        context['title'] = None
-        context['subtitle'] = None
-        context['chapter'] = None
-        context['subchapter'] = None
-        context['section_prefix'] = None
-        context['section_number'] = None
-        context['section_name'] = None
-        context['text'] = None
-        context['filename'] = filename
-        context['future_effective_date'] = None
-        context['source_text'] = ''
-        prior_context = context.copy()
-
-        for source_line in lines:
+        headings = {CODE_NAME: None, TITLE: None, SUBTITLE: None, CHAPTER: None, SUBCHAPTER: None}
+        section = None
+
+        for source_line in text_content.split('\n'):
             line = clean(source_line)
             if not line:
                 continue
 
-            context = classify(line, context, source_line)
+            kind, value = classify_line(line)
+
+            if kind == TEXT:
+                if section is not None:
+                    section.add_line(line, source_line)
+                continue
+
+            if kind == SECTION:
+                section_number, section_name, text, prefix = value
+                section_number = section_number.strip()
+                if section is not None and section.section_number != section_number and section.has_text():
+                    doc.append(section.to_dict(code, headings, filename))
+                section = Section(prefix, section_number, section_name.strip(), text.strip() if text else '', source_line)
+                continue
 
-            if prior_context['section_number'] != context['section_number'] and prior_context['text']:
-                doc.append(prior_context)
+            if kind != HISTORY:
+                headings[kind] = value
 
-            prior_context = context.copy()
-        doc.append(context)
+        if section is None:
+            doc.append(Section.empty_dict(code, headings, filename))
+        else:
+            doc.append(section.to_dict(code, headings, filename))
         return doc
 
 
-def extract_code_name(line: str) -> str:
-    match = re.findall(r'^([A-Z\-\s]+) CODE', line)
-    if match:
-        return match[0]
+class Section(object):
+    """
+    One section of a code, as it is being assembled from lines of text.
+    """
+    __slots__ = ('section_prefix', 'section_number', 'section_name', 'text_lines', 'source_lines')
+
+    def __init__(self, section_prefix: str, section_number: str, section_name: str, text: str, source_line: str):
+        self.section_prefix = section_prefix
+        self.section_number = section_number
+        self.section_name = section_name
+        self.text_lines = [text]
+        self.source_lines = [source_line]
+
+    def add_line(self, line: str, source_line: str):
+        self.text_lines.append(line)
+        self.source_lines.append(source_line)
+
+    def has_text(self) -> bool:
+        return len(self.text_lines) > 1 or bool(self.text_lines[0])
+
+    def to_dict(self, code: str, headings: dict, filename: str) -> dict:
+        """
+        Convert to the dict we save as JSON and index.
+
+        Args:
+            code (str): Code abbreviation.
+            headings (dict): Code name, title, subtitle, chapter and subchapter in effect.
+            filename (str): Name of the file the section will be saved in.
+        Returns:
+            (dict): Section record.
+        """
+        return {
+            'code': code,
+            'code_name': headings[CODE_NAME],
+            'title': headings[TITLE],
+            'subtitle': headings[SUBTITLE],
+            'chapter': headings[CHAPTER],
+            'subchapter': headings[SUBCHAPTER],
+            'section_prefix': self.section_prefix,
+            'section_number': self.section_number,
+            'section_name': self.section_name,
+            'text': '\n\n'.join(self.text_lines),
+            'filename': filename,
+            'future_effective_date': None,
+            'source_text': '\n\n'.join(self.source_lines),
+        }
+
+    @staticmethod
+    def empty_dict(code: str, headings: dict, filename: str) -> dict:
+        """
+        The record we save for a chapter that has no sections at all.
+        """
+        return {
+            'code': code,
+            'code_name': headings[CODE_NAME],
+            'title': headings[TITLE],
+            'subtitle': headings[SUBTITLE],
+            'chapter': headings[CHAPTER],
+            'subchapter': headings[SUBCHAPTER],
+            'section_prefix': None,
+            'section_number': None,
+            'section_name': None,
+            'text': None,
+            'filename': filename,
+            'future_effective_date': None,
+            'source_text': '',
+        }
+
+
+def classify_line(line: str) -> tuple:
+    """
+    Decide what kind of line this is with at most one regular expression match.
 
-    match = re.findall(r'^CODE OF ([A-Z\-\s]+)', line)
-    if match:
-        return match[0]
+    The first character of the line tells us which patterns could possibly
+    match: headings are all upper case, legislative history starts with
+    "Acts", "Added" or "Amended", and sections start with "Sec." or "Art.".
+    Everything else is statutory text.
 
-    return None
+    Args:
+        line (str): Cleaned, non-empty line of text.
+    Returns:
+        (tuple): (kind, value) where kind is one of the constants above. For
+                 headings, value is the heading name. For sections, value is
+                 the tuple returned by extract_section(). Otherwise None.
+    """
+    first = line[0]
+    if first == 'S' or first == 'A':
+        if line.startswith('Sec. ') or line.startswith('Art. '):
+            match = SECTION_PATTERN.match(line)
+            if match:
+                prefix, section_number, section_name, code = match.groups()
+                return SECTION, (section_number, section_name, code, prefix)
+            return TEXT, None
 
+    if first in UPPERCASE:
+        match = HEADING_PATTERN.match(line)
+        if match:
+            for group, kind in HEADING_GROUPS:
+                value = match.group(group)
+                if value is not None:
+                    return kind, value
 
-def extract_title_name(line: str) -> str:
-    match = re.findall(r'^TITLE ([A-Z0-9\-\.\s]+)', line)
+    if (first == 'A' or first == 'a') and is_legislative_history(line):
+        return HISTORY, None
+
+    return TEXT, None
+
+
+def extract_code_name(line: str) -> str:
+    match = HEADING_PATTERN.match(line)
     if match:
-        return match[0]
+        return match.group('code_name') or match.group('code_of')
     return None
 
 
+def extract_title_name(line: str) -> str:
+    return _extract_heading(TITLE, line)
+
+
 def extract_subtitle_name(line: str) -> str:
-    match = re.findall(r'^SUBTITLE ([A-Z0-9\-\.\s]+)', line)
-    if match:
-        return match[0]
-    return None
+    return _extract_heading(SUBTITLE, line)
 
 
 def extract_chapter_name(line: str) -> str:
-    match = re.findall(r'^CHAPTER ([A-Z0-9\-\.\s]+)', line)
-    if match:
-        return match[0]
-    return None
+    return _extract_heading(CHAPTER, line)
 
 
 def extract_subchapter_name(line: str) -> str:
-    match = re.findall(r'^SUBCHAPTER ([A-Z0-9\-\.\s]+)', line)
+    return _extract_heading(SUBCHAPTER, line)
+
+
+def _extract_heading(kind: str, line: str) -> str:
+    match = NAMED_HEADING_PATTERNS[kind].match(line)
     if match:
-        return match[0]
+        return match.group(1)
     return None
 
 
@@ -110,25 +266,10 @@ def extract_section(line: str) -> str:
         ()[2]: First bit of text
         ()[3]: Section Prefix (either "Sec." or "Art.")
     """
-    # Line has all four parts:
-    match = re.findall(r'^Sec\. (\d+\.[\dA-Za-z]+)\. ([0-9A-Z\,\;\:\-\s]+)\. (.*)', line)
-    if match:
-        return match[0][0], match[0][1], match[0][2], 'Sec.'
-
-    # Line has only first three parts:
-    match = re.findall(r'^Sec\. (\d+\.[\dA-Za-z]+)\. ([0-9A-Z\,\;\:\-\s]+)\.', line)
+    match = SECTION_PATTERN.match(line)
     if match:
-        return match[0][0], match[0][1], None, 'Sec.'
-
-    # Line has all four parts:
-    match = re.findall(r'^Art\. (\d+\.[\dA-Za-z]+)\. ([0-9A-Z\,\;\:\-\s]+)\. (.*)', line)
-    if match:
-        return match[0][0], match[0][1], match[0][2], 'Art.'
-
-    # Line has only first three parts:
-    match = re.findall(r'^Art\. (\d+\.[\dA-Za-z]+)\. ([0-9A-Z\,\;\:\-\s]+)\.', line)
-    if match:
-        return match[0][0], match[0][1], None, 'Art.'
+        prefix, section_number, section_name, code = match.groups()
+        return section_number, section_name, code, prefix
 
     return None, None, None, None
 
@@ -141,43 +282,23 @@ def is_legislative_history(line: str):
     if lupper.startswith('AMENDED BY:'):
         return True
 
-    if re.findall(r'^ACTS \d{4}', lupper):
+    if ACTS_PATTERN.match(lupper):
         return True
 
     return False
 
 
 def classify(line: str, context: dict, source_line: str) -> (bool, dict):
-    code_name = extract_code_name(line)
-    if code_name:
-        context['code_name'] = code_name
-        return context
-
-    title_name = extract_title_name(line)
-    if title_name:
-        context['title'] = title_name
-        return context
-
-    subtitle_name = extract_subtitle_name(line)
-    if subtitle_name:
-        context['subtitle'] = subtitle_name
-        return context
+    kind, value = classify_line(line)
 
-    chapter_name = extract_chapter_name(line)
-    if chapter_name:
-        context['chapter'] = chapter_name
+    if kind == TEXT:
+        if context['section_number']:
+            context['text'] += '\n\n' + line
+            context['source_text'] += ('\n\n' + source_line)
         return context
 
-    subchapter_name = extract_subchapter_name(line)
-    if subchapter_name:
-        context['subchapter'] = subchapter_name
-        return context
-
-    if is_legislative_history(line):
-        return context
-
-    section_number, section_name, code, prefix = extract_section(line)
-    if section_number:
+    if kind == SECTION:
+        section_number, section_name, code, prefix = value
         context['section_prefix'] = prefix
         context['section_number'] = section_number.strip()
         context['section_name'] = section_name.strip()
@@ -188,11 +309,8 @@ def classify(line: str, context: dict, source_line: str) -> (bool, dict):
         context['source_text'] = source_line
         return context
 
-    if context['section_number']:
-        # if context.get('text', None):
-        context['text'] += '\n\n' + line
-        context['source_text'] += ('\n\n' + source_line)
-
+    if kind != HISTORY:
+        context[kind] = value
     return context
 
 
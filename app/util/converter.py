@@ -0,0 +1,65 @@
+"""
+converter.py - Convert the HTML of a chapter to sections.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+from util.classifier import Classifier
+from util.htmltotext import HtmlToText
+from util.references import extract_references
+import util.functions as FN
+
+# One converter per extractor, and one classifier, per process. When we run
+# in a process pool, each worker builds its own the first time it is
+# handed a chapter.
+_htmltotexters = {}
+_classifier = Classifier()
+
+
+def extract_text(html_content: str, extractor: str = 'html2text') -> str:
+    htmltotexter = _htmltotexters.get(extractor)
+    if htmltotexter is None:
+        htmltotexter = _htmltotexters[extractor] = HtmlToText(extractor)
+    return htmltotexter.get_text(html_content)
+
+
+def classify_text(text_content: str, code: str, code_name: str, chapter: str) -> tuple:
+    """
+    Classify a chapter's text into sections and note what each section refers to.
+
+    Returns:
+        (tuple): (file name, list of sections)
+    """
+    chap_num = str(chapter).rjust(5, '0')
+    code_file = FN.section_file_name(code_name, chap_num)
+    sections = _classifier.classify_doc(text_content, code, code_file)
+    for section in sections:
+        section['references'] = extract_references(section.get('text'), code_name)
+    return code_file, sections
+
+
+def convert_chapter(code: str, code_name: str, chapter: str, html_content: str, verbose: bool = False,
+                    extractor: str = 'html2text') -> tuple:
+    """
+    Extract the text of a chapter and classify it into sections. This is a
+    module-level function so that it can be handed to a process pool. The
+    sections are returned rather than saved so that only the parent process
+    ever writes to the chapter store.
+
+    Args:
+        code (str): Code abbreviation given on the command line.
+        code_name (str): Code abbreviation from the code's config file.
+        chapter (str): Chapter number.
+        html_content (str): HTML of the chapter.
+        verbose (bool): Whether to print progress messages as each stage finishes.
+        extractor (str): Which HtmlToText extractor to use.
+    Returns:
+        (tuple): (chapter, file name, list of sections)
+    """
+    text_content = extract_text(html_content, extractor)
+    if verbose:
+        print("txt extracted", end=" - ")
+
+    code_file, sections = classify_text(text_content, code, code_name, chapter)
+    if verbose:
+        print("classified")
+    return chapter, code_file, sections
@@ -7,36 +7,166 @@ import glob
 import json
 import os
 
-from whoosh.index import exists_in, open_dir
-from whoosh.fields import DATETIME, Schema, TEXT
-import dotenv
-
-# Load environment variables
-dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
-dotenv.load_dotenv(dotenv_path)
+# Load environment variables, once, for every module. app.py has always kept
+# .env beside itself; util/.env is still read for installs that put it here.
+# Whoosh is imported by the functions that need it, so commands that never
+# touch the index do not pay to load it.
+for dotenv_path in (os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'),
+                    os.path.join(os.path.dirname(__file__), '.env')):
+    if os.path.exists(dotenv_path):
+        import dotenv
+        dotenv.load_dotenv(dotenv_path)
 
 INDEX_PATH = os.environ.get('INDEX_PATH', 'index')
 CODE_PATH = os.environ.get('CODE_PATH', 'codes')
+CACHE_PATH = os.environ.get('CACHE_PATH', 'cache')
+STATUTES_URL = os.environ.get('STATUTES_URL', 'https://statutes.capitol.texas.gov')
+
+# 'single' puts every code into one index called 'main'. 'sharded' gives
+# each code an index of its own, named for the code.
+INDEX_LAYOUT = os.environ.get('INDEX_LAYOUT', 'single').lower()
+
+# 'files' keeps one JSON file per chapter. 'jsonl' keeps one file per code.
+SECTION_STORE = os.environ.get('SECTION_STORE', 'files').lower()
 
 
 def schema():
+    """
+    Fields we index for each section.
+
+    Identifiers and filter fields are indexed as single tokens (ID). Only
+    text and section_name record term positions, because those are the
+    only fields we run phrase queries against. text also records where
+    each term starts and ends, so snippets can be cut without analyzing
+    the body again (see util/snippets.py). The body is not stored in the
+    index at all: both it and source_text, which is what we display, are
+    kept in the text tables (see util/sectiontext.py) and read only when
+    asked for.
+    """
+    from whoosh.fields import DATETIME, ID, STORED, Schema, TEXT
     return Schema(
-        code=TEXT(stored=True),
-        code_name=TEXT(stored=True),
-        title=TEXT(stored=True),
-        subtitle=TEXT(stored=True),
-        chapter=TEXT(stored=True),
-        subchapter=TEXT(stored=True),
-        section_prefix=TEXT(stored=True),
-        section_number=TEXT(stored=True),
+        doc_id=ID(unique=True, stored=True),
+        code=ID(stored=True),
+        code_name=STORED,
+        title=TEXT(stored=True, phrase=False),
+        subtitle=TEXT(stored=True, phrase=False),
+        chapter=TEXT(stored=True, phrase=False),
+        subchapter=TEXT(stored=True, phrase=False),
+        section_prefix=ID(stored=True),
+        section_number=ID(stored=True),
         section_name=TEXT(stored=True),
-        text=TEXT(stored=True),
-        source_text=TEXT(stored=True),
-        filename=TEXT(stored=True),
+        text=TEXT(stored=False, chars=True),
+        filename=STORED,
         future_effective_date=DATETIME(stored=True)
     )
 
 
+def schema_is_current(index) -> bool:
+    """
+    See whether an index was built with the field types in schema().
+    Indexes built by earlier versions stored and analyzed every field, and
+    did not record the character offsets of text.
+
+    Args:
+        index (whoosh.index): Open index.
+    Returns:
+        (bool): True if every field matches schema().
+    """
+    current = schema()
+    for name in current.names():
+        if name not in index.schema:
+            return False
+        field, wanted = index.schema[name], current[name]
+        if type(field) is not type(wanted) or field.stored != wanted.stored:
+            return False
+        if wanted.format and wanted.format.supports('characters') != field.format.supports('characters'):
+            return False
+    return True
+
+
+def index_files(index_path: str, name: str) -> list:
+    """
+    List the files that make up an index.
+
+    Args:
+        index_path (str): Folder the index lives in.
+        name (str): Index name.
+    Returns:
+        (list): Paths to the index's TOC and segment files.
+    """
+    return glob.glob(f'{index_path}/_{name}_*.toc') + glob.glob(f'{index_path}/{name}_*')
+
+
+def doc_id(code_name: str, section_number: str) -> str:
+    """
+    Unique ID of a section in the index: code plus section number, e.g. FA:6.502.
+    """
+    return f'{code_name.upper()}:{section_number}'
+
+
+def document_fields(section: dict, code_name: str) -> dict:
+    """
+    Fields to index for one section.
+
+    Args:
+        section (dict): Section as saved by the classifier.
+        code_name (str): Code abbreviation from the code's config file.
+    Returns:
+        (dict): Keyword arguments for add_document()/update_document().
+    """
+    return dict(
+        doc_id=doc_id(code_name, section.get('section_number')),
+        code_name=section.get('code_name'),
+        title=section.get('title'),
+        subtitle=section.get('subtitle'),
+        chapter=section.get('chapter'),
+        subchapter=section.get('subchapter'),
+        section_prefix=section.get('section_prefix', 'Sec.'),
+        section_number=section.get('section_number'),
+        section_name=section.get('section_name'),
+        text=section.get('text'),
+        code=code_name,
+        filename=section.get('filename')
+    )
+
+
+def upgrade_schema(index):
+    """
+    Add any fields in schema() that an existing index was created without,
+    so that indexes built by earlier versions keep working. Fields the
+    index already has keep their old types; see schema_is_current() and
+    --migrate_index.
+
+    Args:
+        index (whoosh.index): Open index.
+    Returns:
+        (list): Names of the fields that were added.
+    """
+    missing = [name for name in schema().names() if name not in index.schema]
+    if missing:
+        with index.writer() as writer:
+            for name in missing:
+                writer.add_field(name, schema()[name])
+    return missing
+
+
+def section_file_name(code_name: str, chap_num: str) -> str:
+    """
+    Name of the file that holds the sections of one chapter.
+
+    Args:
+        code_name (str): The two-letter abbreviation for the code.
+        chap_num (str): Chapter number, or '*' for a glob pattern that matches every chapter.
+    Returns:
+        (str): File name.
+    """
+    if chap_num != '*':
+        chapter = str(chap_num).rjust(5, '0')
+    else:
+        chapter = chap_num
+    return f'{CODE_PATH}/sections/{code_name}-Chapter-{chapter}.json'
+
+
 def code_config(code_name: str) -> dict:
     """
     Open and load the configuration file for this code.
@@ -51,21 +181,38 @@ def code_config(code_name: str) -> dict:
     return config
 
 
+def configured_codes() -> list:
+    """
+    Codes that have a config file in CODE_PATH.
+
+    Returns:
+        (list): Sorted code abbreviations, lower case, e.g. ['ag', 'al', 'bc']
+    """
+    return sorted(os.path.basename(file)[:-len('.json')] for file in glob.glob(os.path.join(CODE_PATH, '*.json')))
+
+
 def enumerate_indices() -> list:
     """
-    Examine the INDEX_PATH and gather a list of indices.
+    Examine the INDEX_PATH and gather a list of indexed codes.
 
     Args:
         None
     Returns:
         (list): List of code abbreviations that have been indexed
     """
-    files = glob.glob(f'{INDEX_PATH}/_??_*.toc')
+    from whoosh.index import exists_in, open_dir
+    if INDEX_LAYOUT == 'sharded':
+        code_names = shard_names()
+    elif exists_in(INDEX_PATH, 'main'):
+        index = open_dir(INDEX_PATH, 'main')
+        with index.reader() as reader:
+            code_names = [code.lower() for code in reader.field_terms('code')]
+        index.close()
+    else:
+        code_names = []
+
     indices = []
-    for toc in files:
-        begin_position = toc.find('_', 0) + 1
-        end_position = toc.find('_', begin_position+1)
-        code_name = toc[begin_position:end_position]
+    for code_name in code_names:
         config = code_config(code_name)
         full_name = config.get('code_full_name', f"Texas {code_name.upper()} Code")
         indices.append({'code_name': code_name, 'full_code_name': full_name})
@@ -76,46 +223,73 @@ def index_name(args) -> str:
     """
     This is *THE* way we create index names.
     I tried an experiment with putting each codified book into its own
-    index, thus the commented code below.
-
-    But I could not merge the search results properly, so now I'm back
-    to indexing everying into one common index called 'main'.
+    index, but I could not merge the search results properly, so by
+    default everything is indexed into one common index called 'main'.
     /tjd/ 2020-04-06
 
+    Setting INDEX_LAYOUT=sharded brings the experiment back: each code gets
+    its own index. SearchService does not query the shards one by one and
+    merge the hits; it puts the segments of every shard searched into one
+    reader and runs a single search over it, so scores use statistics from
+    all of those shards and stay comparable.
+
     Args:
         args (argpase): Argparse arguments. (somtimes passed as a str)
 
     Returns:
         (str): Index name we use for this code section
     """
-    return 'main'
-    # if isinstance(args, str):
-    #     return args.lower().strip()
-    # return args.code.lower().strip()
+    if INDEX_LAYOUT != 'sharded':
+        return 'main'
+    if isinstance(args, str):
+        return args.lower().strip()
+    return args.code.lower().strip()
+
+
+def shard_names(index_path: str = None) -> list:
+    """
+    Names of the per-code indexes found in a sharded index directory.
+
+    Args:
+        index_path (str): Directory to look in. Defaults to INDEX_PATH.
+    Returns:
+        (list): Sorted index names, one per code.
+    """
+    names = set()
+    for toc in glob.glob(os.path.join(index_path or INDEX_PATH, '_*_*.toc')):
+        name = os.path.basename(toc)[1:].rsplit('_', 1)[0]
+        if name != 'main':
+            names.add(name)
+    return sorted(names)
 
 
-def index_exists(args) -> bool:
+def index_exists(args, index_path: str = None) -> bool:
     """
     See if an index exists.
 
     Args:
         args (argparse): Argparse arguments
+        index_path (str): Directory to look in. Defaults to INDEX_PATH.
     Returns:
         (bool): True if the index exists, otherwise False.
     """
-    if not os.path.exists(INDEX_PATH):
+    from whoosh.index import exists_in
+    index_path = index_path or INDEX_PATH
+    if not os.path.exists(index_path):
         return False
-    return exists_in(INDEX_PATH, index_name(args))
+    return exists_in(index_path, index_name(args))
 
 
-def open_index(args):
+def open_index(args, index_path: str = None):
     """
     Open an index for searching.
 
     Args:
         args (argparse): Argparse arguments.
+        index_path (str): Directory the index is in. Defaults to INDEX_PATH.
     Returns:
         (whoosh.index): Instance of index
     """
-    index = open_dir(INDEX_PATH, index_name(args))
+    from whoosh.index import open_dir
+    index = open_dir(index_path or INDEX_PATH, index_name(args))
     return index
@@ -3,13 +3,95 @@ htmltotext.py - Convert HTML to Markdown text.
 
 Copyright (c) 2020 by Thomas J. Daley, J.D.
 """
-import html2text
+from html.parser import HTMLParser
+import re
+
+EXTRACTORS = ['html2text', 'fast']
 
 
 class HtmlToText(object):
-    def __init__(self):
-        self.converter = html2text.HTML2Text()
+    """
+    Convert a statute page to text, one line per paragraph.
+
+    Two extractors are available:
+
+        html2text - Full Markdown conversion. This is what we have always used.
+        fast      - Streaming extractor that only produces the line structure
+                    the Classifier needs: one line per block element, with
+                    whitespace collapsed and no Markdown.
+    """
+    def __init__(self, extractor: str = 'html2text'):
+        if extractor not in EXTRACTORS:
+            raise ValueError(f"Unknown extractor '{extractor}'. Choose one of {EXTRACTORS}.")
+        self.extractor = extractor
+        if extractor == 'html2text':
+            import html2text
+            self.converter = html2text.HTML2Text()
+        else:
+            self.converter = None
 
     def get_text(self, html_content: str) -> str:
+        if self.converter is None:
+            parser = LineExtractor()
+            parser.feed(html_content)
+            parser.close()
+            return parser.get_text()
         text_content = self.converter.handle(html_content)
         return text_content
+
+
+class LineExtractor(HTMLParser):
+    """
+    Collect the text of an HTML page as a list of lines. A new line starts
+    at every block-level element; everything inside <head>, <script> and
+    <style> is ignored, as html2text does.
+    """
+    BLOCK_TAGS = frozenset([
+        'p', 'div', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'tr', 'table',
+        'blockquote', 'pre', 'hr', 'ul', 'ol', 'dl', 'dt', 'dd', 'center', 'body'
+    ])
+    CELL_TAGS = frozenset(['td', 'th'])
+    QUIET_TAGS = frozenset(['head', 'script', 'style'])
+    WHITESPACE = re.compile(r'\s+')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.lines = []
+        self.parts = []
+        self.quiet = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.QUIET_TAGS:
+            self.quiet += 1
+        elif tag in self.BLOCK_TAGS:
+            self.end_line()
+        elif tag in self.CELL_TAGS:
+            self.parts.append(' ')
+
+    def handle_endtag(self, tag):
+        if tag in self.QUIET_TAGS:
+            self.quiet = max(0, self.quiet - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.end_line()
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self.end_line()
+
+    def handle_data(self, data):
+        if not self.quiet:
+            self.parts.append(data)
+
+    def end_line(self):
+        if self.parts:
+            line = self.WHITESPACE.sub(' ', ''.join(self.parts)).strip()
+            if line:
+                self.lines.append(line)
+            self.parts = []
+
+    def close(self):
+        super().close()
+        self.end_line()
+
+    def get_text(self) -> str:
+        return '\n\n'.join(self.lines) + '\n'
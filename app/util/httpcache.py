@@ -0,0 +1,91 @@
+"""
+httpcache.py - Persistent cache of retrieved statute pages.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+import hashlib
+import json
+import os
+import threading
+
+
+class HttpCache(object):
+    """
+    Keeps the raw HTML of every page we retrieve along with the validators
+    (ETag and Last-Modified) the server sent with it. On the next run we
+    can ask the server whether the page changed and, if not, reuse the
+    body we already have.
+
+    Each URL is stored as two files named for the SHA-1 of the URL:
+
+        {cache_path}/{sha1}.htm  - Raw HTML
+        {cache_path}/{sha1}.json - URL and validators
+    """
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path, exist_ok=True)
+
+    def key(self, url: str) -> str:
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def get(self, url: str) -> dict:
+        """
+        Retrieve a cached page.
+
+        Args:
+            url (str): URL the page was retrieved from.
+        Returns:
+            (dict): Dict with url, etag, last_modified and body, or None if
+                    we have never cached this URL.
+        """
+        key = self.key(url)
+        try:
+            with open(self._path(key, 'json'), 'r') as meta_file:
+                entry = json.load(meta_file)
+            with open(self._path(key, 'htm'), 'r', encoding='utf-8') as body_file:
+                entry['body'] = body_file.read()
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def put(self, url: str, body: str, etag: str = None, last_modified: str = None):
+        """
+        Save a page to the cache. Files are written to a temporary name and
+        then renamed so that concurrent readers never see a partial page.
+        """
+        key = self.key(url)
+        meta = {'url': url, 'etag': etag, 'last_modified': last_modified}
+        self._write(self._path(key, 'htm'), body)
+        self._write(self._path(key, 'json'), json.dumps(meta))
+
+    def conditional_headers(self, url: str) -> dict:
+        """
+        Build the If-None-Match/If-Modified-Since headers for a URL.
+
+        Args:
+            url (str): URL about to be requested.
+        Returns:
+            (dict): Request headers. Empty if we have nothing cached.
+        """
+        key = self.key(url)
+        try:
+            with open(self._path(key, 'json'), 'r') as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return {}
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.cache_path, f'{key}.{extension}')
+
+    def _write(self, path: str, content: str):
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as temp_file:
+            temp_file.write(content)
+        os.replace(temp_path, path)
@@ -0,0 +1,94 @@
+"""
+indexstats.py - Measure the size and query speed of an index.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+import os
+from time import perf_counter
+
+from whoosh.qparser import MultifieldParser
+
+import util.functions as FN
+
+# A fixed set of queries so that measurements can be compared between runs.
+QUERIES = [
+    'child support',
+    'divorce',
+    'insupportability',
+    'conservatorship possession access',
+    '"best interest of the child"',
+    'protective order',
+    'theft',
+    'probate court jurisdiction',
+    'definitions',
+    '6.502',
+]
+
+# Misspelled versions of QUERIES, each with the query it should have been,
+# for comparing ways of finding what the user meant.
+TYPO_QUERIES = [
+    ('chlid suport', 'child support'),
+    ('divorse', 'divorce'),
+    ('insuportability', 'insupportability'),
+    ('conservatorshp posession acess', 'conservatorship possession access'),
+    ('protectve ordr', 'protective order'),
+    ('theift', 'theft'),
+    ('probat cuort jurisdicton', 'probate court jurisdiction'),
+    ('definitons', 'definitions'),
+    ('best intrest', 'best interest'),
+    ('famly violance', 'family violence'),
+]
+
+
+def index_size(index_path: str, name: str) -> int:
+    """
+    Returns:
+        (int): Bytes on disk used by an index.
+    """
+    return sum(os.path.getsize(file) for file in FN.index_files(index_path, name))
+
+
+def query_latency(index, queries: list = None, repeat: int = 5, limit: int = 10) -> dict:
+    """
+    Time a set of queries against an index, loading the stored fields of
+    every hit the way a caller displaying results would.
+
+    Args:
+        index (whoosh.index): Open index.
+        queries (list): Query strings. Defaults to QUERIES.
+        repeat (int): Number of times to run the whole set.
+        limit (int): Number of hits to retrieve per query.
+    Returns:
+        (dict): Query count and mean, 50th, 95th and 99th percentile latency in milliseconds.
+    """
+    queries = queries or QUERIES
+    parser = MultifieldParser(['section_name', 'text', 'section_number'], schema=index.schema)
+    timings = []
+    with index.searcher() as searcher:
+        for _ in range(repeat):
+            for query_text in queries:
+                start = perf_counter()
+                for hit in searcher.search(parser.parse(query_text), limit=limit):
+                    hit.fields()
+                timings.append((perf_counter() - start) * 1000)
+    return latency_summary(timings)
+
+
+def latency_summary(timings: list) -> dict:
+    """
+    Summarize a list of latencies, in milliseconds.
+    """
+    if not timings:
+        return {'count': 0, 'mean_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'p99_ms': 0.0}
+    ordered = sorted(timings)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {
+        'count': len(ordered),
+        'mean_ms': sum(ordered) / len(ordered),
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+    }
@@ -0,0 +1,102 @@
+"""
+indexversions.py - Keep each downloaded index in its own folder and switch between them atomically.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+from datetime import datetime
+import fnmatch
+import os
+import shutil
+
+# Never carried over to a new version: Whoosh's lock files and temp files.
+SKIP = ['*_WRITELOCK', '*.tmp']
+
+
+class IndexVersions(object):
+    """
+    Versioned layout for an index folder:
+
+        {INDEX_PATH}                     Symbolic link to the current version
+        {INDEX_PATH}.versions/{version}  One folder per version
+
+    A new version starts as hard links to the files of the current one, so
+    only the files that change take new space, and is made current by
+    replacing the link with os.replace(), which is atomic. A program that
+    opens INDEX_PATH sees either the old version or the new one, never a
+    mix, and files it already has open are not touched.
+    """
+    def __init__(self, index_path: str):
+        self.index_path = index_path.rstrip('/\\')
+        self.versions_path = f'{self.index_path}.versions'
+
+    def current(self) -> str:
+        """
+        Returns:
+            (str): Folder of the current version, or None if there is no index yet.
+        """
+        if not os.path.exists(self.index_path):
+            return None
+        return os.path.realpath(self.index_path)
+
+    def versions(self) -> list:
+        if not os.path.isdir(self.versions_path):
+            return []
+        return sorted(
+            os.path.join(self.versions_path, name) for name in os.listdir(self.versions_path)
+            if os.path.isdir(os.path.join(self.versions_path, name))
+        )
+
+    def new_version(self, link_current: bool = True, names: set = None) -> str:
+        """
+        Make a folder for the next version.
+
+        Args:
+            link_current (bool): Start with hard links to every file of the
+                current version. Only do this if changed files will be replaced
+                (written elsewhere and renamed into place), never rewritten,
+                or the current version would change with them.
+            names (set): Link only the files with these names. Defaults to every file.
+        Returns:
+            (str): Folder of the new version.
+        """
+        os.makedirs(self.versions_path, exist_ok=True)
+        version_path = os.path.join(self.versions_path, datetime.now().strftime('%Y%m%d-%H%M%S-%f'))
+        os.makedirs(version_path)
+        current = self.current()
+        if current and link_current:
+            for name in os.listdir(current):
+                source = os.path.join(current, name)
+                if not os.path.isfile(source) or any(fnmatch.fnmatch(name, pattern) for pattern in SKIP):
+                    continue
+                if names is not None and name not in names:
+                    continue
+                target = os.path.join(version_path, name)
+                try:
+                    os.link(source, target)
+                except OSError:
+                    shutil.copy2(source, target)
+        return version_path
+
+    def activate(self, version_path: str):
+        """
+        Make a version current.
+
+        An index folder from before versioning is moved into the versions
+        folder first. That one time, INDEX_PATH is briefly missing.
+        """
+        if os.path.isdir(self.index_path) and not os.path.islink(self.index_path):
+            os.makedirs(self.versions_path, exist_ok=True)
+            os.rename(self.index_path, os.path.join(self.versions_path, '00000000-000000-000000'))
+        temp_link = f'{self.index_path}.{os.getpid()}.link'
+        os.symlink(os.path.abspath(version_path), temp_link)
+        os.replace(temp_link, self.index_path)
+
+    def prune(self, keep: int = 3):
+        """
+        Delete all but the newest *keep* versions. The current version is always kept.
+        """
+        current = self.current()
+        versions = self.versions()
+        for version_path in versions[:max(0, len(versions) - keep)]:
+            if os.path.realpath(version_path) != current:
+                shutil.rmtree(version_path, ignore_errors=True)
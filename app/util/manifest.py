@@ -0,0 +1,83 @@
+"""
+manifest.py - Remember which chapters of a code actually exist.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+import json
+import os
+from time import time
+
+# A code's whole chapter range is probed again once the last full probe is
+# this old, so chapters added since then are found without --discover.
+REDISCOVER_DAYS = 30
+
+
+class ChapterManifest(object):
+    """
+    List of chapters that returned content the last time we retrieved
+    a code. Most of the numbers between chapter_range_low and
+    chapter_range_high do not exist, so once we have probed them all we
+    write down the ones that do and only ask for those on later runs.
+
+    A chapter is only dropped from the list when the server says it does
+    not exist. One that could not be retrieved for any other reason is
+    kept until a later run can tell.
+    """
+    def __init__(self, manifest_path: str, code_name: str):
+        self.file_name = os.path.join(manifest_path, f'{code_name.lower()}.json')
+        self.code_name = code_name
+        self.chapters = []
+        self.probed = 0
+        try:
+            with open(self.file_name, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+            self.chapters = manifest.get('chapters', [])
+            self.probed = manifest.get('probed', 0)
+        except (OSError, ValueError, AttributeError):
+            self.chapters = []
+            self.probed = 0
+
+    def stale(self) -> bool:
+        """
+        Returns:
+            (bool): True if the whole chapter range should be probed again.
+        """
+        return not self.chapters or time() - self.probed > REDISCOVER_DAYS * 24 * 60 * 60
+
+    def update(self, requested: list, found: list, not_found: set, full_probe: bool = False):
+        """
+        Record the outcome of a run and write the list to disk.
+
+        Args:
+            requested (list): Chapters this run asked for, in retrieval order.
+            found (list): Chapters that returned content.
+            not_found (set): Chapters the server said do not exist.
+            full_probe (bool): True if requested was the code's whole chapter range.
+        """
+        found = set(found)
+        chapters = [chapter for chapter in requested if chapter in found]
+        chapters += [chapter for chapter in self.chapters if chapter not in found and chapter not in not_found]
+        position = {chapter: i for i, chapter in enumerate(requested)}
+        chapters.sort(key=lambda chapter: position.get(chapter, len(position)))
+        self.save(chapters, time() if full_probe else self.probed)
+
+    def save(self, chapters: list, probed: float = None):
+        """
+        Replace the list of known chapters and write it to disk.
+
+        Args:
+            chapters (list): Chapters that exist, in retrieval order.
+            probed (float): When the whole chapter range was last probed. Unchanged if None.
+        """
+        self.chapters = list(chapters)
+        if probed is not None:
+            self.probed = probed
+        os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+        temp_name = f'{self.file_name}.tmp'
+        with open(temp_name, 'w') as manifest_file:
+            json.dump(
+                {'code_name': self.code_name, 'probed': self.probed, 'chapters': self.chapters},
+                manifest_file,
+                indent=4
+            )
+        os.replace(temp_name, self.file_name)
@@ -0,0 +1,187 @@
+"""
+metrics.py - Count and time what the app does, and report it as JSON or in Prometheus' text format.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+import cProfile
+from contextlib import contextmanager
+import json
+import os
+import threading
+from time import perf_counter, time
+import tracemalloc
+
+
+class Metrics(object):
+    """
+    Counters and stage timers for everything the process does:
+
+        METRICS.count('chapters_fetched')
+        METRICS.count('bytes_fetched', len(body))
+        with METRICS.timer('index.commit'):
+            writer.commit()
+
+    Each stage records how many times it ran, the seconds it took in all,
+    and its longest single run. Recording takes a lock and a dict update,
+    so it is always on; nothing is written unless write() is called.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time()
+        self.counters = {}
+        self.stages = {}
+        self.memory = None
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_time(self, stage: str, seconds: float, calls: int = 1):
+        """
+        Record time spent in a stage.
+
+        Args:
+            stage (str): Name of the stage, e.g. 'fetch' or 'index.commit'.
+            seconds (float): Time spent.
+            calls (int): Number of runs the time covers, if it is a total kept elsewhere.
+        """
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+            entry['calls'] += calls
+            entry['seconds'] += seconds
+            if calls == 1:
+                entry['max_seconds'] = max(entry['max_seconds'], seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, perf_counter() - start)
+
+    def merge(self, report: dict):
+        """
+        Add in the counters and stage times of a report from another process.
+        """
+        with self.lock:
+            for name, value in report.get('counters', {}).items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, other in report.get('stages', {}).items():
+                entry = self.stages.get(name)
+                if entry is None:
+                    entry = self.stages[name] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+                entry['calls'] += other['calls']
+                entry['seconds'] += other['seconds']
+                entry['max_seconds'] = max(entry['max_seconds'], other['max_seconds'])
+
+    def reset(self):
+        with self.lock:
+            self.started = time()
+            self.counters = {}
+            self.stages = {}
+            self.memory = None
+
+    def report(self) -> dict:
+        with self.lock:
+            report = {
+                'started': self.started,
+                'elapsed_seconds': time() - self.started,
+                'counters': dict(sorted(self.counters.items())),
+                'stages': {name: dict(entry) for name, entry in sorted(self.stages.items())},
+            }
+            if self.memory:
+                report['memory'] = self.memory
+        return report
+
+    def prometheus(self, prefix: str = 'code2json') -> str:
+        """
+        Returns:
+            (str): Every metric in Prometheus' text exposition format.
+        """
+        report = self.report()
+        lines = []
+        for name, value in report['counters'].items():
+            metric = f'{prefix}_{metric_name(name)}_total'
+            lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+        for suffix, field, kind in (('seconds_total', 'seconds', 'counter'), ('calls_total', 'calls', 'counter'),
+                                    ('max_seconds', 'max_seconds', 'gauge')):
+            if not report['stages']:
+                break
+            metric = f'{prefix}_stage_{suffix}'
+            lines.append(f'# TYPE {metric} {kind}')
+            for name, entry in report['stages'].items():
+                lines.append(f'{metric}{{stage="{name}"}} {entry[field]}')
+        if report.get('memory'):
+            metric = f'{prefix}_traced_memory_peak_bytes'
+            lines += [f'# TYPE {metric} gauge', f"{metric} {report['memory']['peak_bytes']}"]
+        metric = f'{prefix}_elapsed_seconds'
+        lines += [f'# TYPE {metric} gauge', f"{metric} {report['elapsed_seconds']}"]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, file_name: str):
+        """
+        Write the report. A file name ending in .prom gets Prometheus' text
+        format, for node_exporter's textfile collector; anything else gets
+        JSON. The file is replaced in one step so a collector never reads
+        half of it.
+        """
+        if file_name.endswith('.prom'):
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.report(), indent=4)
+        temp_name = f'{file_name}.tmp'
+        with open(temp_name, 'w') as metrics_file:
+            metrics_file.write(content)
+        os.replace(temp_name, file_name)
+
+
+def metric_name(name: str) -> str:
+    return ''.join(c if c.isalnum() else '_' for c in name)
+
+
+@contextmanager
+def capture(profile_file: str = None, trace_memory: bool = False, metrics: Metrics = None):
+    """
+    Run a block of code under cProfile, tracemalloc, or both.
+
+    cProfile sees only the thread that entered the block; work done in
+    pipeline or worker threads shows up in the stage timers instead.
+
+    Args:
+        profile_file (str): Where to write the profile, for pstats or snakeviz. None to not profile.
+        trace_memory (bool): Whether to trace allocations. The peak and the
+            ten lines holding the most memory at the end go into the metrics report.
+        metrics (Metrics): Where to record memory. Defaults to METRICS.
+    """
+    metrics = metrics or METRICS
+    profiler = None
+    if profile_file:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            metrics.memory = {
+                'peak_bytes': peak,
+                'current_bytes': current,
+                'top': [
+                    {'line': str(stat.traceback), 'bytes': stat.size, 'blocks': stat.count}
+                    for stat in snapshot.statistics('lineno')[:10]
+                ],
+            }
+
+
+# One set of metrics for the whole process.
+METRICS = Metrics()
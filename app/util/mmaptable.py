@@ -0,0 +1,252 @@
+"""
+mmaptable.py - Read-only hash table on disk, looked up through mmap.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from time import sleep
+
+MAGIC = b'MMT2'
+HEADER = struct.Struct('<4s8sQ')   # magic, token shared with the .dat, number of slots
+DAT_HEADER = struct.Struct('<4s8s')  # magic, token shared with the .idx
+NO_TOKEN = bytes(8)                # placeholder until write_table() stamps the real one
+SLOT = struct.Struct('<QQI')       # key hash, record offset, record length
+
+# How many times to open a table again when its two files are from different writes.
+OPEN_ATTEMPTS = 3
+
+
+def key_hash(key: bytes) -> int:
+    # Zero marks an empty slot, so no key may hash to it.
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') or 1
+
+
+def write_table(path: str, data: bytearray, index: bytearray) -> bool:
+    """
+    Move a table's two files into place as {path}.dat and {path}.idx. Both
+    must start with a 4-byte magic and an 8-byte token (NO_TOKEN until now).
+    The token is a hash of everything after the two headers' tokens, so a
+    table written again from the same sections is byte-for-byte the same,
+    and is not written at all when the files on disk already carry it.
+
+    Args:
+        path (str): Table path without extension.
+        data (bytearray): Contents of the .dat file.
+        index (bytearray): Contents of the .idx file.
+    Returns:
+        (bool): True if the files were written, False if they were unchanged.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for content in (data, index):
+        digest.update(content[:4])
+        digest.update(content[12:])
+    token = digest.digest()
+    data[4:12] = token
+    index[4:12] = token
+
+    try:
+        with open(f'{path}.dat', 'rb') as dat_file, open(f'{path}.idx', 'rb') as idx_file:
+            if dat_file.read(12) == data[:12] and idx_file.read(12) == index[:12]:
+                return False
+    except FileNotFoundError:
+        pass
+
+    # A reader that opens the table between these two moves pairs the
+    # old index with the new data, whose records are not where the index
+    # says. The readers see that the tokens differ and open it again.
+    for extension, content in (('dat', data), ('idx', index)):
+        temp_name = f'{path}.{extension}.{os.getpid()}.tmp'
+        with open(temp_name, 'wb') as table_file:
+            table_file.write(content)
+        os.replace(temp_name, f'{path}.{extension}')
+    return True
+
+
+class MmapTableWriter(object):
+    """
+    Collects key/value pairs and writes them as an MmapTable:
+
+        {path}.dat - A header, then records, one after another, each the key,
+                     a NUL byte and the value.
+        {path}.idx - A header and an open-addressing table of slots, each the
+                     key's hash and the offset and length of its record.
+
+    Both files are written to temporary names and moved into place, so a
+    reader never sees half a table. Both headers hold the same token, a hash
+    of the table's contents, so a reader can tell when it has the files of
+    two different writes. See write_table().
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.items = {}
+
+    def add(self, key: str, value: bytes):
+        self.items[key.encode('utf-8')] = value
+
+    def save(self) -> bool:
+        """
+        Returns:
+            (bool): True if the table was written, False if it was unchanged.
+        """
+        slot_count = 8
+        while slot_count < len(self.items) * 2:
+            slot_count *= 2
+        slots = bytearray(HEADER.size + SLOT.size * slot_count)
+        HEADER.pack_into(slots, 0, MAGIC, NO_TOKEN, slot_count)
+
+        # Sorted, so the same pairs always make the same files whatever order
+        # they were added in.
+        data = bytearray(DAT_HEADER.pack(MAGIC, NO_TOKEN))
+        for key, value in sorted(self.items.items()):
+            record = key + b'\0' + value
+            hashed = key_hash(key)
+            slot = hashed & (slot_count - 1)
+            while SLOT.unpack_from(slots, HEADER.size + slot * SLOT.size)[0]:
+                slot = (slot + 1) & (slot_count - 1)
+            SLOT.pack_into(slots, HEADER.size + slot * SLOT.size, hashed, len(data), len(record))
+            data += record
+        return write_table(self.path, data, slots)
+
+
+class MmapTable(object):
+    """
+    Looks keys up in a table written by MmapTableWriter. Both files are
+    memory-mapped, so opening a table reads nothing and a lookup touches
+    only the slots it probes and the one record it returns.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.maps = []
+        for attempt in range(OPEN_ATTEMPTS):
+            self.index = self._map(f'{path}.idx')
+            self.data = self._map(f'{path}.dat')
+            if len(self.index) < HEADER.size:
+                self.close()
+                raise ValueError(f"{path}.idx is not an MmapTable index")
+            magic, token, self.slot_count = HEADER.unpack_from(self.index, 0)
+            if magic != MAGIC:
+                self.close()
+                raise ValueError(f"{path}.idx is not an MmapTable index")
+            if self.data[:DAT_HEADER.size] == DAT_HEADER.pack(MAGIC, token):
+                return
+            # The table is being replaced and we have one file of each write.
+            self.close()
+            sleep(0.01 * (attempt + 1))
+        raise ValueError(f"{path}.idx does not match {path}.dat")
+
+    def _map(self, file_name: str):
+        with open(file_name, 'rb') as table_file:
+            if os.fstat(table_file.fileno()).st_size == 0:
+                return b''
+            table_map = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps.append(table_map)
+        return table_map
+
+    def get(self, key: str) -> bytes:
+        """
+        Returns:
+            (bytes): The value stored under key, or None.
+        """
+        key = key.encode('utf-8')
+        hashed = key_hash(key)
+        mask = self.slot_count - 1
+        slot = hashed & mask
+        for _ in range(self.slot_count):
+            slot_hash, offset, length = SLOT.unpack_from(self.index, HEADER.size + slot * SLOT.size)
+            if not slot_hash:
+                return None
+            if slot_hash == hashed and self.data[offset:offset + len(key) + 1] == key + b'\0':
+                return self.data[offset + len(key) + 1:offset + length]
+            slot = (slot + 1) & mask
+        return None
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def close(self):
+        for table_map in self.maps:
+            table_map.close()
+        self.maps = []
+
+
+class CodeTables(object):
+    """
+    One table per code, {index_path}/{code}-{kind}. Tables are opened
+    the first time they are needed and forgotten when refresh() finds that
+    one has been rewritten.
+
+    Args:
+        index_path (str): Directory holding the tables.
+        kind (str): What the tables hold, e.g. 'citations'.
+        table_class (type): Reader for a {path}.idx/{path}.dat pair. Defaults to MmapTable.
+    """
+    def __init__(self, index_path: str, kind: str, table_class: type = None):
+        self.index_path = index_path
+        self.kind = kind
+        self.table_class = table_class or MmapTable
+        self.lock = threading.Lock()
+        self.tables = {}
+
+    def path(self, code_name: str) -> str:
+        return os.path.join(self.index_path, f'{code_name.lower()}-{self.kind}')
+
+    def code_names(self) -> list:
+        suffix = f'-{self.kind}.idx'
+        return sorted(
+            file[:-len(suffix)].upper() for file in os.listdir(self.index_path) if file.endswith(suffix)
+        ) if os.path.isdir(self.index_path) else []
+
+    def get(self, code_name: str):
+        """
+        Returns:
+            (table_class): The code's table, or None if it has none.
+        """
+        with self.lock:
+            entry = self.tables.get(code_name)
+            if entry is None:
+                path = self.path(code_name)
+                try:
+                    inode = os.stat(f'{path}.idx').st_ino
+                    entry = self.tables[code_name] = (self.table_class(path), inode)
+                except (FileNotFoundError, ValueError):
+                    return None
+            return entry[0]
+
+    def refresh(self) -> bool:
+        """
+        Forget every table that has been rewritten since it was opened. The
+        tables are not closed, since another thread may be reading one; each
+        is unmapped once the last reference to it goes away.
+
+        Returns:
+            (bool): True if any table was forgotten.
+        """
+        changed = False
+        with self.lock:
+            for code_name, (table, inode) in list(self.tables.items()):
+                try:
+                    current = os.stat(f'{table.path}.idx').st_ino
+                except FileNotFoundError:
+                    current = None
+                if current != inode:
+                    del self.tables[code_name]
+                    changed = True
+        return changed
+
+    def close(self):
+        with self.lock:
+            for table, _ in self.tables.values():
+                table.close()
+            self.tables.clear()
+
+
+def remove_table(path: str):
+    for extension in ('idx', 'dat'):
+        try:
+            os.remove(f'{path}.{extension}')
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,162 @@
+"""
+pipeline.py - Run work through a chain of stages connected by bounded queues.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+import queue
+import threading
+from time import perf_counter
+
+# Put on a queue to tell the stage reading it that no more items are coming.
+_DONE = object()
+
+
+class Stage(object):
+    """
+    One step of a Pipeline, plus the counters that tell us where time goes:
+
+        items   - Items this stage finished.
+        busy    - Seconds spent doing the stage's work.
+        starved - Seconds spent waiting for the previous stage.
+        blocked - Seconds spent waiting for the next stage to make room.
+    """
+    def __init__(self, name: str, function, threads: int = 1):
+        self.name = name
+        self.function = function
+        self.threads = max(1, threads)
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    def count(self, busy: float = 0.0, starved: float = 0.0, blocked: float = 0.0, items: int = 0):
+        with self.lock:
+            self.items += items
+            self.busy += busy
+            self.starved += starved
+            self.blocked += blocked
+
+    def report(self, elapsed: float) -> str:
+        rate = self.items / self.busy if self.busy else 0.0
+        return (
+            f"{self.name:>10}: {self.items:6d} items {self.busy:9.2f}s busy {rate:8.1f}/s "
+            f"{self.starved:9.2f}s starved {self.blocked:9.2f}s blocked "
+            f"({self.threads} thread{'s' if self.threads > 1 else ''})"
+        )
+
+
+class Pipeline(object):
+    """
+    Feed items from a source iterator through a series of stages. Each stage
+    runs in its own thread(s) and talks to its neighbours through queues that
+    hold at most *queue_size* items, so a fast stage waits for a slow one
+    instead of piling up work in memory, and network I/O in the source
+    overlaps with CPU work in the later stages.
+
+    Each stage's function takes one item and returns the item to hand to the
+    next stage, or None to drop it.
+    """
+    def __init__(self, source_name: str, source, queue_size: int = 2):
+        self.source = Stage(source_name, None)
+        self.source_iter = source
+        self.queue_size = queue_size
+        self.stages = []
+        self.error = None
+        self.elapsed = 0.0
+
+    def add_stage(self, name: str, function, threads: int = 1):
+        self.stages.append(Stage(name, function, threads))
+        return self
+
+    def run(self):
+        """
+        Run every item through every stage and wait for the last one to finish.
+        Re-raises the first exception any stage raised.
+        """
+        start = perf_counter()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads = [threading.Thread(target=self._produce, args=(queues[0] if queues else None,), daemon=True)]
+        remaining = [stage.threads for stage in self.stages]
+        remaining_lock = threading.Lock()
+
+        for i, stage in enumerate(self.stages):
+            outbox = queues[i + 1] if i + 1 < len(queues) else None
+            for _ in range(stage.threads):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(i, stage, queues[i], outbox, remaining, remaining_lock),
+                    daemon=True
+                ))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = perf_counter() - start
+
+        if self.error:
+            raise self.error
+
+    def report(self) -> str:
+        lines = [self.source.report(self.elapsed)]
+        lines += [stage.report(self.elapsed) for stage in self.stages]
+        lines.append(f"{'elapsed':>10}: {self.elapsed:.2f}s")
+        return '\n'.join(lines)
+
+    def _produce(self, outbox):
+        source = iter(self.source_iter)
+        while not self.error:
+            start = perf_counter()
+            try:
+                item = next(source, _DONE)
+            except Exception as e:
+                self.error = self.error or e
+                item = _DONE
+            fetched = perf_counter()
+            if item is _DONE:
+                break
+            if outbox is not None:
+                outbox.put(item)
+            self.source.count(busy=fetched - start, blocked=perf_counter() - fetched, items=1)
+        # A stage failed: stop pulling from the source, e.g. fetching the
+        # rest of a code only to throw it away, and let it clean up.
+        close = getattr(source, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception as e:
+                self.error = self.error or e
+        if outbox is not None:
+            for _ in range(self.stages[0].threads):
+                outbox.put(_DONE)
+
+    def _work(self, index: int, stage: Stage, inbox, outbox, remaining: list, remaining_lock):
+        while True:
+            start = perf_counter()
+            item = inbox.get()
+            started = perf_counter()
+            if item is _DONE:
+                break
+            if self.error:
+                # Keep draining so upstream stages never block forever.
+                continue
+            try:
+                result = stage.function(item)
+            except Exception as e:
+                self.error = self.error or e
+                result = None
+            item = None
+            finished = perf_counter()
+            if result is not None and outbox is not None:
+                outbox.put(result)
+            stage.count(busy=finished - started, starved=started - start, blocked=perf_counter() - finished, items=1)
+        stage.count(starved=perf_counter() - start)
+
+        # The last thread of this stage to finish tells the next stage.
+        with remaining_lock:
+            remaining[index] -= 1
+            last = remaining[index] == 0
+        if last and outbox is not None:
+            for _ in range(self.stages[index + 1].threads):
+                outbox.put(_DONE)
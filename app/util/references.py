@@ -0,0 +1,215 @@
+"""
+references.py - Find the sections and chapters each section refers to, and who refers to whom.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+import os
+import re
+
+from util.citations import CitationIndex
+import util.functions as FN
+from util.mmaptable import CodeTables, MmapTableWriter, remove_table
+
+# A section or chapter number, possibly followed by subsections: 6.502, 42A.054(a)(1), 153, 21A.
+NUMBER = r'\d+[A-Z]?(?:\.\d+[A-Za-z0-9]*)?(?:\([A-Za-z0-9]+\))*'
+
+# "Section 6.502", "Sections 6.502, 6.503, and 6.504", "Chapter 85, Family Code",
+# "Article 42.12, Code of Criminal Procedure". Only the spelled-out words are
+# matched, so the "Sec." and "ch." of legislative history are not.
+REFERENCE_PATTERN = re.compile(
+    rf'\b(Sections?|Articles?|Chapters?)\s+({NUMBER}(?:(?:,\s*|\s+)(?:(?:and|or|through)\s+)?{NUMBER})*)'
+    r'(?:,\s+((?:[A-Z][A-Za-z]*\s+(?:(?:and|&|&amp;)\s+)?){1,3}Code|Code of Criminal Procedure)\b)?'
+)
+NUMBER_PATTERN = re.compile(NUMBER)
+
+_code_abbreviations = None
+
+
+def chapter_id(code_name: str, chapter: str) -> str:
+    """
+    ID of a chapter in the reference graph, e.g. FA:Ch.153. Sections use FN.doc_id().
+    """
+    return f'{code_name.upper()}:Ch.{chapter}'
+
+
+def code_abbreviations() -> dict:
+    """
+    Returns:
+        (dict): Code names as they appear in statute text, lower case
+                (e.g. "family code", "health and safety code"), to code abbreviations.
+    """
+    global _code_abbreviations
+    if _code_abbreviations is None:
+        names = {}
+        for code in FN.configured_codes():
+            config = FN.code_config(code)
+            for name in (config.get('code_full_name', ''), f"{config.get('code_short_name', '')} Code"):
+                name = re.sub(r'^Texas\s+', '', name.replace('&amp;', '&'))
+                for variant in (name, name.replace('&', 'and')):
+                    names[' '.join(variant.lower().split())] = config['code_name'].upper()
+        _code_abbreviations = names
+    return _code_abbreviations
+
+
+def extract_references(text: str, code_name: str) -> list:
+    """
+    Find the sections and chapters a piece of statute text refers to.
+
+    Args:
+        text (str): Text of a section.
+        code_name (str): Code the text belongs to, for references that do not name one.
+    Returns:
+        (list): IDs of the sections and chapters referred to, in order of first
+                mention, e.g. ['FA:6.502', 'FA:Ch.153', 'PE:12.35']. References to
+                codes we do not keep are left out.
+    """
+    references = []
+    for kind, numbers, code in REFERENCE_PATTERN.findall(text or ''):
+        if code:
+            target_code = code_abbreviations().get(' '.join(code.replace('&amp;', '&').lower().split()))
+            if target_code is None:
+                continue
+        else:
+            target_code = code_name.upper()
+        for number in NUMBER_PATTERN.findall(numbers):
+            number = number.split('(', 1)[0]
+            if kind.startswith('Chapter'):
+                if '.' in number:
+                    continue
+                reference = chapter_id(target_code, number)
+            else:
+                if '.' not in number:
+                    continue
+                reference = FN.doc_id(target_code, number)
+            if reference not in references:
+                references.append(reference)
+    return references
+
+
+def references_path(code_name: str, index_path: str = None) -> str:
+    return os.path.join(index_path or FN.INDEX_PATH, f'{code_name.lower()}-references')
+
+
+def build_references(code_name: str, chapters, index_path: str = None) -> int:
+    """
+    Write the reference table for one code from its sections:
+
+        >{id}   The sections and chapters section {id} refers to.
+        <{id}   The sections of this code that refer to section or chapter {id},
+                which may be in another code.
+        #{id}   Present for every chapter {id} of this code.
+
+    Values are IDs separated by newlines. References within the code are
+    kept only if the section or chapter exists. References to other codes
+    are kept as they are and checked when they are looked up, so the order
+    in which codes are indexed does not matter.
+
+    Each section's references are taken from its 'references' field, which
+    converter.classify_text() fills in, so only chapters that were fetched
+    again are searched again. Sections saved before that field existed are
+    searched here.
+
+    Args:
+        code_name (str): Code abbreviation from the code's config file.
+        chapters (iterable): The list of sections of every chapter of the code.
+        index_path (str): Directory for the table. Defaults to INDEX_PATH.
+    Returns:
+        (int): Number of references written.
+    """
+    code_name = code_name.upper()
+    section_numbers = set()
+    extracted = []
+    for chapter in chapters:
+        for section in chapter or []:
+            section_number = section.get('section_number')
+            if not section_number:
+                continue
+            section_numbers.add(section_number)
+            references = section.get('references')
+            if references is None:
+                references = extract_references(section.get('text'), code_name)
+            extracted.append((FN.doc_id(code_name, section_number), references))
+    chapters = {chapter_id(code_name, number.split('.', 1)[0]) for number in section_numbers}
+
+    forward = {}
+    reverse = {}
+    for source, references in extracted:
+        targets = forward.setdefault(source, [])
+        for target in references:
+            target_code, target_number = target.split(':', 1)
+            if target == source or target in targets:
+                continue
+            if target_code == code_name:
+                if target.startswith(f'{code_name}:Ch.') and target not in chapters:
+                    continue
+                if not target_number.startswith('Ch.') and target_number not in section_numbers:
+                    continue
+            targets.append(target)
+            reverse.setdefault(target, []).append(source)
+
+    writer = MmapTableWriter(references_path(code_name, index_path))
+    for source, targets in forward.items():
+        if targets:
+            writer.add(f'>{source}', '\n'.join(targets).encode('utf-8'))
+    for target, sources in reverse.items():
+        writer.add(f'<{target}', '\n'.join(sources).encode('utf-8'))
+    for chapter in chapters:
+        writer.add(f'#{chapter}', b'')
+    writer.save()
+    return sum(len(sources) for sources in reverse.values())
+
+
+def remove_references(code_name: str, index_path: str = None):
+    remove_table(references_path(code_name, index_path))
+
+
+class ReferenceIndex(object):
+    """
+    The reference tables of every indexed code. cites() reads one record
+    from the citing section's code; cited_by() reads one from each code.
+    """
+    def __init__(self, index_path: str = None, citations: CitationIndex = None):
+        self.index_path = index_path or FN.INDEX_PATH
+        self.tables = CodeTables(self.index_path, 'references')
+        self.citations = citations or CitationIndex(self.index_path)
+
+    def cites(self, reference_id: str) -> list:
+        """
+        Returns:
+            (list): IDs of the sections and chapters that section *reference_id* refers to.
+        """
+        table = self.tables.get(reference_id.split(':', 1)[0])
+        value = table.get(f'>{reference_id}') if table else None
+        if not value:
+            return []
+        code_name = reference_id.split(':', 1)[0]
+        return [
+            target for target in value.decode('utf-8').split('\n')
+            if target.startswith(f'{code_name}:') or self.exists(target)
+        ]
+
+    def cited_by(self, reference_id: str) -> list:
+        """
+        Returns:
+            (list): IDs of the sections that refer to section or chapter *reference_id*.
+        """
+        sources = []
+        for code_name in self.tables.code_names():
+            table = self.tables.get(code_name)
+            value = table.get(f'<{reference_id}') if table else None
+            if value:
+                sources += value.decode('utf-8').split('\n')
+        return sources
+
+    def exists(self, reference_id: str) -> bool:
+        code_name, number = reference_id.split(':', 1)
+        if number.startswith('Ch.'):
+            table = self.tables.get(code_name)
+            return table is not None and f'#{reference_id}' in table
+        return self.citations.contains(code_name, number)
+
+    def refresh(self) -> bool:
+        return self.tables.refresh()
+
+    def close(self):
+        self.tables.close()
@@ -3,39 +3,159 @@ retriever.py - Retrieve text of statutes
 
 Copyright (c) 2020 by Thomas J. Daley, J.D.
 """
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import threading
+from time import sleep, monotonic
+from urllib.parse import urlparse
+
 import requests
-from time import sleep
+from requests.adapters import HTTPAdapter
+
+from util.httpcache import HttpCache
+from util.metrics import METRICS
+
+
+class RateLimiter(object):
+    """
+    Space out requests to each host so that we never send more than
+    *rate* requests per second to any one of them, no matter how many
+    worker threads are asking.
+    """
+    def __init__(self, rate: float = None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, url: str):
+        if not self.interval:
+            return
+        host = urlparse(url).netloc
+        with self.lock:
+            now = monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            sleep(slot - now)
 
 
 class Retriever(object):
-    def __init__(self, base_url: str, code_abbreviation: str):
+    def __init__(self, base_url: str, code_abbreviation: str, workers: int = 1, rate_limit: float = None,
+                 timeout: float = 60, cache: HttpCache = None, offline: bool = False):
         self.base_url = base_url
         self.code_abbreviation = code_abbreviation
+        self.cache = cache
+        self.offline = offline
+        self.workers = max(1, workers or 1)
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(rate_limit)
+        # Chapters the server said do not exist, as opposed to ones we
+        # could not get this time (timeouts, errors, offline misses).
+        self.not_found = set()
+
+        # One keep-alive connection pool, shared by every worker thread.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
-    def retrieve(self, chapter: int) -> str:
+    def retrieve(self, chapter: int, verbose: bool = True) -> str:
+        with METRICS.timer('fetch'):
+            return self._retrieve(chapter, verbose)
+
+    def _retrieve(self, chapter: int, verbose: bool) -> str:
         url = self.make_url(chapter)
-        print(url, end=" - ")
+        if verbose:
+            print(url, end=" - ")
+
+        # Offline mode: serve only what we already have.
+        if self.offline:
+            entry = self.cache.get(url) if self.cache else None
+            if verbose:
+                print("cached" if entry else "not cached", end=" - ")
+            METRICS.count('offline_hits' if entry else 'offline_misses')
+            return entry['body'] if entry else None
+
+        headers = self.cache.conditional_headers(url) if self.cache else {}
         retry = True
         retry_remaining = 5
-        while retry:
+        while retry and retry_remaining > 0:
             try:
                 retry_remaining -= 1
-                response = requests.get(url)
+                self.rate_limiter.wait(url)
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
                 retry = False
-                print(response.status_code, end=" - ")
+                if verbose:
+                    print(response.status_code, end=" - ")
+                METRICS.count(f'http_{response.status_code}')
+                if response.status_code == 304:
+                    entry = self.cache.get(url)
+                    if entry:
+                        METRICS.count('chapters_fetched')
+                        return entry['body']
+                    # Validators without a body? Ask again, unconditionally.
+                    headers = {}
+                    retry = True
+                    METRICS.count('retries')
+                    continue
+                METRICS.count('bytes_fetched', len(response.content))
+                if response.status_code == 200 and self.cache:
+                    self.cache.put(
+                        url,
+                        response.text,
+                        etag=response.headers.get('ETag'),
+                        last_modified=response.headers.get('Last-Modified')
+                    )
                 if response.status_code != 404:
+                    METRICS.count('chapters_fetched')
                     return response.text
-            except ConnectionResetError as e:
-                print(str(e))
-                sleep(5)
-            except ConnectionError as e:
+                self.not_found.add(chapter)
+            except (ConnectionResetError, ConnectionError, requests.exceptions.ConnectionError) as e:
                 print(str(e))
+                METRICS.count('retries')
                 sleep(5)
             except Exception as e:
                 print(str(e))
+                METRICS.count('fetch_errors')
                 retry = False
 
         return None
 
+    def retrieve_all(self, chapters: list, verbose: bool = True):
+        """
+        Retrieve a list of chapters, yielding each one as soon as it arrives.
+
+        With one worker, chapters are retrieved in order, exactly as calling
+        retrieve() in a loop would. With more workers, chapters are retrieved
+        concurrently and yielded in the order they complete. No more than
+        twice the number of workers are in flight at any time so that a slow
+        consumer does not cause the whole code to pile up in memory.
+
+        Args:
+            chapters (list): Chapter numbers to retrieve.
+            verbose (bool): Whether to print each URL and status code when retrieving serially.
+        Yields:
+            (tuple): (chapter, html_content) where html_content is None if the
+                     chapter could not be retrieved.
+        """
+        if self.workers == 1:
+            for chapter in chapters:
+                yield chapter, self.retrieve(chapter, verbose)
+            return
+
+        pending = iter(chapters)
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                while len(in_flight) < self.workers * 2:
+                    chapter = next(pending, None)
+                    if chapter is None:
+                        break
+                    in_flight[executor.submit(self.retrieve, chapter, False)] = chapter
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield in_flight.pop(future), future.result()
+
     def make_url(self, chapter: int) -> str:
         return f'{self.base_url}/Docs/{self.code_abbreviation}/htm/{self.code_abbreviation}.{chapter}.htm'
@@ -0,0 +1,284 @@
+"""
+s3sync.py - Copy a folder to and from S3, moving only the files that changed.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import fnmatch
+import hashlib
+from datetime import datetime, timedelta, timezone
+import json
+import os
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+# Files that must never be shipped: Whoosh's lock files, our temp files and our own state.
+EXCLUDE = ['*_WRITELOCK', '*.tmp', '.s3sync-*']
+
+# Whoosh opens the newest table of contents it finds, so these go last on
+# the way down, after every segment they refer to.
+LAST = ['*.toc', '*.idx']
+
+# Objects this new are never removed, so an upload that has sent its objects
+# but not yet written its manifest keeps them.
+GRACE_PERIOD = timedelta(days=1)
+
+
+class S3Sync(object):
+    """
+    Mirrors a set of local files through S3 as content-addressed objects:
+
+        {prefix}/objects/{sha256}       One object per distinct file content.
+        {prefix}/trees/{tree}.json      Manifest: relative path -> {hash, size}.
+        {prefix}/previous/{tree}.json   The manifest it replaced.
+
+    Uploading sends only the files whose content is not in the tree's last
+    manifest, then writes the new manifest, so a reader never sees a
+    manifest that refers to an object that is not there yet. It then
+    deletes the objects that neither manifest of any tree refers to, so a
+    reader still downloading the previous version finds every object it
+    needs, and objects younger than GRACE_PERIOD are kept. Downloading
+    fetches only the files whose hash differs from the local copy and
+    removes the files that a previous download brought in but the new
+    manifest no longer lists. Files are transferred in parallel, and large
+    files in parallel parts.
+
+    The hash of each local file is remembered, with its size and mtime, in
+    {folder}/.s3sync-{tree}.json, so unchanged files are not read again.
+    """
+    def __init__(self, s3_client, bucket: str, prefix: str = 'sync', workers: int = 8,
+                 multipart_threshold: int = 8 * 1024 * 1024):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.workers = max(1, workers)
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_threshold,
+            max_concurrency=self.workers
+        )
+
+    def upload(self, tree: str, folder: str, files: list = None) -> dict:
+        """
+        Upload a folder, or some of the files in it.
+
+        Args:
+            tree (str): Name of this set of files in S3, e.g. 'index'.
+            folder (str): Local folder.
+            files (list): Paths of the files to upload. Defaults to every file in folder.
+        Returns:
+            (dict): Number of files and bytes uploaded and skipped, and of objects deleted.
+        """
+        if files is None:
+            files = [os.path.join(folder, name) for name in os.listdir(folder)]
+        files = [file for file in files if os.path.isfile(file) and not excluded(file)]
+        hashes = LocalHashes(folder, tree)
+        manifest = {
+            os.path.relpath(file, folder).replace(os.sep, '/'): {'hash': hashes.get(file), 'size': os.path.getsize(file)}
+            for file in files
+        }
+        hashes.save()
+
+        remote = self.manifest(tree) or {}
+        remote_hashes = {entry['hash'] for entry in remote.values()}
+        to_send = {}
+        for path, entry in manifest.items():
+            if entry['hash'] not in remote_hashes and entry['hash'] not in to_send:
+                to_send[entry['hash']] = os.path.join(folder, path)
+
+        self._parallel(
+            lambda item: self.s3_client.upload_file(item[1], self.bucket, self._object_key(item[0]),
+                                                    Config=self.transfer_config),
+            to_send.items()
+        )
+        if remote:
+            self.s3_client.put_object(
+                Bucket=self.bucket, Key=self._previous_key(tree), Body=json.dumps(remote).encode('utf-8')
+            )
+        self.s3_client.put_object(
+            Bucket=self.bucket, Key=self._tree_key(tree), Body=json.dumps(manifest).encode('utf-8')
+        )
+        deleted = self.collect_garbage()
+        sent_bytes = sum(os.path.getsize(file) for file in to_send.values())
+        return {
+            'files': len(manifest), 'sent': len(to_send), 'sent_bytes': sent_bytes,
+            'skipped_bytes': sum(entry['size'] for entry in manifest.values()) - sent_bytes,
+            'deleted': deleted
+        }
+
+    def collect_garbage(self, grace_period: timedelta = GRACE_PERIOD) -> int:
+        """
+        Delete the objects that no current or previous manifest refers to
+        and that are older than grace_period.
+
+        Returns:
+            (int): Number of objects deleted.
+        """
+        referenced = set()
+        for key in self._keys(f'{self.prefix}/trees/') + self._keys(f'{self.prefix}/previous/'):
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=key['Key'])
+            referenced.update(entry['hash'] for entry in json.loads(response['Body'].read()).values())
+
+        cutoff = datetime.now(timezone.utc) - grace_period
+        garbage = [
+            key['Key'] for key in self._keys(f'{self.prefix}/objects/')
+            if key['Key'].rsplit('/', 1)[-1] not in referenced and key['LastModified'] < cutoff
+        ]
+        # delete_objects() takes at most 1,000 keys.
+        for start in range(0, len(garbage), 1000):
+            self.s3_client.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': key} for key in garbage[start:start + 1000]], 'Quiet': True}
+            )
+        return len(garbage)
+
+    def _keys(self, prefix: str) -> list:
+        keys = []
+        for page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix):
+            keys += page.get('Contents', [])
+        return keys
+
+    def download(self, tree: str, folder: str) -> dict:
+        """
+        Bring a local folder up to date with a tree in S3.
+
+        Args:
+            tree (str): Name of the set of files in S3, e.g. 'index'.
+            folder (str): Local folder.
+        Returns:
+            (dict): Number of files and bytes downloaded and deleted, or None if the tree is not in S3.
+        """
+        manifest = self.manifest(tree)
+        if manifest is None:
+            return None
+        os.makedirs(folder, exist_ok=True)
+        hashes = LocalHashes(folder, tree)
+        to_fetch = []
+        for path, entry in manifest.items():
+            file = os.path.join(folder, *path.split('/'))
+            if not os.path.isfile(file) or hashes.get(file) != entry['hash']:
+                to_fetch.append((path, entry))
+
+        def fetch(item):
+            path, entry = item
+            file = os.path.join(folder, *path.split('/'))
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            temp_name = f'{file}.{os.getpid()}.tmp'
+            self.s3_client.download_file(self.bucket, self._object_key(entry['hash']), temp_name,
+                                         Config=self.transfer_config)
+            os.replace(temp_name, file)
+            hashes.set(file, entry['hash'])
+
+        last = [item for item in to_fetch if matches(item[0], LAST)]
+        self._parallel(fetch, [item for item in to_fetch if not matches(item[0], LAST)])
+        self._parallel(fetch, last)
+
+        deleted = 0
+        for file in hashes.files():
+            if os.path.relpath(file, folder).replace(os.sep, '/') not in manifest:
+                if os.path.exists(file):
+                    os.remove(file)
+                    deleted += 1
+                hashes.forget(file)
+        hashes.save()
+        return {
+            'files': len(manifest), 'received': len(to_fetch), 'deleted': deleted,
+            'received_bytes': sum(entry['size'] for _, entry in to_fetch)
+        }
+
+    def manifest(self, tree: str) -> dict:
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self._tree_key(tree))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+        return json.loads(response['Body'].read())
+
+    def _parallel(self, function, items):
+        items = list(items)
+        if not items:
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # list() re-raises the first transfer that failed.
+            list(executor.map(function, items))
+
+    @staticmethod
+    def state_file_name(tree: str) -> str:
+        """
+        Name of the file in a synced folder that remembers the hash of each file (see LocalHashes).
+        """
+        return f".s3sync-{tree.replace('/', '-')}.json"
+
+    def _object_key(self, content_hash: str) -> str:
+        return f'{self.prefix}/objects/{content_hash}'
+
+    def _tree_key(self, tree: str) -> str:
+        return f'{self.prefix}/trees/{tree}.json'
+
+    def _previous_key(self, tree: str) -> str:
+        return f'{self.prefix}/previous/{tree}.json'
+
+
+class LocalHashes(object):
+    """
+    Remembers the hash of each file we have uploaded or downloaded, keyed by
+    its path within the folder and checked against the file's size and
+    mtime before it is trusted. Paths are relative so that a copy of the
+    folder (e.g. a new index version made of hard links) can use them too.
+    """
+    def __init__(self, folder: str, tree: str):
+        self.folder = folder
+        self.file_name = os.path.join(folder, S3Sync.state_file_name(tree))
+        try:
+            with open(self.file_name, 'r') as hash_file:
+                self.entries = json.load(hash_file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, file: str) -> str:
+        stat = os.stat(file)
+        entry = self.entries.get(self._key(file))
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry['hash']
+        content_hash = file_hash(file)
+        self.entries[self._key(file)] = {'hash': content_hash, 'size': stat.st_size, 'mtime': stat.st_mtime}
+        return content_hash
+
+    def set(self, file: str, content_hash: str):
+        stat = os.stat(file)
+        self.entries[self._key(file)] = {'hash': content_hash, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def forget(self, file: str):
+        self.entries.pop(self._key(file), None)
+
+    def files(self) -> list:
+        return [os.path.join(self.folder, *path.split('/')) for path in self.entries]
+
+    def _key(self, file: str) -> str:
+        return os.path.relpath(file, self.folder).replace(os.sep, '/')
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.file_name) or '.', exist_ok=True)
+        temp_name = f'{self.file_name}.tmp'
+        with open(temp_name, 'w') as hash_file:
+            json.dump(self.entries, hash_file)
+        os.replace(temp_name, self.file_name)
+
+
+def file_hash(file: str) -> str:
+    content_hash = hashlib.sha256()
+    with open(file, 'rb') as content_file:
+        for block in iter(lambda: content_file.read(1024 * 1024), b''):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def matches(path: str, patterns: list) -> bool:
+    name = os.path.basename(path)
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def excluded(path: str) -> bool:
+    return matches(path, EXCLUDE)
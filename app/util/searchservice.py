@@ -0,0 +1,459 @@
+"""
+searchservice.py - Long-lived, thread-safe search over the statute index.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+from collections import OrderedDict
+import os
+import threading
+from time import monotonic, perf_counter
+
+from whoosh.index import exists_in, open_dir
+from whoosh.qparser import MultifieldParser, QueryParser
+from whoosh.reading import MultiReader
+from whoosh.searching import Searcher
+
+from util.autocomplete import Completions
+from util.citations import CitationIndex, parse_citation
+import util.functions as FN
+from util.indexstats import QUERIES
+from util.metrics import METRICS
+from util.references import ReferenceIndex
+from util.sectiontext import SectionText
+from util.snippets import FRAGMENTS, leading_snippet, make_highlighter
+from util.spelling import Speller
+
+SEARCH_FIELDS = ['section_name', 'text', 'section_number']
+
+
+class SearchService(object):
+    """
+    Keeps one searcher open for as long as the service runs instead of
+    opening one per query. The searcher is refreshed only when the index
+    changes on disk, and the check is made at most once every
+    *refresh_interval* seconds.
+
+    Restricting a search to some codes uses a cached set of the documents
+    in each code as a filter, rather than adding "code:XX OR ..." clauses
+    to the query. Results are cached by normalized query text, code set
+    and limit, least recently used first out. Both caches are cleared
+    whenever the searcher is refreshed.
+
+    With a sharded layout (FN.INDEX_LAYOUT) each code has its own index.
+    A search opens only the shards of the codes it is restricted to, or
+    every shard when it is not, and runs over a MultiReader of them. The
+    searcher takes document counts, document frequencies and field lengths
+    from the MultiReader, so every hit is scored with statistics for the
+    whole set of shards searched and scores from different codes can be
+    ranked against each other.
+
+    A query that is only a citation, e.g. "FA 6.502" or "Art. 42.12", is
+    answered from the citation tables without touching the full-text index.
+    Those hits have a score of None.
+
+    With snippets=True each hit carries a few short passages around the
+    words it matched, found from the term offsets stored in the index
+    rather than by analyzing the section again. Hits never carry the
+    section's full text; full_text() reads it from the text tables when a
+    caller wants it.
+
+    Misspelled query words are corrected before the query is parsed, from
+    spelling tables built at index time (see util/spelling.py), instead of
+    expanding fuzzy terms against the index's term dictionary.
+
+    complete() is type-ahead over section names and numbers, from prefix
+    tables (see util/autocomplete.py) rather than the full-text index.
+
+    cites() and cited_by() answer from the reference tables (see
+    util/references.py) which sections a section refers to and which refer
+    to it, again without touching the full-text index.
+
+    When INDEX_PATH is a link to one of several index versions (see
+    util/indexversions.py) and the link is moved, the new version is opened
+    alongside the old one and warmed by re-running the *warm_queries* most
+    recently used queries. Searches keep using the old version until then,
+    and the results cache starts out holding the warmed queries.
+    """
+    def __init__(self, index_path: str = None, index_name: str = None, cache_size: int = 1024,
+                 refresh_interval: float = 1.0, layout: str = None, warm_queries: int = 100):
+        self.index_path = index_path or FN.INDEX_PATH
+        self.path = os.path.realpath(self.index_path)
+        self.warm_queries = warm_queries
+        self.layout = layout or FN.INDEX_LAYOUT
+        self.index_name = None if self.layout == 'sharded' else index_name or FN.index_name(None)
+        self.cache_size = cache_size
+        self.refresh_interval = refresh_interval
+        self.lock = threading.RLock()
+        self.cache_lock = threading.Lock()
+        self.switch_lock = threading.Lock()
+        self.switch_thread = None
+        self.cache = OrderedDict()
+        # Bumped, under both locks, whenever the cache is emptied for a new
+        # index. A search caches its hits only if it is unchanged since it ran.
+        self.generation = 0
+        self.code_filters = {}
+        self.last_check = monotonic()
+        self.index = None
+        self.searcher = None
+        self.shards = {}
+        self.shard_searchers = {}
+        self.parser = None
+        self.code_parser = None
+        self.citations = CitationIndex(self.path)
+        self.references = ReferenceIndex(self.path, self.citations)
+        self.section_text = SectionText(self.path)
+        self.completions = Completions(self.path)
+        self.speller = Speller(self.path)
+        self.highlighter = make_highlighter()
+        self._open()
+
+    def _open(self):
+        if self.layout == 'sharded':
+            schema = FN.schema()
+        else:
+            self.index = open_dir(self.path, self.index_name)
+            self.searcher = self.index.searcher()
+            schema = self.index.schema
+        self.parser = MultifieldParser(SEARCH_FIELDS, schema=schema)
+        self.code_parser = QueryParser('code', schema)
+
+    def close(self):
+        with self.lock:
+            if self.searcher:
+                self.searcher.close()
+            for searcher, _ in self.shard_searchers.values():
+                searcher.close()
+            self.shard_searchers.clear()
+            for index in self.shards.values():
+                index.close()
+            self.shards.clear()
+            self.citations.close()
+            self.references.close()
+            self.section_text.close()
+            self.completions.close()
+            self.speller.close()
+            if self.index:
+                self.index.close()
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Move to the latest version of the index if it has changed.
+
+        Args:
+            force (bool): Check now, even if we checked less than refresh_interval seconds ago.
+        Returns:
+            (bool): True if the searcher was refreshed.
+        """
+        now = monotonic()
+        if not force and now - self.last_check < self.refresh_interval:
+            return False
+        path = os.path.realpath(self.index_path)
+        if path != self.path:
+            # Move to the new version in the background; meanwhile every
+            # search, this one included, keeps using the old version.
+            if self.switch_lock.acquire(blocking=False):
+                self.last_check = now
+                self.switch_thread = threading.Thread(target=self._switch_version, args=(path,), daemon=True)
+                self.switch_thread.start()
+            return False
+        with self.lock:
+            self.last_check = now
+            self.citations.refresh()
+            self.references.refresh()
+            self.section_text.refresh()
+            self.completions.refresh()
+            self.speller.refresh()
+            if self.layout == 'sharded':
+                if not self._refresh_shards():
+                    return False
+            else:
+                if self.searcher.up_to_date():
+                    return False
+                self.searcher = self.searcher.refresh()
+                self.code_filters.clear()
+            with self.cache_lock:
+                self.cache.clear()
+                self.generation += 1
+            return True
+
+    def _refresh_shards(self) -> bool:
+        # Drop every searcher built on a shard that has a newer generation on
+        # disk, and all of them if shards were added or removed.
+        # They are rebuilt the next time a search needs them.
+        generations = {name: index.latest_generation() for name, index in self.shards.items()}
+        names = tuple(FN.shard_names(self.path))
+        stale = [
+            key for key, (_, key_generations) in self.shard_searchers.items()
+            if key_generations[0] != names
+            or any(generations[name] != generation for name, generation in key_generations[1:])
+        ]
+        for key in stale:
+            self.shard_searchers.pop(key)[0].close()
+        return bool(stale)
+
+    def _switch_version(self, path: str):
+        try:
+            self._open_version(path)
+        except Exception as e:
+            # Leave things as they are; the next refresh tries again.
+            print(f"Could not open index version {path}: {str(e)}")
+        finally:
+            self.switch_lock.release()
+
+    def _open_version(self, path: str):
+        # Open and warm the new version without holding the lock, so searches
+        # carry on against the old version in the meantime.
+        with self.cache_lock:
+            recent = list(self.cache)[-self.warm_queries:] if self.warm_queries else []
+        if self.warm_queries and not recent:
+            recent = [(query_text, frozenset(), 10, False, True) for query_text in QUERIES]
+        fresh = SearchService(
+            path, self.index_name, self.cache_size, refresh_interval=self.refresh_interval,
+            layout=self.layout, warm_queries=self.warm_queries
+        )
+        for key in recent:
+            try:
+                fresh.search(*key)
+            except Exception:
+                pass
+
+        with self.lock:
+            old_searchers = [self.searcher] + [searcher for searcher, _ in self.shard_searchers.values()]
+            old_indexes = [self.index] + list(self.shards.values())
+            for name in ('path', 'index', 'searcher', 'shards', 'shard_searchers', 'parser', 'code_parser',
+                         'citations', 'references', 'section_text', 'completions', 'speller',
+                         'code_filters'):
+                setattr(self, name, getattr(fresh, name))
+            with self.cache_lock:
+                self.cache = fresh.cache
+                self.generation += 1
+            # Searches hold the lock, so nothing is using the old searchers now.
+            # The old citation, reference, text, prefix and spelling tables are
+            # left for the garbage collector since lookups in them do not take the lock.
+            for old in old_searchers + old_indexes:
+                if old is not None:
+                    old.close()
+
+    def search(self, query_text: str, codes: list = None, limit: int = 10, snippets: bool = False,
+               spelling: bool = True) -> list:
+        """
+        Search the index.
+
+        Args:
+            query_text (str): Query in Whoosh query language.
+            codes (list): Code abbreviations to restrict the search to. None or empty for all codes.
+            limit (int): Maximum number of hits to return.
+            snippets (bool): Whether to add each hit's 'snippet' (see util/snippets.py).
+            spelling (bool): Whether to correct misspelled words first (see correct()).
+        Returns:
+            (list): One dict of stored fields per hit, best first, with its score.
+        """
+        start = perf_counter()
+        codes = frozenset(code.strip().upper() for code in codes or [] if code.strip())
+        key = (normalize_query(query_text), codes, limit, snippets, spelling)
+        self.refresh()
+
+        citation = parse_citation(key[0])
+        if citation:
+            sections = self.citations.lookup(*citation, codes=codes)
+            if sections:
+                hits = [dict(section, score=None) for section in sections[:limit]]
+                if snippets:
+                    for hit in hits:
+                        hit['snippet'] = leading_snippet(self.section_text.text(hit['doc_id']))
+                METRICS.add_time('search.citation', perf_counter() - start)
+                return hits
+
+        with self.cache_lock:
+            hits = self.cache.get(key)
+            if hits is not None:
+                self.cache.move_to_end(key)
+                METRICS.add_time('search.cached', perf_counter() - start)
+                return hits
+
+        corrected = self.speller.correct(key[0], codes) if spelling else key[0]
+        with self.lock:
+            generation = self.generation
+            query = self.parser.parse(corrected)
+            if self.layout == 'sharded':
+                searcher, code_filter = self._shard_searcher(codes), None
+                skip = searcher is None
+            else:
+                searcher, code_filter = self.searcher, self._code_filter(codes)
+                # Whoosh treats an empty filter as no filter at all.
+                skip = codes and not code_filter
+            if skip:
+                hits = []
+            else:
+                results = searcher.search(query, filter=code_filter, limit=limit, terms=snippets)
+                hits = [dict(hit.fields(), score=hit.score) for hit in results]
+                if snippets:
+                    for hit, fields in zip(results, hits):
+                        fields['snippet'] = self._snippet(hit)
+
+        with self.cache_lock:
+            # Hits from an index that has been replaced since must not outlive it.
+            if self.generation == generation:
+                self.cache[key] = hits
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        METRICS.add_time('search.index', perf_counter() - start)
+        return hits
+
+    def _snippet(self, hit) -> list:
+        text = self.section_text.text(hit['doc_id'])
+        if not text:
+            return []
+        return self.highlighter.highlight_hit(hit, 'text', text=text, top=FRAGMENTS) or leading_snippet(text)
+
+    def correct(self, query_text: str, codes: list = None) -> str:
+        """
+        The query as search() runs it, with misspelled words replaced by the
+        closest words in the index, e.g. for a "Showing results for ..." line.
+
+        Args:
+            query_text (str): Query in Whoosh query language.
+            codes (list): Code abbreviations whose words to use. None or empty for all codes.
+        """
+        codes = frozenset(code.strip().upper() for code in codes or [] if code.strip())
+        self.refresh()
+        return self.speller.correct(normalize_query(query_text), codes)
+
+    def complete(self, text: str, codes: list = None, limit: int = 10) -> list:
+        """
+        Type-ahead: the sections whose name or number starts with what has been typed.
+
+        Args:
+            text (str): What has been typed so far, e.g. "protective ord", "6.5" or "FA 6.5".
+            codes (list): Code abbreviations to complete from. None or empty for all codes.
+            limit (int): Maximum number of completions.
+        Returns:
+            (list): doc_id, code, section_prefix, section_number, section_name
+                    and cited_by of each section, most cited first.
+        """
+        start = perf_counter()
+        codes = frozenset(code.strip().upper() for code in codes or [] if code.strip())
+        self.refresh()
+        completions = self.completions.complete(text, codes, limit)
+        METRICS.add_time('search.complete', perf_counter() - start)
+        return completions
+
+    def full_text(self, section: str) -> dict:
+        """
+        The full text of a section, read only now rather than with every hit.
+
+        Args:
+            section (str): Section ID, e.g. "FA:6.502", or a citation with a code, e.g. "FA 6.502".
+        Returns:
+            (dict): doc_id, text (as indexed; snippet offsets are into it) and
+                    source_text (as published), or None if there is no such section.
+        Raises:
+            ValueError: If section is not a section ID or citation.
+        """
+        self.refresh()
+        section_id = reference_id(section)
+        code_name, _, number = section_id.partition(':')
+        if not code_name.isalnum() or not number.strip():
+            raise ValueError(f"Not a section ID: {section}")
+        source_text = self.section_text.source_text(section_id)
+        if source_text is None:
+            return None
+        return {'doc_id': section_id, 'text': self.section_text.text(section_id), 'source_text': source_text}
+
+    def cites(self, section: str) -> list:
+        """
+        The sections and chapters a section refers to.
+
+        Args:
+            section (str): Section ID, e.g. "FA:6.502", or a citation with a code, e.g. "FA 6.502".
+        Returns:
+            (list): The stored fields of each section referred to, and
+                    {'doc_id', 'code', 'chapter'} for each chapter referred to.
+        """
+        self.refresh()
+        return self._reference_records(self.references.cites(reference_id(section)))
+
+    def cited_by(self, section: str) -> list:
+        """
+        The sections that refer to a section or chapter.
+
+        Args:
+            section (str): Section or chapter ID, e.g. "FA:6.502" or "FA:Ch.153",
+                           or a citation with a code, e.g. "FA 6.502".
+        Returns:
+            (list): The stored fields of each section that refers to it.
+        """
+        self.refresh()
+        return self._reference_records(self.references.cited_by(reference_id(section)))
+
+    def _reference_records(self, reference_ids: list) -> list:
+        records = []
+        for target in reference_ids:
+            code_name, number = target.split(':', 1)
+            if number.startswith('Ch.'):
+                records.append({'doc_id': target, 'code': code_name, 'chapter': number[len('Ch.'):]})
+            else:
+                records += self.citations.lookup(code_name, None, number)
+        return records
+
+    def _code_filter(self, codes: frozenset) -> set:
+        if not codes:
+            return None
+        docnums = set()
+        for code in codes:
+            code_docs = self.code_filters.get(code)
+            if code_docs is None:
+                code_docs = self.code_filters[code] = frozenset(
+                    self.searcher.docs_for_query(self.code_parser.parse(code))
+                )
+            docnums.update(code_docs)
+        return docnums
+
+    def _shard_searcher(self, codes: frozenset) -> Searcher:
+        """
+        Searcher over the shards of the given codes, or of every code when
+        codes is empty. Returns None if none of them has been indexed.
+        """
+        key = codes or None
+        entry = self.shard_searchers.get(key)
+        if entry is not None:
+            return entry[0]
+
+        all_names = tuple(FN.shard_names(self.path))
+        names = sorted(code.lower() for code in codes) if codes else all_names
+        indexes = [self._shard(name) for name in names]
+        indexes = [(name, index) for name, index in zip(names, indexes) if index is not None]
+        if not indexes:
+            return None
+
+        readers = [index.reader() for _, index in indexes]
+        # A shard with more than one segment is a MultiReader itself. Whoosh
+        # expects every leaf of a MultiReader to be a single segment, so
+        # gather the segments of all the shards into one.
+        segments = [segment for reader in readers for segment, _ in reader.leaf_readers()]
+        reader = readers[0] if len(readers) == 1 else MultiReader(segments)
+        searcher = Searcher(reader)
+        generations = (all_names,) + tuple((name, reader.generation()) for (name, _), reader in zip(indexes, readers))
+        self.shard_searchers[key] = (searcher, generations)
+        return searcher
+
+    def _shard(self, name: str):
+        index = self.shards.get(name)
+        if index is None and exists_in(self.path, name):
+            index = self.shards[name] = open_dir(self.path, name)
+        return index
+
+
+def reference_id(section: str) -> str:
+    """
+    Turn "FA 6.502" or "fa:6.502" into the "FA:6.502" form of IDs in the reference tables.
+    """
+    citation = parse_citation(section)
+    if citation and citation[0]:
+        return FN.doc_id(citation[0], citation[2])
+    code_name, _, number = section.strip().partition(':')
+    return f'{code_name.upper()}:{number}'
+
+
+def normalize_query(query_text: str) -> str:
+    return ' '.join(query_text.split())
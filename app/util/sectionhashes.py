@@ -0,0 +1,50 @@
+"""
+sectionhashes.py - Remember what each indexed section looked like.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+import hashlib
+import json
+import os
+
+
+class SectionHashes(object):
+    """
+    Sidecar manifest kept next to an index that maps each section's doc_id
+    (code + section number) to a hash of the section as it was indexed. By
+    comparing freshly classified sections against it we can add, update and
+    delete only the sections that changed instead of rebuilding a code.
+    """
+    def __init__(self, index_path: str, index_name: str):
+        self.file_name = os.path.join(index_path, f'{index_name}-hashes.json')
+        try:
+            with open(self.file_name, 'r') as hash_file:
+                self.codes = json.load(hash_file)
+        except (OSError, ValueError):
+            self.codes = {}
+
+    @staticmethod
+    def hash(section: dict) -> str:
+        return hashlib.sha1(json.dumps(section, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def has_code(self, code_name: str) -> bool:
+        return code_name in self.codes
+
+    def for_code(self, code_name: str) -> dict:
+        """
+        Returns:
+            (dict): doc_id -> hash for every indexed section of this code.
+        """
+        return self.codes.get(code_name, {})
+
+    def set_code(self, code_name: str, hashes: dict):
+        self.codes[code_name] = hashes
+
+    def remove_code(self, code_name: str):
+        self.codes.pop(code_name, None)
+
+    def save(self):
+        temp_name = f'{self.file_name}.tmp'
+        with open(temp_name, 'w') as hash_file:
+            json.dump(self.codes, hash_file)
+        os.replace(temp_name, self.file_name)
@@ -0,0 +1,78 @@
+"""
+sectiontext.py - Keep the full text of every section outside the search index.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+import os
+
+import util.functions as FN
+from util.mmaptable import CodeTables, MmapTableWriter, remove_table
+
+TEXT = 't'
+SOURCE_TEXT = 's'
+
+
+def section_text_path(code_name: str, index_path: str = None) -> str:
+    return os.path.join(index_path or FN.INDEX_PATH, f'{code_name.lower()}-text')
+
+
+def build_section_text(code_name: str, chapters, index_path: str = None):
+    """
+    Write the text table for one code from its sections. Each section has
+    two records, keyed by its doc_id:
+
+        t{doc_id}   The text as indexed. Highlight offsets are into this text.
+        s{doc_id}   The text as published, which is what we display.
+
+    Args:
+        code_name (str): Code abbreviation from the code's config file.
+        chapters (iterable): The list of sections of every chapter of the code.
+        index_path (str): Directory for the table. Defaults to INDEX_PATH.
+    """
+    writer = MmapTableWriter(section_text_path(code_name, index_path))
+    for chapter in chapters:
+        for section in chapter or []:
+            if not section.get('section_number'):
+                continue
+            section_id = FN.doc_id(code_name, section['section_number'])
+            writer.add(f'{TEXT}{section_id}', (section.get('text') or '').encode('utf-8'))
+            writer.add(f'{SOURCE_TEXT}{section_id}', (section.get('source_text') or '').encode('utf-8'))
+    writer.save()
+
+
+def remove_section_text(code_name: str, index_path: str = None):
+    remove_table(section_text_path(code_name, index_path))
+
+
+class SectionText(object):
+    """
+    The text tables of every indexed code.
+    """
+    def __init__(self, index_path: str = None):
+        self.index_path = index_path or FN.INDEX_PATH
+        self.tables = CodeTables(self.index_path, 'text')
+
+    def text(self, section_id: str) -> str:
+        """
+        Returns:
+            (str): The indexed text of a section, or None if there is none.
+        """
+        return self._get(TEXT, section_id)
+
+    def source_text(self, section_id: str) -> str:
+        """
+        Returns:
+            (str): The published text of a section, or None if there is none.
+        """
+        return self._get(SOURCE_TEXT, section_id)
+
+    def _get(self, kind: str, section_id: str) -> str:
+        table = self.tables.get(section_id.split(':', 1)[0])
+        value = table.get(f'{kind}{section_id}') if table else None
+        return value.decode('utf-8') if value is not None else None
+
+    def refresh(self) -> bool:
+        return self.tables.refresh()
+
+    def close(self):
+        self.tables.close()
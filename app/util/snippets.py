@@ -0,0 +1,78 @@
+"""
+snippets.py - Short passages of a section around the words a search matched.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+from whoosh.highlight import Formatter, Highlighter, PinpointFragmenter
+
+SNIPPET_CHARS = 200
+SURROUND = 40
+FRAGMENTS = 3
+
+
+class SnippetFormatter(Formatter):
+    """
+    Returns fragments as data rather than marked-up text, so the caller
+    decides how to show a match:
+
+        [{'start': 512, 'text': '... the child support ...', 'highlights': [[8, 13], [14, 21]]}]
+
+    *start* is where the fragment begins in the section's text and each
+    highlight is [start, end) within the fragment.
+    """
+    def format(self, fragments, replace=False):
+        snippets = []
+        for fragment in fragments:
+            highlights = []
+            end = fragment.startchar
+            for token in sorted(fragment.matches, key=lambda t: t.startchar):
+                if token.startchar < end or token.endchar > fragment.endchar:
+                    continue
+                highlights.append([token.startchar - fragment.startchar, token.endchar - fragment.startchar])
+                end = token.endchar
+            snippets.append({
+                'start': fragment.startchar,
+                'text': fragment.text[fragment.startchar:fragment.endchar],
+                'highlights': highlights,
+            })
+        return snippets
+
+
+def make_highlighter(always_retokenize: bool = False) -> Highlighter:
+    """
+    A highlighter that finds matches from the character offsets stored in
+    the index (TEXT(chars=True)) instead of running the analyzer over the
+    whole section again. The fragments are cut from the section's text
+    without tokenizing it. Fields indexed without offsets fall back to
+    re-tokenizing.
+
+    Args:
+        always_retokenize (bool): Re-tokenize even when offsets are stored, for comparison.
+    """
+    return Highlighter(
+        fragmenter=PinpointFragmenter(maxchars=SNIPPET_CHARS, surround=SURROUND, autotrim=True),
+        formatter=SnippetFormatter(),
+        always_retokenize=always_retokenize
+    )
+
+
+def leading_snippet(text: str) -> list:
+    """
+    A snippet for a hit that matched no words, e.g. a citation: the start of its text.
+    """
+    return [{'start': 0, 'text': text[:SNIPPET_CHARS], 'highlights': []}] if text else []
+
+
+def snippet_text(snippet: list, before: str = '[', after: str = ']', between: str = ' ... ') -> str:
+    """
+    Render a snippet as plain text with each match marked.
+    """
+    rendered = []
+    for fragment in snippet or []:
+        text, position, parts = fragment['text'], 0, []
+        for start, end in fragment['highlights']:
+            parts += [text[position:start], before, text[start:end], after]
+            position = end
+        parts.append(text[position:])
+        rendered.append(' '.join(''.join(parts).split()))
+    return between.join(rendered)
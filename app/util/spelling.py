@@ -0,0 +1,182 @@
+"""
+spelling.py - Correct misspelled query words from the indexed vocabulary (symmetric delete).
+
+Copyright (c) 2020 by Thomas J. Daley, J.D.
+"""
+from collections import Counter, defaultdict
+import os
+import re
+
+import util.functions as FN
+from util.mmaptable import CodeTables, MmapTableWriter, remove_table
+
+MAX_DISTANCE = 2
+PREFIX_LENGTH = 7
+MIN_LENGTH = 3
+
+# Plain words of a query, with an old-style fuzzy suffix ("custody~2") if
+# it has one. Field names ("code:"), wildcards and the operators are left alone.
+QUERY_WORD = re.compile(r'(?<![\w:.*?\\])([A-Za-z]+)(~\d*)?(?![\w:*?])')
+OPERATORS = {'AND', 'OR', 'NOT', 'TO', 'ANDNOT', 'ANDMAYBE'}
+
+
+def deletes(word: str, max_distance: int = MAX_DISTANCE) -> set:
+    """
+    Every string made by deleting up to max_distance characters from the
+    first PREFIX_LENGTH characters of word, and that prefix itself.
+    """
+    prefix = word[:PREFIX_LENGTH]
+    found = {prefix}
+    edges = {prefix}
+    for _ in range(max_distance):
+        edges = {edge[:i] + edge[i + 1:] for edge in edges if len(edge) > 1 for i in range(len(edge))}
+        found |= edges
+    return found
+
+
+def edit_distance(a: str, b: str, max_distance: int = MAX_DISTANCE) -> int:
+    """
+    Damerau-Levenshtein distance (optimal string alignment), or max_distance + 1
+    as soon as it is known to be more than max_distance.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def spelling_path(code_name: str, index_path: str = None) -> str:
+    return os.path.join(index_path or FN.INDEX_PATH, f'{code_name.lower()}-spelling')
+
+
+def build_spelling(code_name: str, chapters, index_path: str = None) -> int:
+    """
+    Write the spelling table for one code from the words of its section names
+    and text, as the index's analyzer sees them:
+
+        #{word}     How many times the word appears.
+        ~{delete}   The words that have this delete among their deletes().
+
+    Args:
+        code_name (str): Code abbreviation from the code's config file.
+        chapters (iterable): The list of sections of every chapter of the code.
+        index_path (str): Directory for the table. Defaults to INDEX_PATH.
+    Returns:
+        (int): Number of words in the vocabulary.
+    """
+    analyzer = FN.schema()['text'].analyzer
+    counts = Counter()
+    for chapter in chapters:
+        for section in chapter or []:
+            if not section.get('section_number'):
+                continue
+            for text in (section.get('section_name'), section.get('text')):
+                counts.update(
+                    token.text for token in analyzer(text or '')
+                    if len(token.text) >= MIN_LENGTH and token.text.isalpha()
+                )
+
+    words_by_delete = defaultdict(list)
+    for word in counts:
+        for delete in deletes(word):
+            words_by_delete[delete].append(word)
+
+    writer = MmapTableWriter(spelling_path(code_name, index_path))
+    for word, count in counts.items():
+        writer.add(f'#{word}', str(count).encode('utf-8'))
+    for delete, words in words_by_delete.items():
+        writer.add(f'~{delete}', '\n'.join(words).encode('utf-8'))
+    writer.save()
+    return len(counts)
+
+
+def remove_spelling(code_name: str, index_path: str = None):
+    remove_table(spelling_path(code_name, index_path))
+
+
+class Speller(object):
+    """
+    Corrects query words against the spelling tables of every indexed code.
+
+    A word the index knows is left alone. Otherwise the deletes of the word
+    are looked up, which gives every known word within MAX_DISTANCE edits
+    of it (SymSpell), and the closest, most frequent one replaces it. This
+    costs a few dozen table lookups per unknown word, where a fuzzy term
+    query walks the whole term dictionary of the field.
+    """
+    def __init__(self, index_path: str = None):
+        self.index_path = index_path or FN.INDEX_PATH
+        self.tables = CodeTables(self.index_path, 'spelling')
+        self.analyzer = FN.schema()['text'].analyzer
+
+    def _tables(self, codes: frozenset) -> list:
+        tables = (self.tables.get(code_name) for code_name in (sorted(codes) if codes else self.tables.code_names()))
+        return [table for table in tables if table is not None]
+
+    def frequency(self, word: str, codes: frozenset = None) -> int:
+        count = 0
+        for table in self._tables(codes):
+            value = table.get(f'#{word}')
+            if value:
+                count += int(value)
+        return count
+
+    def suggest(self, word: str, codes: frozenset = None) -> str:
+        """
+        Returns:
+            (str): The known word closest to word, word itself if it is
+                   known, or None if nothing is within MAX_DISTANCE edits.
+        """
+        word = word.lower()
+        tables = self._tables(codes)
+        if any(table.get(f'#{word}') for table in tables):
+            return word
+        candidates = set()
+        for delete in deletes(word):
+            for table in tables:
+                value = table.get(f'~{delete}')
+                if value:
+                    candidates.update(value.decode('utf-8').split('\n'))
+        best, best_key = None, None
+        for candidate in candidates:
+            distance = edit_distance(word, candidate)
+            if distance > MAX_DISTANCE:
+                continue
+            key = (distance, -self.frequency(candidate, codes), candidate)
+            if best_key is None or key < best_key:
+                best, best_key = candidate, key
+        return best
+
+    def correct(self, query_text: str, codes: frozenset = None) -> str:
+        """
+        Rewrite the misspelled words of a query. Words the analyzer drops
+        (stop words, words under MIN_LENGTH letters) and operators are kept
+        as they are. A "~" after a word, which used to ask for a fuzzy
+        match, is dropped.
+        """
+        def replace(match):
+            word = match.group(1)
+            if word in OPERATORS or len(word) < MIN_LENGTH or not any(True for _ in self.analyzer(word)):
+                return word
+            suggestion = self.suggest(word, codes)
+            if suggestion is None or suggestion == word.lower():
+                return word
+            return suggestion
+        return QUERY_WORD.sub(replace, query_text)
+
+    def refresh(self) -> bool:
+        return self.tables.refresh()
+
+    def close(self):
+        self.tables.close()